@@ -10,6 +10,7 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/5.2/ref/settings/
 """
 import os
+from importlib.util import find_spec
 from pathlib import Path
 from dotenv import load_dotenv
 
@@ -47,11 +48,13 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    "referral_system.middleware.RequestMetricsMiddleware",
     "django.middleware.security.SecurityMiddleware",
     "django.contrib.sessions.middleware.SessionMiddleware",
     "django.middleware.common.CommonMiddleware",
     "django.middleware.csrf.CsrfViewMiddleware",
     "django.contrib.auth.middleware.AuthenticationMiddleware",
+    "referral_system.db_router.ReplicaRoutingMiddleware",
     "django.contrib.messages.middleware.MessageMiddleware",
     "django.middleware.clickjacking.XFrameOptionsMiddleware",
 ]
@@ -61,10 +64,15 @@ ROOT_URLCONF = "ReferralSystem.urls"
 TEMPLATES = [
     {
         "BACKEND": "django.template.backends.django.DjangoTemplates",
-        "DIRS": [BASE_DIR / 'templates']
-        ,
-        "APP_DIRS": True,
+        "DIRS": [BASE_DIR / 'templates'],
         "OPTIONS": {
+            # compiled templates are kept in memory, the autoreloader resets them when a template changes
+            "loaders": [
+                ("django.template.loaders.cached.Loader", [
+                    "django.template.loaders.filesystem.Loader",
+                    "django.template.loaders.app_directories.Loader",
+                ]),
+            ],
             "context_processors": [
                 "django.template.context_processors.request",
                 "django.contrib.auth.context_processors.auth",
@@ -80,6 +88,11 @@ WSGI_APPLICATION = "ReferralSystem.wsgi.application"
 # Database
 # https://docs.djangoproject.com/en/5.2/ref/settings/#databases
 
+# Connections are kept open for DB_CONN_MAX_AGE seconds instead of being opened for every request.
+# DB_POOL=true switches to the connection pool of psycopg 3 (psycopg[pool], CONN_MAX_AGE must be 0 then).
+# Behind pgbouncer in transaction pooling mode set DB_PGBOUNCER=true, server-side cursors do not survive it
+DB_POOL = os.getenv('DB_POOL') in ('1', 'true')
+
 DATABASES = {
     "default": {
         "ENGINE": "django.db.backends.postgresql",
@@ -88,9 +101,51 @@ DATABASES = {
         'PASSWORD': os.getenv('DB_PASSWORD'),
         'HOST': os.getenv('DB_HOST'),
         'PORT': os.getenv('DB_PORT'),
+        'CONN_MAX_AGE': 0 if DB_POOL else int(os.getenv('DB_CONN_MAX_AGE', 60)),
+        'CONN_HEALTH_CHECKS': True,
+        'DISABLE_SERVER_SIDE_CURSORS': os.getenv('DB_PGBOUNCER') in ('1', 'true'),
+        'OPTIONS': {
+            'pool': {
+                'min_size': int(os.getenv('DB_POOL_MIN_SIZE', 2)),
+                'max_size': int(os.getenv('DB_POOL_MAX_SIZE', 10)),
+            },
+        } if DB_POOL else {},
     }
 }
 
+# Read replicas (comma separated hosts with the credentials of the primary). Only the views in REPLICA_READ_VIEWS
+# read from them, and not for REPLICA_STICKY_SECONDS after the same user wrote something,
+# see referral_system/db_router.py. The profile views are left out: they fill the versioned profile caches,
+# and a lagging replica would store stale data under the new version
+for number, host in enumerate(filter(None, os.getenv('DB_REPLICA_HOSTS', '').split(',')), start=1):
+    DATABASES[f'replica{number}'] = {**DATABASES['default'], 'HOST': host, 'TEST': {'MIRROR': 'default'}}
+DATABASE_REPLICAS = [alias for alias in DATABASES if alias != 'default']
+DATABASE_ROUTERS = ['referral_system.db_router.PrimaryReplicaRouter']
+REPLICA_READ_VIEWS = ['all_users']
+REPLICA_STICKY_SECONDS = int(os.getenv('REPLICA_STICKY_SECONDS', 10))
+REPLICA_STICKY_CACHE = 'default'
+
+
+# Cache
+# https://docs.djangoproject.com/en/5.2/topics/cache/
+# Without REDIS_URL every process has its own local memory cache
+
+REDIS_URL = os.getenv('REDIS_URL')
+
+if REDIS_URL:
+    CACHES = {
+        "default": {
+            "BACKEND": "django.core.cache.backends.redis.RedisCache",
+            "LOCATION": REDIS_URL,
+        }
+    }
+else:
+    CACHES = {
+        "default": {
+            "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+        }
+    }
+
 
 # Password validation
 # https://docs.djangoproject.com/en/5.2/ref/settings/#auth-password-validators
@@ -113,10 +168,107 @@ AUTH_PASSWORD_VALIDATORS = [
 
 
 REST_FRAMEWORK = {
+    # orjson and MessagePack (for clients sending Accept: application/msgpack) are in requirements.txt.
+    # Without orjson the stock JSON encoder is used, without msgpack that renderer is left out
+    "DEFAULT_RENDERER_CLASSES": [
+        "referral_system.renderers.ORJSONRenderer",
+        *(["referral_system.renderers.MessagePackRenderer"] if find_spec("msgpack") else []),
+        "rest_framework.renderers.BrowsableAPIRenderer",
+    ],
     "DEFAULT_AUTHENTICATION_CLASSES": (
+        "referral_system.authentication.SignedTokenAuthentication",
         "rest_framework.authentication.SessionAuthentication",
-    )
+    ),
+    # Sliding window limits of the auth endpoints, see referral_system/ratelimit.py
+    "DEFAULT_THROTTLE_RATES": {
+        "auth_ip": os.getenv('AUTH_IP_RATE', '20/min'),
+        "auth_phone": os.getenv('AUTH_PHONE_RATE', '5/min'),
+        "auth_global": os.getenv('AUTH_GLOBAL_RATE', '200/s'),
+    },
+    # Reverse proxies in front of the app: the auth_ip limit keys on the address this many hops from the end
+    # of X-Forwarded-For. 0 trusts only REMOTE_ADDR, a client can put anything in the header
+    "NUM_PROXIES": int(os.getenv('NUM_PROXIES', 0)),
+}
+
+RATE_LIMIT_CACHE = 'default'
+
+# Signed access/refresh tokens returned by /referral/confirm/ with token=true (lifetimes in seconds).
+# The revocation list must live in a cache shared by all processes in production
+ACCESS_TOKEN_LIFETIME = int(os.getenv('ACCESS_TOKEN_LIFETIME', 15 * 60))
+REFRESH_TOKEN_LIFETIME = int(os.getenv('REFRESH_TOKEN_LIFETIME', 30 * 24 * 60 * 60))
+TOKEN_REVOCATION_CACHE = 'default'
+
+# /referral/users/ pagination and NDJSON export
+REFERRAL_USERS_PAGE_SIZE = int(os.getenv('REFERRAL_USERS_PAGE_SIZE', 100))
+REFERRAL_USERS_MAX_PAGE_SIZE = int(os.getenv('REFERRAL_USERS_MAX_PAGE_SIZE', 1000))
+REFERRAL_USERS_STREAM_CHUNK_SIZE = int(os.getenv('REFERRAL_USERS_STREAM_CHUNK_SIZE', 2000))
+
+# /referral/test/users/ page size, every page is cached as a template fragment until any profile changes
+USER_PROFILES_PAGE_SIZE = int(os.getenv('USER_PROFILES_PAGE_SIZE', 100))
+
+# Per-user profile cache, invalidated explicitly whenever a profile changes
+PROFILE_CACHE = 'default'
+PROFILE_CACHE_TIMEOUT = 24 * 60 * 60
+
+# Authorization code storage. Codes are kept in the cache when it is shared between processes (Redis),
+# otherwise in the UserPhoneCode table
+PHONE_CODE_STORE = os.getenv(
+    'PHONE_CODE_STORE',
+    'referral_system.code_store.CacheCodeStore' if REDIS_URL else 'referral_system.code_store.DatabaseCodeStore',
+)
+PHONE_CODE_CACHE = 'default'
+PHONE_CODE_TTL = 60 * 60
+PHONE_CODE_RESEND_INTERVAL = 30
+
+# Authorization code delivery off the request thread, at most CODE_DELIVERY_QUEUE codes wait for a worker.
+# In DEBUG the fake gateway simulates a one second SMS round trip, otherwise messages are only logged
+# until SMS_GATEWAY names a real provider
+CODE_DELIVERY_BACKEND = 'referral_system.sms.ThreadPoolCodeDelivery'
+CODE_DELIVERY_OPTIONS = {
+    'max_workers': int(os.getenv('CODE_DELIVERY_WORKERS', 8)),
+    'max_queue': int(os.getenv('CODE_DELIVERY_QUEUE', 1000)),
 }
+SMS_GATEWAY = os.getenv(
+    'SMS_GATEWAY', 'referral_system.sms.FakeSMSGateway' if DEBUG else 'referral_system.sms.LoggingSMSGateway')
+SMS_GATEWAY_OPTIONS = {'latency': 1} if SMS_GATEWAY == 'referral_system.sms.FakeSMSGateway' else {}
+
+# Users with at least this many referrals are deleted by a background worker that unlinks the referrals
+# in chunks of REFERRAL_UNLINK_CHUNK_SIZE rows
+REFERRAL_UNLINK_BACKGROUND_THRESHOLD = int(os.getenv('REFERRAL_UNLINK_BACKGROUND_THRESHOLD', 10000))
+REFERRAL_UNLINK_CHUNK_SIZE = int(os.getenv('REFERRAL_UNLINK_CHUNK_SIZE', 1000))
+
+# Invite code sequence numbers reserved per round trip to the counter row
+INVITE_CODE_BLOCK_SIZE = int(os.getenv('INVITE_CODE_BLOCK_SIZE', 100))
+# Per-process index of all invite codes answering "no such code" without a query, built in the background
+# at startup: '' (off), 'sorted' (exact, 8 bytes per code) or 'bloom' (INVITE_CODE_INDEX_ERROR_RATE false positives,
+# about 10 bits per code at 1%). Codes created by other processes are picked up at most INVITE_CODE_INDEX_REFRESH
+# seconds later
+INVITE_CODE_INDEX = os.getenv('INVITE_CODE_INDEX', '')
+INVITE_CODE_INDEX_ERROR_RATE = float(os.getenv('INVITE_CODE_INDEX_ERROR_RATE', 0.01))
+INVITE_CODE_INDEX_REFRESH = float(os.getenv('INVITE_CODE_INDEX_REFRESH', 1))
+
+# Views (URL names) whose latency, queries and response size are recorded for /metrics, empty for all views.
+# Requests slower than SLOW_REQUEST_THRESHOLD seconds are logged with up to SLOW_REQUEST_MAX_QUERIES SQL statements
+REQUEST_METRICS_VIEWS = [name for name in os.getenv('REQUEST_METRICS_VIEWS', 'all_users,profile,delete_user').split(',')
+                         if name]
+SLOW_REQUEST_THRESHOLD = float(os.getenv('SLOW_REQUEST_THRESHOLD')) if os.getenv('SLOW_REQUEST_THRESHOLD') else None
+SLOW_REQUEST_MAX_QUERIES = int(os.getenv('SLOW_REQUEST_MAX_QUERIES', 100))
+
+# Caps of /referral/tree/. With REFERRAL_CLOSURE_TABLE on every activation also maintains the ReferralClosure table,
+# which turns subtree and ancestor lookups into index scans (run rebuild_referral_closure once after turning it on)
+REFERRAL_TREE_MAX_DEPTH = int(os.getenv('REFERRAL_TREE_MAX_DEPTH', 10))
+REFERRAL_TREE_MAX_NODES = int(os.getenv('REFERRAL_TREE_MAX_NODES', 10000))
+REFERRAL_CLOSURE_TABLE = os.getenv('REFERRAL_CLOSURE_TABLE') in ('1', 'true')
+# How many referrers up the chain an activation looks for the activating user, to reject referral cycles
+REFERRAL_CYCLE_CHECK_DEPTH = int(os.getenv('REFERRAL_CYCLE_CHECK_DEPTH', 1000))
+
+# Batch activations of /referral/code/bulk/ and the activate_referrals command: pairs looked up per IN query
+# and rows per UPDATE statement, and the largest batch the endpoint accepts
+REFERRAL_BULK_CHUNK_SIZE = int(os.getenv('REFERRAL_BULK_CHUNK_SIZE', 1000))
+REFERRAL_BULK_MAX_ITEMS = int(os.getenv('REFERRAL_BULK_MAX_ITEMS', 10000))
+
+# Upper bound for the top/days parameters of /referral/stats/
+REFERRAL_STATS_MAX_ROWS = int(os.getenv('REFERRAL_STATS_MAX_ROWS', 365))
 
 
 # Internationalization
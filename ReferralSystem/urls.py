@@ -9,6 +9,8 @@ from drf_yasg.views import get_schema_view
 from drf_yasg import openapi
 from rest_framework import permissions
 
+from referral_system.views import metrics
+
 schema_view = get_schema_view(
     openapi.Info(
         title="Referral System",
@@ -24,4 +26,5 @@ urlpatterns = [
     path("admin/", admin.site.urls),
     path("referral/", include('referral_system.urls')),
     path('redoc/', schema_view.with_ui('redoc', cache_timeout=0), name='schema-redoc'),
+    path('metrics', metrics, name='metrics'),
 ]
@@ -14,3 +14,8 @@ from django.core.wsgi import get_wsgi_application
 os.environ.setdefault("DJANGO_SETTINGS_MODULE", "ReferralSystem.settings")
 
 application = get_wsgi_application()
+
+# after setup, so the index is built from a configured project while the server starts accepting requests
+from referral_system.invite_code_index import warm_up_invite_code_index  # noqa: E402
+
+warm_up_invite_code_index()
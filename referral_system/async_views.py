@@ -0,0 +1,227 @@
+"""
+Async versions of the auth and referral endpoints, meant to be served by an ASGI server (ReferralSystem.asgi).
+They keep the request/response format of the DRF views in views.py, but DRF views are synchronous,
+so these are plain Django async views: database access goes through the async ORM and cache access through
+the async cache API, so a worker is not tied up while waiting for them.
+"""
+import json
+
+from asgiref.sync import sync_to_async
+from django.contrib.auth import alogin
+from django.http import HttpResponse, JsonResponse, QueryDict
+from django.utils.decorators import method_decorator
+from django.views import View
+from django.views.decorators.csrf import csrf_exempt
+from rest_framework.authentication import CSRFCheck, get_authorization_header
+from rest_framework.settings import api_settings
+from rest_framework.throttling import BaseThrottle
+
+from referral_system.code_store import get_code_store
+from referral_system.db_router import apin_to_primary
+from referral_system.invite_code_index import invite_code_may_exist
+from referral_system.models import User
+from referral_system.phone_numbers import astored_phone_number, phone_number_key
+from referral_system.profile_cache import aget_profile
+from referral_system.ratelimit import SlidingWindowRateLimiter
+from referral_system.referrals import ReferralAlreadyActivatedError, ReferralCycleError, activate_referral
+from referral_system.serializers import AddReferralSerializer, UserPhoneCodeSerializer, UserSerializer, \
+    serialize_user_profile
+from referral_system.sms import get_code_delivery
+from referral_system.tokens import ACCESS, TokenError, averify_token, issue_tokens
+
+
+def parse_body(request):
+    """Return the JSON or form encoded request body as a dict-like object, or None if it cannot be parsed."""
+    if request.content_type == 'application/json':
+        try:
+            data = json.loads(request.body or b'{}')
+        except ValueError:
+            return None
+        return data if isinstance(data, dict) else None
+    return QueryDict(request.body, encoding=request.encoding)
+
+
+async def check_throttles(request, scopes):
+    """
+    Count the request against each (scope, key) pair with the rates of the DRF throttles of the same scope.
+    Returns a 429 response if any of the limits is exceeded, otherwise None.
+    """
+    retry_after = 0
+    for scope, key in scopes:
+        if key is None:
+            continue
+        limiter = SlidingWindowRateLimiter(api_settings.DEFAULT_THROTTLE_RATES[scope], prefix=scope)
+        allowed, wait = await limiter.ahit(key)
+        if not allowed:
+            retry_after = max(retry_after, wait)
+    if retry_after:
+        response = JsonResponse({'message': 'Too many requests'}, status=429)
+        response['Retry-After'] = str(int(retry_after) + 1)
+        return response
+    return None
+
+
+async def authenticate(request):
+    """
+    Return the user of a Bearer access token or of the session, or None.
+    Session authenticated requests are CSRF checked the same way DRF's SessionAuthentication does.
+    """
+    auth = get_authorization_header(request).split()
+    if auth and auth[0].lower() == b'bearer':
+        try:
+            payload = await averify_token(auth[1].decode(), ACCESS) if len(auth) == 2 else None
+        except (TokenError, UnicodeError):
+            payload = None
+        if payload is None:
+            return None
+        return await User.objects.filter(pk=payload['uid']).afirst()
+
+    user = await request.auser()
+    if not user.is_authenticated:
+        return None
+    if request.method not in ('GET', 'HEAD', 'OPTIONS') and CSRFCheck(lambda req: None).process_view(
+            request, None, (), {}) is not None:
+        return None
+    return user
+
+
+def unauthorized():
+    response = JsonResponse({'detail': 'Authentication credentials were not provided.'}, status=401)
+    response['WWW-Authenticate'] = 'Bearer'
+    return response
+
+
+@method_decorator(csrf_exempt, name='dispatch')
+class AsyncRequestCode(View):
+    http_method_names = ['post']
+
+    async def post(self, request):
+        data = parse_body(request)
+        if data is None:
+            return JsonResponse({'message': 'Malformed request body'}, status=400)
+        throttled = await check_throttles(request, (('auth_ip', BaseThrottle().get_ident(request)),
+                                                    ('auth_global', 'all')))
+        if throttled:
+            return throttled
+
+        phone_number = data.get('phone_number')
+        if not phone_number:
+            return JsonResponse({'message': 'phone_number is required'}, status=400)
+
+        serializer = UserSerializer(
+            data=data, context={'stored_phone_number': await astored_phone_number(phone_number)})
+        if not serializer.is_valid():
+            return JsonResponse(serializer.errors, status=400)
+        phone_number = serializer.validated_data['phone_number']
+
+        auth_code = await get_code_store().aissue(phone_number)
+        if auth_code is None:
+            return JsonResponse({'message': 'The authentication code was requested less than 30 seconds ago'},
+                                status=400)
+        await get_code_delivery().asend(phone_number, auth_code)
+        return JsonResponse({"message": f"Code is created and sent to {phone_number}",
+                             "code": auth_code}, status=201)
+
+
+@method_decorator(csrf_exempt, name='dispatch')
+class AsyncConfirmCode(View):
+    http_method_names = ['post']
+
+    async def post(self, request):
+        data = parse_body(request)
+        if data is None:
+            return JsonResponse({'message': 'Malformed request body'}, status=400)
+        throttled = await check_throttles(request, (('auth_ip', BaseThrottle().get_ident(request)),
+                                                    ('auth_phone', phone_number_key(data.get('phone_number'))),
+                                                    ('auth_global', 'all')))
+        if throttled:
+            return throttled
+
+        serializer = UserPhoneCodeSerializer(
+            data=data, context={'stored_phone_number': await astored_phone_number(data.get('phone_number'))})
+        if not serializer.is_valid():
+            return JsonResponse(serializer.errors, status=400)
+        phone_number = serializer.validated_data['phone_number']
+        auth_code = serializer.validated_data['code']
+
+        code_store = get_code_store()
+        phone_code = await code_store.aget(phone_number)
+        if phone_code is None:
+            return JsonResponse({"message": "Code not found"}, status=404)
+
+        if phone_code.expired:
+            return JsonResponse({"message": "Code expired"}, status=400)
+
+        if phone_code.code != auth_code:
+            return JsonResponse({"message": "Code invalid"}, status=400)
+
+        created = False
+        try:
+            user = await User.objects.aget(phone_number=phone_number)
+        except User.DoesNotExist:
+            user = await User.objects.acreate_user(phone_number=phone_number)
+            created = True
+        await code_store.adiscard(phone_number)
+        if serializer.validated_data['token']:
+            # token clients are anonymous to ReplicaRoutingMiddleware here, pin the new session explicitly
+            await apin_to_primary(user.pk)
+            return JsonResponse({"message": "User authenticated", "new_user": created, **issue_tokens(user)})
+        await alogin(request, user)
+        return JsonResponse({"message": "User authenticated", "new_user": created})
+
+
+async def aserialize_profile(user):
+    referrals = [phone async for phone in user.referrals.order_by('pk').values_list('phone_number', flat=True)]
+    return serialize_user_profile(user, referrals)
+
+
+@method_decorator(csrf_exempt, name='dispatch')
+class AsyncUserProfile(View):
+    http_method_names = ['get']
+
+    async def get(self, request):
+        user = await authenticate(request)
+        if user is None:
+            return unauthorized()
+        profile, etag = await aget_profile(user, aserialize_profile, request.headers.get('If-None-Match'))
+        if profile is None:
+            response = HttpResponse(status=304)
+        else:
+            response = JsonResponse(profile)
+        response['ETag'] = etag
+        return response
+
+
+@method_decorator(csrf_exempt, name='dispatch')
+class AsyncAddReferral(View):
+    http_method_names = ['patch']
+
+    async def patch(self, request):
+        user = await authenticate(request)
+        if user is None:
+            return unauthorized()
+        data = parse_body(request)
+        if data is None:
+            return JsonResponse({'message': 'Malformed request body'}, status=400)
+        serializer = AddReferralSerializer(data=data)
+        if not serializer.is_valid():
+            return JsonResponse(serializer.errors, status=400)
+
+        if user.activated_code:
+            return JsonResponse({"message": "Referral code already activated"}, status=400)
+        activated_code = serializer.validated_data['activated_code']
+
+        referrer = None
+        # the index is loaded and refreshed from the database, so it is only touched from a worker thread
+        if await sync_to_async(invite_code_may_exist)(activated_code):
+            referrer = await User.objects.filter(invite_code=activated_code).exclude(pk=user.pk).afirst()
+        if referrer is None:
+            return JsonResponse({"message": "Referral code not found"}, status=404)
+        # Django has no async transactions, the activation runs in a worker thread in one transaction
+        try:
+            await sync_to_async(activate_referral)(user, referrer)
+        except ReferralCycleError:
+            return JsonResponse({"message": "Referral code of your own referral"}, status=400)
+        except ReferralAlreadyActivatedError:
+            return JsonResponse({"message": "Referral code already activated"}, status=400)
+        return JsonResponse({"message": "Referral code successfully added"})
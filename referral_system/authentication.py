@@ -0,0 +1,48 @@
+from django.utils.functional import SimpleLazyObject
+from rest_framework import exceptions
+from rest_framework.authentication import BaseAuthentication, get_authorization_header
+
+from referral_system.models import User
+from referral_system.tokens import ACCESS, TokenError, verify_token
+
+
+class TokenUser(SimpleLazyObject):
+    """
+    The user of a verified access token. pk and the authentication flags are known from the token,
+    the User row is only fetched when anything else is accessed.
+    """
+    is_authenticated = True
+    is_anonymous = False
+
+    def __init__(self, user_id):
+        def load_user():
+            try:
+                return User.objects.get(pk=user_id)
+            except User.DoesNotExist:
+                raise exceptions.AuthenticationFailed('User not found')
+
+        super().__init__(load_user)
+        self.__dict__['pk'] = self.__dict__['id'] = user_id
+
+    def __bool__(self):
+        return True
+
+
+class SignedTokenAuthentication(BaseAuthentication):
+    """Authenticates "Authorization: Bearer <access token>" headers without touching the database."""
+    keyword = b'bearer'
+
+    def authenticate(self, request):
+        auth = get_authorization_header(request).split()
+        if not auth or auth[0].lower() != self.keyword:
+            return None
+        if len(auth) != 2:
+            raise exceptions.AuthenticationFailed('Invalid Authorization header')
+        try:
+            payload = verify_token(auth[1].decode(), ACCESS)
+        except (TokenError, UnicodeError) as exc:
+            raise exceptions.AuthenticationFailed(str(exc))
+        return TokenUser(payload['uid']), payload
+
+    def authenticate_header(self, request):
+        return 'Bearer'
@@ -0,0 +1,185 @@
+import threading
+from collections import namedtuple
+from datetime import timedelta
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.cache import caches
+from django.core.signals import setting_changed
+from django.db import connections, router
+from django.dispatch import receiver
+from django.utils import timezone
+from django.utils.module_loading import import_string
+
+from referral_system.models import UserPhoneCode
+
+PhoneCode = namedtuple('PhoneCode', ('code', 'expired'))
+
+
+class BaseCodeStore:
+    """
+    Keeps the authorization code issued to a phone number.
+    A code lives for PHONE_CODE_TTL seconds and a new one can be issued PHONE_CODE_RESEND_INTERVAL seconds
+    after the previous one.
+    """
+
+    def __init__(self):
+        self.ttl = settings.PHONE_CODE_TTL
+        self.resend_interval = settings.PHONE_CODE_RESEND_INTERVAL
+
+    def issue(self, phone_number):
+        """Generate and store a new code. Returns None if the previous code was issued too recently."""
+        raise NotImplementedError
+
+    def get(self, phone_number):
+        """Return the PhoneCode issued to phone_number or None if there is none."""
+        raise NotImplementedError
+
+    def discard(self, phone_number):
+        raise NotImplementedError
+
+    async def aissue(self, phone_number):
+        return await sync_to_async(self.issue)(phone_number)
+
+    async def aget(self, phone_number):
+        return await sync_to_async(self.get)(phone_number)
+
+    async def adiscard(self, phone_number):
+        return await sync_to_async(self.discard)(phone_number)
+
+
+class DatabaseCodeStore(BaseCodeStore):
+    """Stores codes as UserPhoneCode rows, one per phone number."""
+
+    def issue(self, phone_number):
+        """
+        Insert the code or replace the previous one in a single INSERT ... ON CONFLICT DO UPDATE statement.
+        The update only happens when the previous code is older than the resend interval, so concurrent
+        requests for one phone number are serialized by the unique index and at most one of them wins.
+        """
+        connection = connections[router.db_for_write(UserPhoneCode)]
+        ops = connection.ops
+        table = ops.quote_name(UserPhoneCode._meta.db_table)
+        now = timezone.now()
+        auth_code = UserPhoneCode.generate_4xcode()
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f"INSERT INTO {table} (phone_number, code, created_at) VALUES (%s, %s, %s) "
+                f"ON CONFLICT (phone_number) DO UPDATE SET code = EXCLUDED.code, created_at = EXCLUDED.created_at "
+                f"WHERE {table}.created_at < %s "
+                f"RETURNING code",
+                [
+                    phone_number,
+                    auth_code,
+                    ops.adapt_datetimefield_value(now),
+                    ops.adapt_datetimefield_value(now - timedelta(seconds=self.resend_interval)),
+                ],
+            )
+            row = cursor.fetchone()
+        return row[0] if row else None
+
+    def get(self, phone_number):
+        user_phone_code = UserPhoneCode.objects.filter(phone_number=phone_number).first()
+        if user_phone_code is None:
+            return None
+        return PhoneCode(user_phone_code.code, user_phone_code.is_expired())
+
+    def discard(self, phone_number):
+        UserPhoneCode.objects.filter(phone_number=phone_number).delete()
+
+    def purge_expired(self, batch_size=1000, max_batches=None):
+        """
+        Delete expired rows oldest first, batch_size rows per statement.
+        Each batch commits on its own so no lock is held for longer than one small DELETE.
+        """
+        expired = UserPhoneCode.objects.filter(
+            created_at__lt=timezone.now() - timedelta(seconds=self.ttl)
+        ).order_by('created_at')
+        deleted = batches = 0
+        while max_batches is None or batches < max_batches:
+            ids = list(expired.values_list('id', flat=True)[:batch_size])
+            if not ids:
+                break
+            deleted += UserPhoneCode.objects.filter(id__in=ids).delete()[0]
+            batches += 1
+        return deleted
+
+
+class CacheCodeStore(BaseCodeStore):
+    """
+    Stores codes in the PHONE_CODE_CACHE cache, relying on native key expiry for both the code lifetime
+    and the resend window. Expired codes disappear, so they are reported as not found.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.cache = caches[settings.PHONE_CODE_CACHE]
+
+    @staticmethod
+    def code_key(phone_number):
+        return f'phone_code:code:{phone_number}'
+
+    @staticmethod
+    def resend_key(phone_number):
+        return f'phone_code:resend:{phone_number}'
+
+    def issue(self, phone_number):
+        # add() is atomic, so only one of several concurrent requests can open the resend window
+        if not self.cache.add(self.resend_key(phone_number), 1, timeout=self.resend_interval):
+            return None
+        auth_code = UserPhoneCode.generate_4xcode()
+        self.cache.set(self.code_key(phone_number), auth_code, timeout=self.ttl)
+        return auth_code
+
+    def get(self, phone_number):
+        auth_code = self.cache.get(self.code_key(phone_number))
+        if auth_code is None:
+            return None
+        return PhoneCode(auth_code, False)
+
+    def discard(self, phone_number):
+        self.cache.delete_many([self.code_key(phone_number), self.resend_key(phone_number)])
+
+    async def aissue(self, phone_number):
+        if not await self.cache.aadd(self.resend_key(phone_number), 1, timeout=self.resend_interval):
+            return None
+        auth_code = UserPhoneCode.generate_4xcode()
+        await self.cache.aset(self.code_key(phone_number), auth_code, timeout=self.ttl)
+        return auth_code
+
+    async def aget(self, phone_number):
+        auth_code = await self.cache.aget(self.code_key(phone_number))
+        if auth_code is None:
+            return None
+        return PhoneCode(auth_code, False)
+
+    async def adiscard(self, phone_number):
+        await self.cache.adelete_many([self.code_key(phone_number), self.resend_key(phone_number)])
+
+
+_code_store = None
+_code_store_lock = threading.Lock()
+
+
+def get_code_store():
+    """Return the process-wide code store configured by PHONE_CODE_STORE."""
+    global _code_store
+    with _code_store_lock:
+        if _code_store is None:
+            _code_store = import_string(settings.PHONE_CODE_STORE)()
+        return _code_store
+
+
+@receiver(setting_changed)
+def reset_code_store(setting, **kwargs):
+    global _code_store
+    if setting in ('PHONE_CODE_STORE', 'PHONE_CODE_CACHE', 'PHONE_CODE_TTL', 'PHONE_CODE_RESEND_INTERVAL'):
+        _code_store = None
+
+
+def purge_expired_codes(batch_size=1000, max_batches=None):
+    """
+    Scheduler hook (cron, Celery beat, ...) removing abandoned UserPhoneCode rows.
+    Codes kept in the cache expire on their own.
+    """
+    return DatabaseCodeStore().purge_expired(batch_size=batch_size, max_batches=max_batches)
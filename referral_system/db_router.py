@@ -0,0 +1,132 @@
+import random
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction, sync_to_async
+from django.conf import settings
+from django.contrib.auth import SESSION_KEY
+from django.core.cache import caches
+from rest_framework.authentication import get_authorization_header
+
+from referral_system.tokens import ACCESS, TokenError, verify_token
+
+SAFE_METHODS = ('GET', 'HEAD', 'OPTIONS')
+
+_read_alias = ContextVar('referral_system_read_alias', default=None)
+
+
+def _sticky_key(user_id):
+    return f'db:primary:{user_id}'
+
+
+def pin_to_primary(user_id):
+    """Read the user's requests from the primary for REPLICA_STICKY_SECONDS, so they see their own writes."""
+    caches[settings.REPLICA_STICKY_CACHE].set(_sticky_key(user_id), True, timeout=settings.REPLICA_STICKY_SECONDS)
+
+
+async def apin_to_primary(user_id):
+    await caches[settings.REPLICA_STICKY_CACHE].aset(_sticky_key(user_id), True,
+                                                     timeout=settings.REPLICA_STICKY_SECONDS)
+
+
+def is_pinned_to_primary(user_id):
+    return bool(caches[settings.REPLICA_STICKY_CACHE].get(_sticky_key(user_id)))
+
+
+@contextmanager
+def use_replica():
+    """Send the reads inside the block to a random replica, or to the primary if there are no replicas."""
+    token = _read_alias.set(random.choice(settings.DATABASE_REPLICAS) if settings.DATABASE_REPLICAS else None)
+    try:
+        yield _read_alias.get()
+    finally:
+        _read_alias.reset(token)
+
+
+class PrimaryReplicaRouter:
+    """
+    Writes always go to the primary ('default'). Reads go to a replica only inside use_replica(),
+    which ReplicaRoutingMiddleware enters for the views in REPLICA_READ_VIEWS.
+    """
+
+    def db_for_read(self, model, **hints):
+        return _read_alias.get()
+
+    def db_for_write(self, model, **hints):
+        # without an explicit alias Django would write an instance back to the database it was read from
+        return 'default'
+
+    def allow_relation(self, obj1, obj2, **hints):
+        return True
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        # replicas receive the schema through replication
+        return db == 'default'
+
+
+def request_user_id(request):
+    """The user id of a Bearer token or of the session, found without querying the user table."""
+    auth = get_authorization_header(request).split()
+    if auth and auth[0].lower() == b'bearer':
+        try:
+            return verify_token(auth[1].decode(), ACCESS)['uid'] if len(auth) == 2 else None
+        except (TokenError, UnicodeError):
+            return None
+    session = getattr(request, 'session', None)
+    return session.get(SESSION_KEY) if session is not None else None
+
+
+class ReplicaRoutingMiddleware:
+    """
+    Reads of the views in REPLICA_READ_VIEWS (URL names) go to a replica, unless the user has written
+    something in the last REPLICA_STICKY_SECONDS: every successful unsafe request pins its user to the primary.
+    """
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        try:
+            response = self.get_response(request)
+        finally:
+            token = request.__dict__.pop('_read_alias_token', None)
+            if token is not None:
+                _read_alias.reset(token)
+        self.pin_writer(request, response)
+        return response
+
+    async def __acall__(self, request):
+        previous = _read_alias.get()
+        try:
+            response = await self.get_response(request)
+        finally:
+            # process_view ran in sync_to_async, its token belongs to a copy of this context and cannot reset it
+            if request.__dict__.pop('_read_alias_token', None) is not None:
+                _read_alias.set(previous)
+        if request.method not in SAFE_METHODS and response.status_code < 400:
+            # request.user of an async view is lazy and queries the database when evaluated
+            await sync_to_async(self.pin_writer)(request, response)
+        return response
+
+    def pin_writer(self, request, response):
+        if request.method not in SAFE_METHODS and response.status_code < 400:
+            # DRF sets request.user of the underlying HttpRequest once it has authenticated the request
+            user = getattr(request, 'user', None)
+            if user is not None and user.is_authenticated:
+                pin_to_primary(user.pk)
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        if (not settings.DATABASE_REPLICAS or request.method not in SAFE_METHODS
+                or request.resolver_match.url_name not in settings.REPLICA_READ_VIEWS):
+            return None
+        user_id = request_user_id(request)
+        if user_id is None or not is_pinned_to_primary(user_id):
+            request._read_alias_token = _read_alias.set(random.choice(settings.DATABASE_REPLICAS))
+        return None
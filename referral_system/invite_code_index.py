@@ -0,0 +1,316 @@
+"""
+Optional per-process index of the invite codes of all users (INVITE_CODE_INDEX), so that a code that does not exist,
+mistyped or guessed, is rejected without a database query. Codes are packed into 36-bit integers and kept either
+in a sorted array('Q') ('sorted', exact, 8 bytes per code) or in a Bloom filter ('bloom', about 10 bits per code
+at a 1% false positive rate).
+
+The index is built in a background thread, started by warm_up_invite_code_index() from the WSGI and ASGI entry points
+(or by the first lookup), so no request waits for the build; lookups go to the database until it is ready. It is kept
+up to date with the users created and deleted by this process. Users created by other processes are picked up by
+a refresh of the rows above the highest primary key seen, done before a negative answer once the index is older
+than INVITE_CODE_INDEX_REFRESH seconds, so a code issued elsewhere is rejected for at most that long. Deletions by
+other processes are never seen, which only costs a database lookup: a positive answer always means "ask the database".
+"""
+import heapq
+import logging
+import math
+import threading
+import time
+from array import array
+from bisect import bisect_left
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.signals import setting_changed
+from django.db import connections, transaction
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from referral_system.invite_codes import parse_invite_code
+
+logger = logging.getLogger(__name__)
+
+_MASK64 = (1 << 64) - 1
+
+
+class SortedCodeSet:
+    """
+    Exact set of packed codes: a sorted array('Q') searched with bisect, plus small sets of the codes added
+    and removed since the array was built, merged into it once they grow past 1/64 of its size.
+    """
+
+    def __init__(self, values=(), presorted=False):
+        self._values = values if presorted and isinstance(values, array) else array('Q', sorted(values))
+        self._added = set()
+        self._removed = set()
+
+    def __contains__(self, value):
+        if value in self._added:
+            return True
+        if value in self._removed:
+            return False
+        values = self._values
+        index = bisect_left(values, value)
+        return index < len(values) and values[index] == value
+
+    def __len__(self):
+        return len(self._values) + len(self._added) - len(self._removed)
+
+    @property
+    def nbytes(self):
+        return self._values.itemsize * len(self._values)
+
+    def add(self, value):
+        self._removed.discard(value)
+        self._added.add(value)
+        self._compact()
+
+    def discard(self, value):
+        self._added.discard(value)
+        self._removed.add(value)
+        self._compact()
+
+    def _compact(self):
+        if len(self._added) + len(self._removed) <= max(1024, len(self._values) // 64):
+            return
+        removed = self._removed | self._added
+        merged = heapq.merge((value for value in self._values if value not in removed), sorted(self._added))
+        self._values = array('Q', merged)
+        self._added, self._removed = set(), set()
+
+
+def _mix(value):
+    # splitmix64 finalizer, spreads neighbouring sequence numbers over the whole 64-bit range
+    value = (value + 0x9E3779B97F4A7C15) & _MASK64
+    value = ((value ^ (value >> 30)) * 0xBF58476D1CE4E5B9) & _MASK64
+    value = ((value ^ (value >> 27)) * 0x94D049BB133111EB) & _MASK64
+    return value ^ (value >> 31)
+
+
+class BloomFilter:
+    """
+    Approximate set of packed codes sized for capacity values at error_rate false positives, with no false negatives.
+    Values cannot be removed, a deleted code stays a (harmless) false positive.
+    """
+
+    def __init__(self, capacity, error_rate=0.01):
+        self.capacity = max(capacity, 1)
+        self.size = max(64, math.ceil(-self.capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hashes = max(1, round(self.size / self.capacity * math.log(2)))
+        self.count = 0
+        self._bits = bytearray((self.size + 7) // 8)
+
+    def _positions(self, value):
+        # double hashing: the two halves of one 64-bit hash give all the probe positions
+        hashed = _mix(value)
+        first, step = hashed & 0xFFFFFFFF, (hashed >> 32) | 1
+        return [(first + i * step) % self.size for i in range(self.hashes)]
+
+    def __contains__(self, value):
+        hashed = _mix(value)
+        position, step, size, bits = hashed & 0xFFFFFFFF, (hashed >> 32) | 1, self.size, self._bits
+        # most absent values stop at the first or second probe
+        for _ in range(self.hashes):
+            position %= size
+            if not bits[position >> 3] & (1 << (position & 7)):
+                return False
+            position += step
+        return True
+
+    def __len__(self):
+        return self.count
+
+    @property
+    def nbytes(self):
+        return len(self._bits)
+
+    @property
+    def full(self):
+        return self.count > self.capacity
+
+    def add(self, value):
+        bits = self._bits
+        for position in self._positions(value):
+            bits[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+    def discard(self, value):
+        pass
+
+
+class InviteCodeIndex:
+    """The invite codes of all users in a SortedCodeSet or a BloomFilter, see the module docstring."""
+
+    def __init__(self, kind='sorted', error_rate=0.01, refresh_interval=1.0, chunk_size=20000):
+        if kind not in ('sorted', 'bloom'):
+            raise ValueError(f'Unknown invite code index: {kind}')
+        self.kind = kind
+        self.error_rate = error_rate
+        self.refresh_interval = refresh_interval
+        self.chunk_size = chunk_size
+        self.codes = None
+        self._lock = threading.Lock()
+        self._loader = None
+        self._max_pk = 0
+        self._previous_max_pk = 0
+        self._refreshed_at = 0.0
+
+    def _rows(self, min_pk=None):
+        """Yield (pk, packed invite code) of the users above min_pk."""
+        users = get_user_model().objects.order_by()
+        if min_pk is not None:
+            users = users.filter(pk__gt=min_pk)
+        for pk, code in users.values_list('pk', 'invite_code').iterator(chunk_size=self.chunk_size):
+            value = parse_invite_code(code)
+            if value is not None:
+                yield pk, value
+
+    def load(self, force=False):
+        """Build the index from the users table, one pass over (pk, invite_code). Rebuild it with force."""
+        with self._lock:
+            if self.codes is not None and not force:
+                return
+            max_pk = 0
+            if self.kind == 'sorted':
+                values = array('Q')
+                for pk, value in self._rows():
+                    values.append(value)
+                    max_pk = max(max_pk, pk)
+                codes = SortedCodeSet(values)
+            else:
+                # headroom for the users created until the filter is rebuilt
+                codes = BloomFilter(2 * get_user_model().objects.count() + 1024, self.error_rate)
+                for pk, value in self._rows():
+                    codes.add(value)
+                    max_pk = max(max_pk, pk)
+            self.codes = codes
+            self._max_pk = self._previous_max_pk = max_pk
+            self._refreshed_at = time.monotonic()
+
+    def load_in_background(self, force=False):
+        """Start building the index in a daemon thread, once. Lookups go to the database until it is built."""
+        with self._lock:
+            if (self.codes is not None and not force) or self._loader is not None:
+                return
+            self._loader = threading.Thread(target=self._load_and_close, args=(force,), name='invite-code-index',
+                                            daemon=True)
+        self._loader.start()
+
+    def _load_and_close(self, force=False):
+        try:
+            self.load(force)
+        except Exception:
+            logger.exception('Building the invite code index failed')
+        finally:
+            self._loader = None
+            # the thread got its own database connection
+            connections.close_all()
+
+    def _stale(self):
+        return time.monotonic() - self._refreshed_at >= self.refresh_interval
+
+    def refresh(self):
+        """Add the users created by other processes since the previous refresh."""
+        with self._lock:
+            # another request may have refreshed while this one waited for the lock
+            if self.codes is None or not self._stale():
+                return
+            # primary keys are not committed in order, so every refresh also covers the range of the previous one
+            min_pk, max_pk = self._previous_max_pk, self._max_pk
+            for pk, value in self._rows(min_pk):
+                self.codes.add(value)
+                max_pk = max(max_pk, pk)
+            self._previous_max_pk, self._max_pk = self._max_pk, max_pk
+            self._refreshed_at = time.monotonic()
+        if self.kind == 'bloom' and self.codes.full:
+            # the full filter stays in use, only with more false positives, until the new one is built
+            self.load_in_background(force=True)
+
+    def may_exist(self, code):
+        """
+        False if no user has this invite code, True if one may have it and the database has to be asked.
+        A miss is final once the index has been refreshed within the last refresh_interval seconds.
+        """
+        value = parse_invite_code(code)
+        if value is None:
+            return False
+        if self.codes is None:
+            self.load_in_background()
+            return True
+        if value in self.codes:
+            return True
+        if not self._stale():
+            return False
+        self.refresh()
+        return value in self.codes
+
+    def add(self, code):
+        value = parse_invite_code(code)
+        if self.codes is None or value is None:
+            return
+        with self._lock:
+            self.codes.add(value)
+
+    def discard(self, code):
+        value = parse_invite_code(code)
+        if self.codes is None or value is None:
+            return
+        with self._lock:
+            self.codes.discard(value)
+
+
+_invite_code_index = None
+_invite_code_index_lock = threading.Lock()
+
+
+def get_invite_code_index():
+    """Return the process-wide invite code index, or None if INVITE_CODE_INDEX is off."""
+    global _invite_code_index
+    if not settings.INVITE_CODE_INDEX:
+        return None
+    with _invite_code_index_lock:
+        if _invite_code_index is None:
+            _invite_code_index = InviteCodeIndex(settings.INVITE_CODE_INDEX,
+                                                 error_rate=settings.INVITE_CODE_INDEX_ERROR_RATE,
+                                                 refresh_interval=settings.INVITE_CODE_INDEX_REFRESH)
+        return _invite_code_index
+
+
+def warm_up_invite_code_index():
+    """Start building the invite code index in the background if INVITE_CODE_INDEX is on. Called at startup."""
+    index = get_invite_code_index()
+    if index is not None:
+        index.load_in_background()
+
+
+def invite_code_may_exist(code):
+    """
+    False if no user can have this invite code: malformed codes always, and codes missing from the refreshed index
+    when INVITE_CODE_INDEX is on. True means the database has to be asked.
+    """
+    index = get_invite_code_index()
+    if index is None:
+        return parse_invite_code(code) is not None
+    return index.may_exist(code)
+
+
+@receiver(setting_changed)
+def reset_invite_code_index(setting, **kwargs):
+    global _invite_code_index
+    if setting in ('INVITE_CODE_INDEX', 'INVITE_CODE_INDEX_ERROR_RATE', 'INVITE_CODE_INDEX_REFRESH'):
+        _invite_code_index = None
+
+
+@receiver(post_save, sender=settings.AUTH_USER_MODEL)
+def index_created_user(sender, instance, created, **kwargs):
+    # a code of a rolled back user stays in the index, which only costs a database lookup
+    if created and _invite_code_index is not None:
+        _invite_code_index.add(instance.invite_code)
+
+
+@receiver(post_delete, sender=settings.AUTH_USER_MODEL)
+def unindex_deleted_user(sender, instance, **kwargs):
+    # removed only after commit, a rolled back delete must not leave the code missing
+    index = _invite_code_index
+    if index is not None:
+        transaction.on_commit(lambda: index.discard(instance.invite_code))
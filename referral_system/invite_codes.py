@@ -0,0 +1,110 @@
+import string
+import threading
+
+from django.db import transaction
+
+INVITE_CODE_ALPHABET = string.ascii_letters + string.digits
+INVITE_CODE_LENGTH = 6
+INVITE_CODE_SPACE = len(INVITE_CODE_ALPHABET) ** INVITE_CODE_LENGTH
+
+# 62 ** 6 < 2 ** 36, so a balanced Feistel network over 36 bits plus cycle walking
+# gives a bijection of [0, INVITE_CODE_SPACE) onto itself
+_HALF_BITS = 18
+_HALF_MASK = (1 << _HALF_BITS) - 1
+# Changing the keys changes which code every sequence number maps to, never change them on a live database
+_ROUND_KEYS = (0x1F3A7, 0x2B6C1, 0x0D94E, 0x3C259)
+
+
+def invite_code_to_int(code):
+    """Pack a 6-character invite code into an integer below INVITE_CODE_SPACE."""
+    value = 0
+    for char in code:
+        value = value * len(INVITE_CODE_ALPHABET) + INVITE_CODE_ALPHABET.index(char)
+    return value
+
+
+_CHAR_VALUES = {char: value for value, char in enumerate(INVITE_CODE_ALPHABET)}
+
+
+def parse_invite_code(code):
+    """invite_code_to_int() for untrusted input: None for anything that cannot be an invite code."""
+    if not isinstance(code, str) or len(code) != INVITE_CODE_LENGTH:
+        return None
+    value = 0
+    for char in code:
+        char_value = _CHAR_VALUES.get(char)
+        if char_value is None:
+            return None
+        value = value * len(INVITE_CODE_ALPHABET) + char_value
+    return value
+
+
+def int_to_invite_code(value):
+    chars = []
+    for _ in range(INVITE_CODE_LENGTH):
+        value, index = divmod(value, len(INVITE_CODE_ALPHABET))
+        chars.append(INVITE_CODE_ALPHABET[index])
+    return ''.join(reversed(chars))
+
+
+def _round(value, key):
+    value = ((value ^ key) * 0x9E3779B1) & 0xFFFFFFFF
+    return (value ^ (value >> 15)) & _HALF_MASK
+
+
+def _feistel(value):
+    left, right = value >> _HALF_BITS, value & _HALF_MASK
+    for key in _ROUND_KEYS:
+        left, right = right, left ^ _round(right, key)
+    return (left << _HALF_BITS) | right
+
+
+def sequence_to_invite_code(number):
+    """
+    Map a sequence number to an invite code. Distinct numbers always give distinct codes,
+    while consecutive numbers give unrelated-looking codes.
+    """
+    if not 0 <= number < INVITE_CODE_SPACE:
+        raise ValueError(f"Invite code sequence exhausted: {number}")
+    value = _feistel(number)
+    while value >= INVITE_CODE_SPACE:
+        value = _feistel(value)
+    return int_to_invite_code(value)
+
+
+class InviteCodeAllocator:
+    """
+    Hands out invite codes from blocks of sequence numbers reserved in InviteCodeCounter,
+    so only one signup in block_size pays for a round trip to the counter row.
+    """
+
+    def __init__(self, counter_model, block_size):
+        self.counter_model = counter_model
+        self.block_size = block_size
+        self._lock = threading.Lock()
+        self._blocks = {}
+
+    def reserve(self, count, using=None):
+        """
+        Atomically reserve count sequence numbers and return them as a range.
+        Numbers reserved inside a transaction that is rolled back can be handed out twice,
+        callers must still treat a unique violation on invite_code as "try the next code".
+        """
+        with transaction.atomic(using=using):
+            counter, _ = self.counter_model.objects.using(using).select_for_update().get_or_create(pk=1)
+            start = counter.value
+            counter.value = start + count
+            counter.save(using=using, update_fields=['value'])
+        return range(start, start + count)
+
+    def reserve_codes(self, count, using=None):
+        return [sequence_to_invite_code(number) for number in self.reserve(count, using=using)]
+
+    def next_code(self, using=None):
+        with self._lock:
+            number = next(self._blocks.get(using, iter(())), None)
+            if number is None:
+                block = iter(self.reserve(self.block_size, using=using))
+                self._blocks[using] = block
+                number = next(block)
+        return sequence_to_invite_code(number)
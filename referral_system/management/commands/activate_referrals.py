@@ -0,0 +1,53 @@
+import json
+import sys
+import time
+from collections import Counter
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from referral_system.management.commands.import_users import detect_format, read_rows, text_field
+from referral_system.referrals import activate_referrals_in_bulk
+
+
+class Command(BaseCommand):
+    help = ("Activate referral codes for a batch of users from a CSV (phone_number,activated_code header) "
+            "or NDJSON file, all in one transaction. Prints a JSON summary of the results")
+
+    def add_arguments(self, parser):
+        parser.add_argument("path", help="File with the pairs, - for stdin")
+        parser.add_argument("--format", choices=("csv", "ndjson"), help="Taken from the file extension by default")
+        parser.add_argument("--chunk-size", type=int, default=settings.REFERRAL_BULK_CHUNK_SIZE,
+                            help="Pairs looked up per query")
+        parser.add_argument("--results", action="store_true",
+                            help="Print the result of every pair as a JSON line before the summary")
+
+    def handle(self, *args, **options):
+        path = options["path"]
+        fmt = detect_format(path, options["format"]) if path != "-" else options["format"] or "csv"
+        stream = sys.stdin if path == "-" else open(path, newline="", encoding="utf-8")
+        pairs = []
+        try:
+            for line, row in read_rows(stream, fmt):
+                pair = (text_field(row, "phone_number"), text_field(row, "activated_code")) if row is not None else None
+                # nothing is written yet, the whole file is rejected rather than activated in part
+                if pair is None or None in pair:
+                    raise CommandError(f"line {line}: malformed row")
+                pairs.append(pair)
+        finally:
+            if stream is not sys.stdin:
+                stream.close()
+
+        started = time.perf_counter()
+        statuses = activate_referrals_in_bulk(pairs, chunk_size=options["chunk_size"])
+        elapsed = time.perf_counter() - started
+
+        if options["results"]:
+            for (phone_number, activated_code), status in zip(pairs, statuses):
+                self.stdout.write(json.dumps(
+                    {"phone_number": phone_number, "activated_code": activated_code, "status": status}))
+        self.stdout.write(json.dumps({
+            "pairs": len(pairs),
+            **Counter(statuses),
+            "seconds": round(elapsed, 3),
+        }))
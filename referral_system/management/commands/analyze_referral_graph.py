@@ -0,0 +1,22 @@
+import json
+
+from django.core.management.base import BaseCommand
+
+from referral_system.referral_graph import analyze_referral_graph
+
+
+class Command(BaseCommand):
+    help = ("Find suspicious clusters in the referral graph: referral cycles and large groups of accounts "
+            "activated in a burst. Prints one JSON line per cluster, largest first")
+
+    def add_arguments(self, parser):
+        parser.add_argument("--min-size", type=int, default=50, help="Smallest cluster checked for bursts")
+        parser.add_argument("--min-per-hour", type=float, default=100.0,
+                            help="Average activations per hour from which a cluster is reported")
+        parser.add_argument("--chunk-size", type=int, default=10000, help="Rows fetched per round trip")
+
+    def handle(self, *args, **options):
+        clusters = analyze_referral_graph(min_size=options["min_size"], min_per_hour=options["min_per_hour"],
+                                          chunk_size=options["chunk_size"])
+        for cluster in clusters:
+            self.stdout.write(json.dumps(cluster))
@@ -0,0 +1,220 @@
+import json
+import random
+import statistics
+import time
+from collections import Counter
+from urllib.parse import parse_qs, urlsplit
+
+import requests
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test import Client, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+
+from referral_system.management.commands.benchmark_signup import PHONE_PREFIX, benchmark_phone_number
+from referral_system.models import User, UserPhoneCode, invite_code_allocator
+from referral_system.tokens import issue_tokens
+
+ENDPOINTS = ("auth", "confirm", "profile", "code", "users", "delete")
+
+
+class TestClientTransport:
+    """Calls the views in-process through the Django test client, so queries per request can be counted."""
+    counts_queries = True
+
+    def __init__(self):
+        self.client = Client()
+
+    def request(self, method, url, data=None, token=None):
+        headers = {"Authorization": f"Bearer {token}"} if token else {}
+        with CaptureQueriesContext(connection) as queries:
+            response = getattr(self.client, method)(url, data, content_type="application/json", headers=headers)
+        return response.status_code, len(queries), response.json() if response.content else None
+
+
+class LiveServerTransport:
+    """Calls an already running server, e.g. `runserver` or gunicorn/uvicorn against the same database."""
+    counts_queries = False
+
+    def __init__(self, base_url):
+        self.base_url = base_url.rstrip("/")
+        self.session = requests.Session()
+
+    def request(self, method, url, data=None, token=None):
+        headers = {"Authorization": f"Bearer {token}"} if token else {}
+        if method == "get":
+            response = self.session.get(self.base_url + url, params=data, headers=headers)
+        else:
+            response = self.session.request(method, self.base_url + url, json=data, headers=headers)
+        return response.status_code, None, response.json() if response.content else None
+
+
+def percentile(sorted_values, percent):
+    if len(sorted_values) < 2:
+        return sorted_values[0] if sorted_values else None
+    return statistics.quantiles(sorted_values, n=100, method="inclusive")[percent - 1]
+
+
+class Command(BaseCommand):
+    help = ("Seed benchmark users with a heavy-tailed referral fan-out and measure latency percentiles, "
+            "requests per second and queries per request of the API endpoints. "
+            "Prints one JSON line per endpoint. Benchmark users are removed afterwards")
+
+    def add_arguments(self, parser):
+        parser.add_argument("--users", type=int, default=10_000, help="Users to seed before the measurements")
+        parser.add_argument("--requests", type=int, default=200, help="Timed requests per endpoint")
+        parser.add_argument("--endpoints", nargs="+", choices=ENDPOINTS, default=list(ENDPOINTS))
+        parser.add_argument("--referrer-share", type=float, default=0.2,
+                            help="Share of the seeded users that invite others")
+        parser.add_argument("--referred-share", type=float, default=0.6,
+                            help="Share of the remaining users that activated an invite code")
+        parser.add_argument("--fanout-alpha", type=float, default=1.2,
+                            help="Pareto shape of the referrals per referrer, smaller means a heavier tail")
+        parser.add_argument("--base-url", help="Benchmark a running server instead of the in-process test client. "
+                                               "Queries per request are not reported then")
+        parser.add_argument("--seed", type=int, default=0, help="Random seed, for comparable runs")
+        parser.add_argument("--batch-size", type=int, default=1000, help="Batch size used to seed users")
+        parser.add_argument("--keep", action="store_true", help="Do not delete the benchmark users at the end")
+
+    def handle(self, *args, **options):
+        if User.objects.filter(phone_number__startswith=PHONE_PREFIX).exists():
+            raise CommandError(f"Benchmark users ({PHONE_PREFIX}...) already exist, remove them first")
+        self.random = random.Random(options["seed"])
+        self.requests = options["requests"]
+        # the benchmark measures the views, not the rate limits protecting them
+        rest_framework = {**settings.REST_FRAMEWORK, "DEFAULT_THROTTLE_RATES": {
+            scope: "1000000/s" for scope in settings.REST_FRAMEWORK["DEFAULT_THROTTLE_RATES"]}}
+        try:
+            with override_settings(ALLOWED_HOSTS=["testserver"], REST_FRAMEWORK=rest_framework):
+                self.seed_users(options)
+                self.transport = (LiveServerTransport(options["base_url"]) if options["base_url"]
+                                  else TestClientTransport())
+                for endpoint in options["endpoints"]:
+                    result = getattr(self, f"bench_{endpoint}")()
+                    self.stdout.write(json.dumps({"endpoint": endpoint, **result}))
+        finally:
+            if not options["keep"]:
+                User.objects.filter(phone_number__startswith=PHONE_PREFIX).delete()
+                UserPhoneCode.objects.filter(phone_number__startswith=PHONE_PREFIX).delete()
+
+    def seed_users(self, options):
+        """
+        Create the users, then let the referred ones pick their referrer with Pareto distributed weights:
+        most referrers have a few referrals and a handful have a large share of all of them.
+        """
+        users, batch_size = options["users"], options["batch_size"]
+        for start in range(0, users, batch_size):
+            size = min(batch_size, users - start)
+            User.objects.bulk_create(
+                User(phone_number=benchmark_phone_number(start + i), invite_code=code, password="!")
+                for i, code in enumerate(invite_code_allocator.reserve_codes(size))
+            )
+        self.next_number = users
+
+        seeded = list(User.objects.filter(phone_number__startswith=PHONE_PREFIX).order_by("pk")
+                      .only("pk", "invite_code"))
+        referrers = seeded[:max(1, int(len(seeded) * options["referrer_share"]))]
+        candidates = seeded[len(referrers):]
+        referred = self.random.sample(candidates, int(len(candidates) * options["referred_share"]))
+        weights = [self.random.paretovariate(options["fanout_alpha"]) for _ in referrers]
+        now = timezone.now()
+        for user, referrer in zip(referred, self.random.choices(referrers, weights, k=len(referred))):
+            user.referred_by, user.activated_code, user.activated_at = referrer, referrer.invite_code, now
+        User.objects.bulk_update(referred, ["referred_by", "activated_code", "activated_at"],
+                                 batch_size=batch_size)
+        counts = Counter(user.referred_by_id for user in referred)
+        for referrer in referrers:
+            referrer.referral_count = counts[referrer.pk]
+        User.objects.bulk_update(referrers, ["referral_count"], batch_size=batch_size)
+
+        self.seeded = seeded
+        self.unreferred = [user for user in candidates if user.referred_by_id is None]
+        self.referrers = referrers
+        self.stdout.write(json.dumps({
+            "seeded_users": len(seeded),
+            "referred_users": len(referred),
+            "max_referrals": max(counts.values(), default=0),
+        }))
+
+    def fresh_phone_numbers(self):
+        first, self.next_number = self.next_number, self.next_number + self.requests
+        return [benchmark_phone_number(number) for number in range(first, self.next_number)]
+
+    def timed_request(self, samples, method, url, data=None, token=None):
+        started = time.perf_counter()
+        status, query_count, body = self.transport.request(method, url, data, token)
+        samples.append(((time.perf_counter() - started) * 1000, query_count, status))
+        return body
+
+    def summarize(self, samples, elapsed):
+        latencies = sorted(latency for latency, _, _ in samples)
+        return {
+            "requests": len(samples),
+            "errors": sum(status >= 400 for _, _, status in samples),
+            "rps": round(len(samples) / elapsed, 1) if elapsed else None,
+            "p50_ms": round(percentile(latencies, 50), 2) if latencies else None,
+            "p95_ms": round(percentile(latencies, 95), 2) if latencies else None,
+            "p99_ms": round(percentile(latencies, 99), 2) if latencies else None,
+            "queries_per_request": (round(sum(queries for _, queries, _ in samples) / len(samples), 2)
+                                    if self.transport.counts_queries and samples else None),
+        }
+
+    def measure(self, calls):
+        """Run (method, url, data, token) calls one after another. Returns the summary and the response bodies."""
+        samples = []
+        started = time.perf_counter()
+        bodies = [self.timed_request(samples, *call) for call in calls]
+        return self.summarize(samples, time.perf_counter() - started), bodies
+
+    def request_codes(self, phone_numbers):
+        return self.measure(("post", reverse("first_auth"), {"phone_number": phone_number}, None)
+                            for phone_number in phone_numbers)
+
+    def bench_auth(self):
+        return self.request_codes(self.fresh_phone_numbers())[0]
+
+    def bench_confirm(self):
+        phone_numbers = self.fresh_phone_numbers()
+        _, bodies = self.request_codes(phone_numbers)
+        summary, _ = self.measure(
+            ("post", reverse("confirm_code"), {"phone_number": phone_number, "code": body["code"], "token": True}, None)
+            for phone_number, body in zip(phone_numbers, bodies)
+        )
+        return summary
+
+    def bench_profile(self):
+        # weighted towards referrers, whose profiles are the expensive ones
+        users = self.random.choices(self.referrers + self.seeded, k=self.requests)
+        return self.measure(("get", reverse("profile"), None, issue_tokens(user)["access"]) for user in users)[0]
+
+    def bench_code(self):
+        users = self.random.sample(self.unreferred, min(self.requests, len(self.unreferred)))
+        return self.measure(
+            ("patch", reverse("referral"), {"activated_code": self.random.choice(self.referrers).invite_code},
+             issue_tokens(user)["access"])
+            for user in users
+        )[0]
+
+    def bench_users(self):
+        # walk the pages in order, every page follows the cursor of the previous one
+        samples, cursor = [], None
+        started = time.perf_counter()
+        for _ in range(self.requests):
+            body = self.timed_request(samples, "get", reverse("all_users"), {"cursor": cursor} if cursor else None)
+            next_page = body and body.get("next")
+            cursor = parse_qs(urlsplit(next_page).query)["cursor"][0] if next_page else None
+        return self.summarize(samples, time.perf_counter() - started)
+
+    def bench_delete(self):
+        # new users without referrals, the synchronous deletion path
+        phone_numbers = self.fresh_phone_numbers()
+        User.objects.bulk_create(
+            User(phone_number=phone_number, invite_code=code, password="!")
+            for phone_number, code in zip(phone_numbers, invite_code_allocator.reserve_codes(len(phone_numbers)))
+        )
+        users = User.objects.filter(phone_number__in=phone_numbers)
+        return self.measure(("delete", reverse("delete_user"), None, issue_tokens(user)["access"])
+                            for user in users)[0]
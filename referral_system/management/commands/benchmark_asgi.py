@@ -0,0 +1,95 @@
+import asyncio
+import json
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from asgiref.sync import ThreadSensitiveContext, sync_to_async
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import connections
+from django.test import AsyncClient, Client, override_settings
+from django.urls import reverse
+
+from referral_system.management.commands.benchmark_signup import PHONE_PREFIX, benchmark_phone_number
+from referral_system.models import User, UserPhoneCode
+
+
+def sign_in_wsgi(phone_number):
+    client = Client()
+    response = client.post(reverse("first_auth"), {"phone_number": phone_number})
+    if response.status_code != 201:
+        return False
+    response = client.post(reverse("confirm_code"), {"phone_number": phone_number, "code": response.json()["code"]})
+    return response.status_code == 200
+
+
+async def sign_in_asgi(phone_number):
+    client = AsyncClient()
+    response = await client.post(reverse("async_first_auth"), {"phone_number": phone_number},
+                                 content_type="application/json")
+    if response.status_code != 201:
+        return False
+    response = await client.post(reverse("async_confirm_code"),
+                                 {"phone_number": phone_number, "code": response.json()["code"]},
+                                 content_type="application/json")
+    return response.status_code == 200
+
+
+class Command(BaseCommand):
+    help = ("Compare the sign in flow (request a code, confirm it) served by the WSGI handler with the DRF views "
+            "and by the ASGI handler with the async views, at the same concurrency. "
+            "Creates benchmark users in the configured database and removes them afterwards")
+
+    def add_arguments(self, parser):
+        parser.add_argument("--sign-ins", type=int, default=500, help="Sign ins per handler")
+        parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 10, 50],
+                            help="Concurrent clients: threads for WSGI, tasks for ASGI")
+        parser.add_argument("--keep", action="store_true", help="Do not delete the benchmark users at the end")
+
+    def handle(self, *args, **options):
+        # the benchmark measures the views, not the rate limits protecting them
+        rest_framework = {**settings.REST_FRAMEWORK, "DEFAULT_THROTTLE_RATES": {
+            scope: "1000000/s" for scope in settings.REST_FRAMEWORK["DEFAULT_THROTTLE_RATES"]}}
+        next_number = 0
+        try:
+            with override_settings(ALLOWED_HOSTS=["testserver"], REST_FRAMEWORK=rest_framework):
+                for concurrency in options["concurrency"]:
+                    for handler, run in (("wsgi", self.run_wsgi), ("asgi", self.run_asgi)):
+                        phone_numbers = [benchmark_phone_number(number)
+                                         for number in range(next_number, next_number + options["sign_ins"])]
+                        next_number += options["sign_ins"]
+                        started = time.perf_counter()
+                        succeeded = run(phone_numbers, concurrency)
+                        elapsed = time.perf_counter() - started
+                        self.stdout.write(json.dumps({
+                            "handler": handler,
+                            "concurrency": concurrency,
+                            "sign_ins": len(phone_numbers),
+                            "failed": len(phone_numbers) - succeeded,
+                            "sign_ins_per_second": round(len(phone_numbers) / elapsed, 1),
+                        }))
+        finally:
+            if not options["keep"]:
+                User.objects.filter(phone_number__startswith=PHONE_PREFIX).delete()
+                UserPhoneCode.objects.filter(phone_number__startswith=PHONE_PREFIX).delete()
+
+    def run_wsgi(self, phone_numbers, concurrency):
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            return sum(executor.map(sign_in_wsgi, phone_numbers))
+
+    def run_asgi(self, phone_numbers, concurrency):
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def sign_in(phone_number):
+            # like ASGIHandler does per request: without a context of its own, the ORM calls of every task
+            # would share one thread and the tasks would run one after another
+            async with semaphore, ThreadSensitiveContext():
+                try:
+                    return await sign_in_asgi(phone_number)
+                finally:
+                    await sync_to_async(connections.close_all)()
+
+        async def run():
+            return sum(await asyncio.gather(*(sign_in(phone_number) for phone_number in phone_numbers)))
+
+        return asyncio.run(run())
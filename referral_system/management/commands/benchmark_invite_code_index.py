@@ -0,0 +1,84 @@
+import json
+import random
+import time
+from array import array
+
+from django.core.management.base import BaseCommand
+
+from referral_system.invite_code_index import BloomFilter, SortedCodeSet
+from referral_system.invite_codes import INVITE_CODE_SPACE, int_to_invite_code, parse_invite_code
+from referral_system.models import User
+
+
+def synthetic_codes(count, seed):
+    """count distinct packed codes spread uniformly over the code space, generated already sorted."""
+    rng = random.Random(seed)
+    step = INVITE_CODE_SPACE // count
+    return array("Q", (i * step + rng.randrange(step) for i in range(count)))
+
+
+def per_lookup_ns(index, codes):
+    started = time.perf_counter()
+    for code in codes:
+        value = parse_invite_code(code)
+        if value is not None:
+            value in index
+    return round((time.perf_counter() - started) / len(codes) * 1e9)
+
+
+class Command(BaseCommand):
+    help = ("Measure the memory, build time and lookup latency of the invite code index (sorted array and Bloom "
+            "filter) over synthetic codes, against an indexed database lookup. Prints one JSON line per structure")
+
+    def add_arguments(self, parser):
+        parser.add_argument("--codes", type=int, default=10_000_000, help="Number of codes in the index")
+        parser.add_argument("--lookups", type=int, default=100_000, help="Lookups of each kind")
+        parser.add_argument("--kinds", nargs="+", choices=("sorted", "bloom"), default=["sorted", "bloom"])
+        parser.add_argument("--error-rate", type=float, default=0.01, help="Bloom filter false positive rate")
+        parser.add_argument("--db-lookups", type=int, default=1000,
+                            help="Lookups against the users table for comparison, 0 to skip")
+        parser.add_argument("--seed", type=int, default=0)
+
+    def handle(self, *args, **options):
+        rng = random.Random(options["seed"])
+        values = synthetic_codes(options["codes"], options["seed"])
+        present = [int_to_invite_code(values[rng.randrange(len(values))]) for _ in range(options["lookups"])]
+        # odd offsets from a present code, almost never a code themselves
+        absent = [int_to_invite_code((values[rng.randrange(len(values))] + 1) % INVITE_CODE_SPACE)
+                  for _ in range(options["lookups"])]
+        malformed = [code[:5] + "-" for code in absent]
+
+        for kind in options["kinds"]:
+            started = time.perf_counter()
+            if kind == "sorted":
+                index = SortedCodeSet(array("Q", values), presorted=True)
+            else:
+                index = BloomFilter(len(values), options["error_rate"])
+                for value in values:
+                    index.add(value)
+            build_seconds = time.perf_counter() - started
+
+            false_positives = sum(parse_invite_code(code) in index for code in absent)
+            self.stdout.write(json.dumps({
+                "kind": kind,
+                "codes": len(values),
+                "bytes": index.nbytes,
+                "bytes_per_code": round(index.nbytes / len(values), 2),
+                "build_seconds": round(build_seconds, 3),
+                "hit_ns": per_lookup_ns(index, present),
+                "miss_ns": per_lookup_ns(index, absent),
+                "malformed_ns": per_lookup_ns(index, malformed),
+                "false_positive_rate": round(false_positives / len(absent), 4),
+            }))
+            del index
+
+        if options["db_lookups"]:
+            codes = absent[:options["db_lookups"]]
+            started = time.perf_counter()
+            for code in codes:
+                User.objects.filter(invite_code=code).exists()
+            self.stdout.write(json.dumps({
+                "kind": "database",
+                "codes": User.objects.count(),
+                "miss_ns": round((time.perf_counter() - started) / len(codes) * 1e9),
+            }))
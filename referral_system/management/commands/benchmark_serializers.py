@@ -0,0 +1,76 @@
+import json
+import random
+import time
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+from rest_framework.renderers import JSONRenderer
+
+from referral_system.management.commands.benchmark_signup import PHONE_PREFIX, benchmark_phone_number
+from referral_system.models import User, invite_code_allocator
+from referral_system.renderers import MessagePackRenderer, ORJSONRenderer, msgpack, orjson
+from referral_system.serializers import PROFILE_FIELDS, UserProfileSerializer, serialize_profile_rows
+
+
+class Command(BaseCommand):
+    help = ("Compare the profile list serializers (ModelSerializer over instances against .values() rows with plain "
+            "functions) and the JSON, orjson and MessagePack renderers. Times are reported per 10k users, "
+            "best of --repeat runs. Benchmark users are created in the configured database and removed afterwards")
+
+    def add_arguments(self, parser):
+        parser.add_argument("--users", type=int, default=10_000)
+        parser.add_argument("--referred-share", type=float, default=0.5, help="Share of users with a referrer")
+        parser.add_argument("--repeat", type=int, default=5)
+        parser.add_argument("--seed", type=int, default=0)
+
+    def handle(self, *args, **options):
+        self.repeat = options["repeat"]
+        self.per_10k = 10_000 / options["users"]
+        try:
+            self.seed_users(options["users"], options["referred_share"], random.Random(options["seed"]))
+            self.run()
+        finally:
+            User.objects.filter(phone_number__startswith=PHONE_PREFIX).delete()
+
+    def seed_users(self, count, referred_share, rng):
+        users = [User(phone_number=benchmark_phone_number(i), invite_code=code, password="!")
+                 for i, code in enumerate(invite_code_allocator.reserve_codes(count))]
+        User.objects.bulk_create(users, batch_size=5000)
+        users = list(User.objects.filter(phone_number__startswith=PHONE_PREFIX).only("pk", "invite_code"))
+        referrers = users[:max(1, count // 10)]
+        referred = rng.sample(users[len(referrers):], int((count - len(referrers)) * referred_share))
+        now = timezone.now()
+        for user in referred:
+            referrer = rng.choice(referrers)
+            user.referred_by, user.activated_code, user.activated_at = referrer, referrer.invite_code, now
+        User.objects.bulk_update(referred, ["referred_by", "activated_code", "activated_at"], batch_size=5000)
+
+    def timed(self, func):
+        best, result = None, None
+        for _ in range(self.repeat):
+            started = time.perf_counter()
+            result = func()
+            elapsed = time.perf_counter() - started
+            best = elapsed if best is None else min(best, elapsed)
+        return round(best * 1000 * self.per_10k, 2), result
+
+    def run(self):
+        users = User.objects.filter(phone_number__startswith=PHONE_PREFIX).order_by("pk")
+
+        model_ms, model_data = self.timed(lambda: UserProfileSerializer(users, many=True).data)
+        rows_ms, rows_data = self.timed(lambda: serialize_profile_rows(users.values(*PROFILE_FIELDS)))
+        for name, ms in (("model_serializer", model_ms), ("values_rows", rows_ms)):
+            self.stdout.write(json.dumps({"stage": "serialize", "name": name, "ms_per_10k_users": ms}))
+
+        renderers = [("json", JSONRenderer()), ("orjson", ORJSONRenderer() if orjson else None),
+                     ("msgpack", MessagePackRenderer() if msgpack else None)]
+        reference = JSONRenderer().render(model_data)
+        for name, renderer in renderers:
+            if renderer is None:
+                self.stdout.write(json.dumps({"stage": "render", "name": name, "skipped": "package not installed"}))
+                continue
+            ms, body = self.timed(lambda: renderer.render(rows_data))
+            line = {"stage": "render", "name": name, "ms_per_10k_users": ms, "bytes": len(body)}
+            if renderer.media_type == "application/json":
+                line["identical_to_json"] = body == reference
+            self.stdout.write(json.dumps(line))
@@ -0,0 +1,81 @@
+import json
+import random
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+
+from referral_system.invite_codes import INVITE_CODE_ALPHABET, INVITE_CODE_LENGTH
+from referral_system.models import User, invite_code_allocator
+
+# Benchmark users get phone numbers no real user can have, so they can be told apart and removed
+PHONE_PREFIX = "+999"
+
+
+def benchmark_phone_number(number):
+    return f"{PHONE_PREFIX}{number:011d}"
+
+
+def create_user_legacy(phone_number):
+    """The previous signup path: random code, probed with exists() until a free one is found."""
+    invite_code = "".join(random.choices(INVITE_CODE_ALPHABET, k=INVITE_CODE_LENGTH))
+    while User.objects.filter(invite_code=invite_code).exists():
+        invite_code = "".join(random.choices(INVITE_CODE_ALPHABET, k=INVITE_CODE_LENGTH))
+    user = User(phone_number=phone_number, invite_code=invite_code)
+    user.set_unusable_password()
+    user.save()
+    return user
+
+
+class Command(BaseCommand):
+    help = ("Measure signup throughput (create_user per second) while the user table grows. "
+            "Inserts benchmark users into the configured database and removes them afterwards")
+
+    def add_arguments(self, parser):
+        parser.add_argument("--rows", type=int, nargs="+", default=[10_000, 100_000, 1_000_000],
+                            help="Table sizes at which signups are measured, e.g. 1000000 10000000 50000000")
+        parser.add_argument("--signups", type=int, default=1000, help="Signups timed at every table size")
+        parser.add_argument("--batch-size", type=int, default=10_000, help="bulk_create batch used to grow the table")
+        parser.add_argument("--legacy", action="store_true", help="Also time the previous retry-exists signup path")
+        parser.add_argument("--keep", action="store_true", help="Do not delete the benchmark users at the end")
+
+    def handle(self, *args, **options):
+        next_number = 0
+        try:
+            for rows in sorted(options["rows"]):
+                next_number = self.grow_table(rows, next_number, options["batch_size"])
+                strategies = [("sequence", User.objects.create_user)]
+                if options["legacy"]:
+                    strategies.append(("legacy", create_user_legacy))
+                for name, create in strategies:
+                    result = self.time_signups(create, next_number, options["signups"])
+                    next_number += options["signups"]
+                    self.stdout.write(json.dumps({"rows": rows, "strategy": name, **result}))
+        finally:
+            if not options["keep"]:
+                User.objects.filter(phone_number__startswith=PHONE_PREFIX).delete()
+
+    def grow_table(self, rows, next_number, batch_size):
+        missing = rows - User.objects.count()
+        while missing > 0:
+            size = min(batch_size, missing)
+            codes = invite_code_allocator.reserve_codes(size)
+            User.objects.bulk_create(
+                User(phone_number=benchmark_phone_number(next_number + i), invite_code=code, password="!")
+                for i, code in enumerate(codes)
+            )
+            next_number += size
+            missing -= size
+        return next_number
+
+    def time_signups(self, create, first_number, signups):
+        with CaptureQueriesContext(connection) as queries:
+            started = time.perf_counter()
+            for number in range(first_number, first_number + signups):
+                create(benchmark_phone_number(number))
+            elapsed = time.perf_counter() - started
+        return {
+            "signups_per_second": round(signups / elapsed, 1),
+            "queries_per_signup": round(len(queries) / signups, 3),
+        }
@@ -0,0 +1,98 @@
+import csv
+import json
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import connection
+
+from referral_system.models import User
+
+# referred_by is exported as the referrer's phone number
+FIELDS = ("phone_number", "invite_code", "activated_code", "referred_by", "referral_count", "activated_at")
+
+
+class CountingWriter:
+    """Text sink counting the lines written through it."""
+
+    def __init__(self, write):
+        self._write = write
+        self.lines = 0
+
+    def write(self, data):
+        if isinstance(data, (bytes, bytearray, memoryview)):
+            data = bytes(data).decode()
+        self.lines += data.count("\n")
+        self._write(data)
+
+
+class Command(BaseCommand):
+    help = ("Export all users as CSV or NDJSON, streamed in primary key order without loading the table into memory. "
+            "The throughput in rows per second is reported on stderr")
+
+    def add_arguments(self, parser):
+        parser.add_argument("path", nargs="?", default="-", help="Output file, stdout by default")
+        parser.add_argument("--format", choices=("csv", "ndjson"), default="csv")
+        parser.add_argument("--chunk-size", type=int, default=5000, help="Rows fetched per round trip")
+        parser.add_argument("--copy", action="store_true", help="Export CSV with COPY ... TO STDOUT (PostgreSQL)")
+
+    def handle(self, *args, **options):
+        if options["copy"] and (connection.vendor != "postgresql" or options["format"] != "csv"):
+            raise CommandError("--copy needs PostgreSQL and the csv format")
+        path = options["path"]
+        stream = None if path == "-" else open(path, "w", newline="", encoding="utf-8")
+        out = CountingWriter(stream.write if stream else lambda data: self.stdout.write(data, ending=""))
+        started = time.perf_counter()
+        try:
+            if options["copy"]:
+                self.export_copy(out)
+                rows = out.lines - 1
+            else:
+                rows = self.export(out, options["format"], options["chunk_size"])
+        finally:
+            if stream:
+                stream.close()
+        elapsed = time.perf_counter() - started
+        self.stderr.write(json.dumps({
+            "rows": rows,
+            "seconds": round(elapsed, 3),
+            "rows_per_second": round(rows / elapsed, 1) if elapsed else None,
+        }))
+
+    def export(self, out, fmt, chunk_size):
+        users = (
+            User.objects.order_by("pk")
+            .values_list("phone_number", "invite_code", "activated_code", "referred_by__phone_number",
+                         "referral_count", "activated_at")
+            .iterator(chunk_size=chunk_size)
+        )
+        rows = 0
+        if fmt == "csv":
+            writer = csv.writer(out)
+            writer.writerow(FIELDS)
+            for row in users:
+                writer.writerow([value.isoformat() if hasattr(value, "isoformat") else value for value in row])
+                rows += 1
+        else:
+            for row in users:
+                out.write(json.dumps(dict(zip(FIELDS, row)), cls=DjangoJSONEncoder, ensure_ascii=False) + "\n")
+                rows += 1
+        return rows
+
+    def export_copy(self, out):
+        quote = connection.ops.quote_name
+        table = quote(User._meta.db_table)
+        sql = (
+            f"COPY (SELECT u.phone_number, u.invite_code, u.activated_code, r.phone_number, u.referral_count, "
+            f"u.activated_at FROM {table} u LEFT JOIN {table} r ON r.id = u.referred_by_id ORDER BY u.id) "
+            f"TO STDOUT WITH (FORMAT csv)"
+        )
+        csv.writer(out).writerow(FIELDS)
+        with connection.cursor() as cursor:
+            raw_cursor = cursor.cursor
+            if hasattr(raw_cursor, "copy_expert"):
+                raw_cursor.copy_expert(sql, out)
+            else:
+                with raw_cursor.copy(sql) as copy:
+                    for data in copy:
+                        out.write(data)
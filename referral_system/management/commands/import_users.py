@@ -0,0 +1,188 @@
+import csv
+import io
+import json
+import re
+import sys
+import time
+from collections import Counter
+from itertools import islice
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+
+from referral_system.models import User, invite_code_allocator
+from referral_system.phone_numbers import normalize_phone_number
+from referral_system.profile_cache import invalidate_profile_list
+
+INVITE_CODE_RE = re.compile(r'^[A-Za-z0-9]{6}$')
+# Rejected rows printed to stderr, the rest are only counted
+MAX_REPORTED_REJECTS = 20
+
+
+def read_rows(stream, fmt):
+    """
+    Yield (line number, row) pairs from a CSV file with a header line or from NDJSON, row being
+    a {"phone_number": ..., "invite_code": ...} dict, or None for an NDJSON line that is not a JSON object.
+    """
+    if fmt == "csv":
+        reader = csv.DictReader(stream)
+        for row in reader:
+            yield reader.line_num, row
+    else:
+        for line, text in enumerate(stream, start=1):
+            if not text.strip():
+                continue
+            try:
+                row = json.loads(text)
+            except ValueError:
+                row = None
+            yield line, row if isinstance(row, dict) else None
+
+
+def text_field(row, name):
+    """The stripped value of a column, "" if it is missing or empty, None if it is not a string."""
+    value = row.get(name)
+    if value is None:
+        return ""
+    return value.strip() if isinstance(value, str) else None
+
+
+def detect_format(path, fmt):
+    if fmt:
+        return fmt
+    if path.endswith(".csv"):
+        return "csv"
+    if path.endswith((".ndjson", ".jsonl")):
+        return "ndjson"
+    raise CommandError("Cannot tell the format from the file name, pass --format")
+
+
+def copy_users(users):
+    """Write users with one COPY ... FROM STDIN (PostgreSQL only), several times faster than INSERT for big batches."""
+    fields = [field for field in User._meta.concrete_fields if not field.primary_key]
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    for user in users:
+        row = []
+        for field in fields:
+            value = field.get_db_prep_save(getattr(user, field.attname), connection)
+            # an unquoted empty field is NULL in COPY's csv format
+            row.append('' if value is None else value)
+        writer.writerow(row)
+    buffer.seek(0)
+
+    quote = connection.ops.quote_name
+    columns = ', '.join(quote(field.column) for field in fields)
+    sql = f'COPY {quote(User._meta.db_table)} ({columns}) FROM STDIN WITH (FORMAT csv)'
+    with connection.cursor() as cursor:
+        raw_cursor = cursor.cursor
+        if hasattr(raw_cursor, 'copy_expert'):
+            raw_cursor.copy_expert(sql, buffer)
+        else:
+            with raw_cursor.copy(sql) as copy:
+                copy.write(buffer.getvalue())
+
+
+class Command(BaseCommand):
+    help = ("Import users from a CSV (phone_number[,invite_code] header) or NDJSON file in batches. "
+            "Missing invite codes are generated, existing phone numbers are skipped. "
+            "Prints a JSON summary with the throughput in rows per second")
+
+    def add_arguments(self, parser):
+        parser.add_argument("path", help="File to import, - for stdin")
+        parser.add_argument("--format", choices=("csv", "ndjson"), help="Taken from the file extension by default")
+        parser.add_argument("--batch-size", type=int, default=5000, help="Rows validated and written per transaction")
+        parser.add_argument("--copy", action="store_true", help="Write with COPY instead of INSERT (PostgreSQL)")
+
+    def handle(self, *args, **options):
+        if options["copy"] and connection.vendor != "postgresql":
+            raise CommandError("--copy needs PostgreSQL")
+        path = options["path"]
+        fmt = detect_format(path, options["format"]) if path != "-" else options["format"] or "csv"
+        self.totals = Counter()
+        self.reported = 0
+
+        started = time.perf_counter()
+        stream = sys.stdin if path == "-" else open(path, newline="", encoding="utf-8")
+        try:
+            rows = read_rows(stream, fmt)
+            while batch := list(islice(rows, options["batch_size"])):
+                self.import_batch(batch, options["copy"])
+        finally:
+            if stream is not sys.stdin:
+                stream.close()
+        elapsed = time.perf_counter() - started
+
+        self.stdout.write(json.dumps({
+            **self.totals,
+            "seconds": round(elapsed, 3),
+            "rows_per_second": round(self.totals["rows"] / elapsed, 1) if elapsed else None,
+        }))
+
+    def reject(self, line, reason):
+        self.totals[reason] += 1
+        if self.reported < MAX_REPORTED_REJECTS:
+            self.reported += 1
+            self.stderr.write(f"line {line}: {reason}")
+
+    def import_batch(self, batch, use_copy):
+        self.totals["rows"] += len(batch)
+        rows, phone_numbers, invite_codes = [], set(), set()
+        for line, row in batch:
+            # a broken line is rejected like an invalid row, the batches before it are already committed
+            phone_number = text_field(row, "phone_number") if row is not None else None
+            invite_code = text_field(row, "invite_code") if row is not None else None
+            if phone_number is None or invite_code is None:
+                self.reject(line, "malformed_row")
+                continue
+            phone_number = normalize_phone_number(phone_number)
+            invite_code = invite_code or None
+            if phone_number is None:
+                self.reject(line, "invalid_phone_number")
+            elif invite_code and not INVITE_CODE_RE.match(invite_code):
+                self.reject(line, "invalid_invite_code")
+            elif phone_number in phone_numbers:
+                self.reject(line, "duplicate_phone_number")
+            elif invite_code and invite_code in invite_codes:
+                self.reject(line, "duplicate_invite_code")
+            else:
+                phone_numbers.add(phone_number)
+                if invite_code:
+                    invite_codes.add(invite_code)
+                rows.append((line, phone_number, invite_code))
+
+        # one IN query per column for the whole batch instead of a probe per row
+        existing_phone_numbers = set(
+            User.objects.filter(phone_number__in=phone_numbers).values_list("phone_number", flat=True))
+        taken_codes = set(User.objects.filter(invite_code__in=invite_codes).values_list("invite_code", flat=True))
+        accepted = []
+        for line, phone_number, invite_code in rows:
+            if phone_number in existing_phone_numbers:
+                self.totals["existing"] += 1
+            elif invite_code in taken_codes:
+                self.reject(line, "invite_code_taken")
+            else:
+                accepted.append((phone_number, invite_code))
+
+        generated = iter(self.generate_codes(sum(code is None for _, code in accepted), invite_codes))
+        # an unusable password without hashing a random one per row
+        users = [
+            User(phone_number=phone_number, invite_code=invite_code or next(generated), password="!")
+            for phone_number, invite_code in accepted
+        ]
+        with transaction.atomic():
+            if use_copy:
+                copy_users(users)
+            else:
+                User.objects.bulk_create(users)
+            invalidate_profile_list()
+        self.totals["imported"] += len(users)
+
+    def generate_codes(self, count, reserved):
+        """Reserve count sequence codes, replacing the few that clash with older random or imported codes."""
+        codes = []
+        while len(codes) < count:
+            candidates = invite_code_allocator.reserve_codes(count - len(codes))
+            taken = set(User.objects.filter(invite_code__in=candidates).values_list("invite_code", flat=True))
+            codes.extend(code for code in candidates if code not in taken and code not in reserved)
+        return codes
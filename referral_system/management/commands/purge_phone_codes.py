@@ -0,0 +1,16 @@
+from django.core.management.base import BaseCommand
+
+from referral_system.code_store import purge_expired_codes
+
+
+class Command(BaseCommand):
+    help = "Delete expired authorization codes in bounded batches. Meant to be run periodically (cron)"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=1000, help="Rows deleted per statement")
+        parser.add_argument("--max-batches", type=int, default=None,
+                            help="Stop after this many batches, the rest is left for the next run")
+
+    def handle(self, *args, **options):
+        deleted = purge_expired_codes(batch_size=options["batch_size"], max_batches=options["max_batches"])
+        self.stdout.write(self.style.SUCCESS(f"Deleted {deleted} expired authorization codes"))
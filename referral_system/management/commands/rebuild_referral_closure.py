@@ -0,0 +1,15 @@
+from django.core.management.base import BaseCommand
+
+from referral_system.referrals import rebuild_referral_closure
+
+
+class Command(BaseCommand):
+    help = ("Rebuild the ReferralClosure table from the referred_by links. "
+            "Run it once after turning REFERRAL_CLOSURE_TABLE on, activations keep it up to date afterwards")
+
+    def add_arguments(self, parser):
+        parser.add_argument("--max-depth", type=int, default=100, help="Deepest referral level to record")
+
+    def handle(self, *args, **options):
+        rows = rebuild_referral_closure(max_depth=options["max_depth"])
+        self.stdout.write(self.style.SUCCESS(f"Referral closure rebuilt: {rows} rows"))
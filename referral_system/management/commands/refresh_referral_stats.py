@@ -0,0 +1,15 @@
+from django.core.management.base import BaseCommand
+
+from referral_system.referrals import refresh_referral_stats
+
+
+class Command(BaseCommand):
+    help = "Rebuild the per-day referral statistics served by /referral/stats/. Meant to be run periodically (cron)"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--days", type=int, default=None,
+                            help="Only recompute the last N days instead of the whole history")
+
+    def handle(self, *args, **options):
+        refresh_referral_stats(days=options["days"])
+        self.stdout.write(self.style.SUCCESS("Referral statistics refreshed"))
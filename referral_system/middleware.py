@@ -0,0 +1,116 @@
+import logging
+import time
+from contextlib import ExitStack
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction, sync_to_async
+from django.conf import settings
+from django.db import connections
+
+from referral_system.metrics import Histogram
+
+slow_request_logger = logging.getLogger('referral_system.slow_requests')
+
+REQUEST_DURATION = Histogram(
+    "referral_request_duration_seconds", "Wall time of a request by view", labelnames=("view",))
+REQUEST_QUERIES = Histogram(
+    "referral_request_queries", "Database queries per request by view", labelnames=("view",),
+    buckets=(0, 1, 2, 3, 5, 10, 20, 50, 100, 200, 500, 1000))
+REQUEST_DB_DURATION = Histogram(
+    "referral_request_db_duration_seconds", "Time spent in database queries per request by view",
+    labelnames=("view",))
+RESPONSE_SIZE = Histogram(
+    "referral_response_size_bytes", "Response body size by view", labelnames=("view",),
+    buckets=(256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304, 16777216))
+
+
+class QueryRecorder:
+    """execute_wrapper that counts queries and their time, and keeps the SQL while a slow request log is enabled."""
+
+    def __init__(self, keep_sql):
+        self.count = 0
+        self.duration = 0.0
+        self.keep_sql = keep_sql
+        self.statements = []
+
+    def __call__(self, execute, sql, params, many, context):
+        started = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            duration = time.perf_counter() - started
+            self.count += 1
+            self.duration += duration
+            if len(self.statements) < self.keep_sql:
+                self.statements.append((duration, sql))
+
+
+class RequestMetricsMiddleware:
+    """
+    Observes wall time, database queries, database time and response size of the views named in
+    REQUEST_METRICS_VIEWS (all views if it is empty) into the histograms served at /metrics.
+    Requests slower than SLOW_REQUEST_THRESHOLD seconds are logged with their SQL.
+    The body of a streaming response is produced after the middleware returns, so its queries and size are not counted.
+    """
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        recorder = self.query_recorder()
+        started = time.perf_counter()
+        with self.recording(recorder):
+            response = self.get_response(request)
+        return self.observe(request, response, recorder, time.perf_counter() - started)
+
+    async def __acall__(self, request):
+        recorder = self.query_recorder()
+        started = time.perf_counter()
+        # connections are per thread, the async ORM queries on the thread of the request's sync_to_async calls
+        stack = await sync_to_async(self.recording)(recorder)
+        try:
+            response = await self.get_response(request)
+        finally:
+            await sync_to_async(stack.close)()
+        return self.observe(request, response, recorder, time.perf_counter() - started)
+
+    def query_recorder(self):
+        return QueryRecorder(keep_sql=settings.SLOW_REQUEST_MAX_QUERIES
+                             if settings.SLOW_REQUEST_THRESHOLD is not None else 0)
+
+    def recording(self, recorder):
+        stack = ExitStack()
+        for connection in connections.all():
+            stack.enter_context(connection.execute_wrapper(recorder))
+        return stack
+
+    def observe(self, request, response, recorder, duration):
+        view = self.view_name(request)
+        if view is None:
+            return response
+        REQUEST_DURATION.observe(duration, view=view)
+        REQUEST_QUERIES.observe(recorder.count, view=view)
+        REQUEST_DB_DURATION.observe(recorder.duration, view=view)
+        if not response.streaming:
+            RESPONSE_SIZE.observe(len(response.content), view=view)
+
+        threshold = settings.SLOW_REQUEST_THRESHOLD
+        if threshold is not None and duration >= threshold:
+            slow_request_logger.warning(
+                'Slow request %s %s (%s): %.3fs, %d queries in %.3fs\n%s',
+                request.method, request.path, view, duration, recorder.count, recorder.duration,
+                '\n'.join(f'[{query_duration * 1000:.1f}ms] {sql}' for query_duration, sql in recorder.statements),
+            )
+        return response
+
+    def view_name(self, request):
+        match = getattr(request, 'resolver_match', None)
+        if match is None or (settings.REQUEST_METRICS_VIEWS and match.url_name not in settings.REQUEST_METRICS_VIEWS):
+            return None
+        return match.url_name or match.view_name
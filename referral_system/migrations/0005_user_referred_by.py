@@ -0,0 +1,26 @@
+# Generated by Django 5.2.4 on 2026-10-18 14:07
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("referral_system", "0004_alter_user_phone_number"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="user",
+            name="referred_by",
+            field=models.ForeignKey(
+                blank=True,
+                null=True,
+                on_delete=django.db.models.deletion.SET_NULL,
+                related_name="referrals",
+                to=settings.AUTH_USER_MODEL,
+            ),
+        ),
+    ]
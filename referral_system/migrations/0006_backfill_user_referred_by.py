@@ -0,0 +1,40 @@
+from django.db import migrations
+
+BATCH_SIZE = 1000
+
+
+def backfill_referred_by(apps, schema_editor):
+    User = apps.get_model("referral_system", "User")
+    db_alias = schema_editor.connection.alias
+    referrals = User.objects.using(db_alias).filter(activated_code__isnull=False, referred_by__isnull=True)
+
+    last_id = 0
+    while True:
+        batch = list(referrals.filter(id__gt=last_id).order_by("id").only("id", "activated_code")[:BATCH_SIZE])
+        if not batch:
+            break
+        last_id = batch[-1].id
+
+        referrer_ids = dict(
+            User.objects.using(db_alias)
+            .filter(invite_code__in={user.activated_code for user in batch})
+            .values_list("invite_code", "id")
+        )
+        updated = []
+        for user in batch:
+            referrer_id = referrer_ids.get(user.activated_code)
+            if referrer_id is not None and referrer_id != user.id:
+                user.referred_by_id = referrer_id
+                updated.append(user)
+        User.objects.using(db_alias).bulk_update(updated, ["referred_by"])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("referral_system", "0005_user_referred_by"),
+    ]
+
+    operations = [
+        migrations.RunPython(backfill_referred_by, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,57 @@
+# Generated by Django 5.2.4 on 2026-10-18 14:08
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("referral_system", "0006_backfill_user_referred_by"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="user",
+            name="activated_at",
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name="user",
+            name="referral_count",
+            field=models.PositiveIntegerField(db_index=True, default=0),
+        ),
+        migrations.CreateModel(
+            name="ReferralStats",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("date", models.DateField(db_index=True)),
+                ("referrals", models.PositiveIntegerField(default=0)),
+                (
+                    "referrer",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="referral_stats",
+                        to=settings.AUTH_USER_MODEL,
+                    ),
+                ),
+            ],
+            options={
+                "constraints": [
+                    models.UniqueConstraint(
+                        fields=("referrer", "date"),
+                        name="unique_referral_stats_per_day",
+                    )
+                ],
+            },
+        ),
+    ]
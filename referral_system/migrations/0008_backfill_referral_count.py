@@ -0,0 +1,34 @@
+from django.db import migrations
+from django.db.models import Count, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+
+BATCH_SIZE = 10000
+
+
+def backfill_referral_count(apps, schema_editor):
+    User = apps.get_model("referral_system", "User")
+    users = User.objects.using(schema_editor.connection.alias)
+    referral_count = Subquery(
+        users.filter(referred_by=OuterRef("pk"))
+        .order_by()
+        .values("referred_by")
+        .annotate(total=Count("pk"))
+        .values("total")
+    )
+
+    last_id = users.order_by("-id").values_list("id", flat=True).first() or 0
+    for start in range(0, last_id, BATCH_SIZE):
+        users.filter(id__gt=start, id__lte=start + BATCH_SIZE).update(
+            referral_count=Coalesce(referral_count, 0)
+        )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("referral_system", "0007_referral_counters"),
+    ]
+
+    operations = [
+        migrations.RunPython(backfill_referral_count, migrations.RunPython.noop),
+    ]
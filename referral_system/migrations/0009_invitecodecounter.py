@@ -0,0 +1,34 @@
+# Generated by Django 5.2.4 on 2026-10-18 14:10
+
+from django.db import migrations, models
+
+
+def create_counter(apps, schema_editor):
+    InviteCodeCounter = apps.get_model("referral_system", "InviteCodeCounter")
+    InviteCodeCounter.objects.using(schema_editor.connection.alias).get_or_create(pk=1)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("referral_system", "0008_backfill_referral_count"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="InviteCodeCounter",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("value", models.BigIntegerField(default=0)),
+            ],
+        ),
+        migrations.RunPython(create_counter, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,30 @@
+from django.db import migrations
+from django.db.models import Count, Max
+
+BATCH_SIZE = 1000
+
+
+def dedupe_phone_codes(apps, schema_editor):
+    """Keep only the latest code of every phone number so phone_number can become unique."""
+    UserPhoneCode = apps.get_model("referral_system", "UserPhoneCode")
+    phone_codes = UserPhoneCode.objects.using(schema_editor.connection.alias)
+    duplicates = (
+        phone_codes.values("phone_number")
+        .annotate(codes=Count("id"), latest_id=Max("id"))
+        .filter(codes__gt=1)
+        .order_by()
+    )
+    while batch := list(duplicates[:BATCH_SIZE]):
+        for row in batch:
+            phone_codes.filter(phone_number=row["phone_number"]).exclude(id=row["latest_id"]).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("referral_system", "0009_invitecodecounter"),
+    ]
+
+    operations = [
+        migrations.RunPython(dedupe_phone_codes, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 5.2.4 on 2026-10-18 14:14
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("referral_system", "0010_dedupe_userphonecode"),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name="userphonecode",
+            name="created_at",
+            field=models.DateTimeField(auto_now_add=True, db_index=True),
+        ),
+        migrations.AlterField(
+            model_name="userphonecode",
+            name="phone_number",
+            field=models.CharField(max_length=15, unique=True),
+        ),
+    ]
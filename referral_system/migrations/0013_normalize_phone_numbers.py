@@ -0,0 +1,67 @@
+import re
+
+from django.db import migrations, transaction
+
+BATCH_SIZE = 1000
+# a copy of referral_system.phone_numbers as of this migration, later changes there must not change what it does
+PHONE_NUMBER_RE = re.compile(r"^\+?(\d{5,14})$")
+PHONE_NUMBER_SEPARATORS_RE = re.compile(r"[\s().-]+")
+
+
+def normalize_phone_number(value):
+    match = PHONE_NUMBER_RE.match(PHONE_NUMBER_SEPARATORS_RE.sub("", value))
+    return f"+{match.group(1)}" if match else None
+
+
+def canonical_numbers(batch):
+    """{row: canonical number} for the rows of batch whose number is valid but not stored in canonical form."""
+    changes = {}
+    for row in batch:
+        canonical = normalize_phone_number(row.phone_number)
+        if canonical is not None and canonical != row.phone_number:
+            changes[row] = canonical
+    return changes
+
+
+def normalize_phone_numbers(apps, schema_editor):
+    """
+    Rewrite phone numbers to their canonical "+<digits>" form, one short transaction per batch of rows.
+    A user whose canonical number already belongs to another user is left as is, the two accounts need a manual
+    merge; until then sign-in finds it by the number typed exactly as stored. A duplicate authorization code
+    is dropped.
+    """
+    db_alias = schema_editor.connection.alias
+    for model_name in ("User", "UserPhoneCode"):
+        rows = apps.get_model("referral_system", model_name).objects.using(db_alias)
+        last_id = 0
+        while batch := list(rows.filter(id__gt=last_id).order_by("id").only("id", "phone_number")[:BATCH_SIZE]):
+            last_id = batch[-1].id
+            changes = canonical_numbers(batch)
+            if not changes:
+                continue
+            taken = set(rows.filter(phone_number__in=changes.values()).values_list("phone_number", flat=True))
+            updated, duplicates = [], []
+            for row, canonical in changes.items():
+                if canonical in taken:
+                    duplicates.append(row.id)
+                    continue
+                taken.add(canonical)
+                row.phone_number = canonical
+                updated.append(row)
+            with transaction.atomic(using=db_alias):
+                if model_name == "UserPhoneCode":
+                    rows.filter(id__in=duplicates).delete()
+                rows.bulk_update(updated, ["phone_number"])
+
+
+class Migration(migrations.Migration):
+    # every batch commits on its own instead of one transaction locking the whole table
+    atomic = False
+
+    dependencies = [
+        ("referral_system", "0012_referralclosure"),
+    ]
+
+    operations = [
+        migrations.RunPython(normalize_phone_numbers, migrations.RunPython.noop),
+    ]
@@ -1,16 +1,22 @@
+from collections import namedtuple
 from datetime import timedelta
 
 from django.utils import timezone
+from contextlib import nullcontext
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
 from django.contrib.auth.models import AbstractBaseUser, BaseUserManager, PermissionsMixin
 from rest_framework import exceptions
-from django.db import models
+from django.db import IntegrityError, connections, models, transaction
 import random
-import string
 
+from referral_system.invite_codes import InviteCodeAllocator
+from referral_system.profile_cache import ainvalidate_profile_list, ainvalidate_profiles, invalidate_profile_list, \
+    invalidate_profiles
 
-def generate_invite_code(max_length=6):
-    chars = string.ascii_letters + string.digits
-    return ''.join(random.choices(chars, k=max_length))
+# One user of a referral subtree: parent is the phone number of the user whose code they activated
+ReferralNode = namedtuple('ReferralNode', ('phone_number', 'invite_code', 'parent', 'depth'))
 
 
 class CustomUserManager(BaseUserManager):
@@ -18,14 +24,131 @@ class CustomUserManager(BaseUserManager):
         if not phone_number:
             raise exceptions.AuthenticationFailed('There is no phone number')
 
-        invite_code = generate_invite_code()
-        while User.objects.filter(invite_code=invite_code).exists():
-            invite_code = generate_invite_code()
+        user = self.model(phone_number=phone_number, **extra_fields)
+        user.set_unusable_password()
+        # A savepoint is only needed to survive the IntegrityError inside an outer transaction
+        in_atomic_block = transaction.get_connection(self._db).in_atomic_block
+        while True:
+            user.invite_code = invite_code_allocator.next_code(using=self._db)
+            try:
+                with transaction.atomic(using=self._db) if in_atomic_block else nullcontext():
+                    user.save(using=self._db)
+                invalidate_profiles([user.pk])
+                invalidate_profile_list()
+                return user
+            except IntegrityError:
+                # Codes generated before the allocator existed were random and may take a sequence slot
+                if not self.filter(invite_code=user.invite_code).exists():
+                    raise
+
+    async def acreate_user(self, phone_number, **extra_fields):
+        """Async version of create_user() for async views, which always run in autocommit mode."""
+        if not phone_number:
+            raise exceptions.AuthenticationFailed('There is no phone number')
 
-        user = self.model(phone_number=phone_number, invite_code=invite_code, **extra_fields)
+        user = self.model(phone_number=phone_number, **extra_fields)
         user.set_unusable_password()
-        user.save(using=self._db)
-        return user
+        while True:
+            # only every block_size-th call reserves a new block in the database
+            user.invite_code = await sync_to_async(invite_code_allocator.next_code)(using=self._db)
+            try:
+                await user.asave(using=self._db)
+            except IntegrityError:
+                if not await self.filter(invite_code=user.invite_code).aexists():
+                    raise
+                continue
+            await ainvalidate_profiles([user.pk])
+            await ainvalidate_profile_list()
+            return user
+
+    def referral_subtree(self, user, max_depth, max_nodes, chunk_size=2000):
+        """
+        Yield the referrals of user, their referrals and so on down to max_depth levels as ReferralNode,
+        level by level and at most max_nodes of them. Rows are fetched chunk_size at a time from a single query:
+        a recursive CTE over referred_by, or the closure table when REFERRAL_CLOSURE_TABLE is on.
+        """
+        user_table = self.model._meta.db_table
+        if settings.REFERRAL_CLOSURE_TABLE:
+            sql = (
+                f'SELECT u.phone_number, u.invite_code, p.phone_number, c.depth '
+                f'FROM {ReferralClosure._meta.db_table} c '
+                f'JOIN {user_table} u ON u.id = c.descendant_id '
+                f'JOIN {user_table} p ON p.id = u.referred_by_id '
+                f'WHERE c.ancestor_id = %s AND c.depth <= %s '
+                f'ORDER BY c.depth, c.descendant_id LIMIT %s'
+            )
+            params = [user.pk, max_depth, max_nodes]
+        else:
+            # the depth condition also ends the recursion if the referrals ever form a cycle
+            sql = (
+                f'WITH RECURSIVE tree (id, phone_number, invite_code, parent, depth) AS ('
+                f'SELECT id, phone_number, invite_code, CAST(%s AS varchar(15)), 1 '
+                f'FROM {user_table} WHERE referred_by_id = %s '
+                f'UNION ALL '
+                f'SELECT u.id, u.phone_number, u.invite_code, tree.phone_number, tree.depth + 1 '
+                f'FROM {user_table} u JOIN tree ON u.referred_by_id = tree.id WHERE tree.depth < %s'
+                f') SELECT phone_number, invite_code, parent, depth FROM tree ORDER BY depth, id LIMIT %s'
+            )
+            params = [user.phone_number, user.pk, max_depth, max_nodes]
+
+        with connections[self.db].cursor() as cursor:
+            cursor.execute(sql, params)
+            while rows := cursor.fetchmany(chunk_size):
+                yield from map(ReferralNode._make, rows)
+
+    def has_referral_ancestor(self, user_id, ancestor_id, max_depth):
+        """
+        Whether ancestor_id is found among the first max_depth referrers above user_id (its referrer,
+        the referrer's referrer and so on). One indexed lookup with the closure table, otherwise a recursive CTE
+        that walks up the primary key index one level per step.
+        """
+        if settings.REFERRAL_CLOSURE_TABLE:
+            return ReferralClosure.objects.using(self.db).filter(
+                ancestor_id=ancestor_id, descendant_id=user_id, depth__lte=max_depth).exists()
+
+        user_table = self.model._meta.db_table
+        with connections[self.db].cursor() as cursor:
+            cursor.execute(
+                f'WITH RECURSIVE chain (id, depth) AS ('
+                f'SELECT referred_by_id, 1 FROM {user_table} WHERE id = %s AND referred_by_id IS NOT NULL '
+                f'UNION ALL '
+                f'SELECT u.referred_by_id, chain.depth + 1 FROM {user_table} u JOIN chain ON u.id = chain.id '
+                f'WHERE u.referred_by_id IS NOT NULL AND chain.depth < %s'
+                f') SELECT 1 FROM chain WHERE id = %s LIMIT 1',
+                [user_id, max_depth, ancestor_id],
+            )
+            return cursor.fetchone() is not None
+
+    def referral_uplines(self, user_ids, max_depth):
+        """
+        Return {user_id: [referrer id, the referrer's referrer id, ...]} with at most max_depth referrers above each
+        of user_ids, for all of them in one query. Users without a referrer are left out.
+        """
+        uplines = {}
+        if not user_ids:
+            return uplines
+        if settings.REFERRAL_CLOSURE_TABLE:
+            rows = (ReferralClosure.objects.using(self.db)
+                    .filter(descendant_id__in=user_ids, depth__lte=max_depth)
+                    .order_by('descendant_id', 'depth').values_list('descendant_id', 'ancestor_id'))
+        else:
+            user_table = self.model._meta.db_table
+            placeholders = ', '.join(['%s'] * len(user_ids))
+            with connections[self.db].cursor() as cursor:
+                cursor.execute(
+                    f'WITH RECURSIVE chain (user_id, id, depth) AS ('
+                    f'SELECT id, referred_by_id, 1 FROM {user_table} '
+                    f'WHERE id IN ({placeholders}) AND referred_by_id IS NOT NULL '
+                    f'UNION ALL '
+                    f'SELECT chain.user_id, u.referred_by_id, chain.depth + 1 FROM {user_table} u '
+                    f'JOIN chain ON u.id = chain.id WHERE u.referred_by_id IS NOT NULL AND chain.depth < %s'
+                    f') SELECT user_id, id FROM chain ORDER BY user_id, depth',
+                    [*user_ids, max_depth],
+                )
+                rows = cursor.fetchall()
+        for user_id, ancestor_id in rows:
+            uplines.setdefault(user_id, []).append(ancestor_id)
+        return uplines
 
     def create_superuser(self, phone_number, **extra_fields):
         extra_fields.setdefault('is_staff', True)
@@ -37,6 +160,10 @@ class User(AbstractBaseUser, PermissionsMixin):
     phone_number = models.CharField(max_length=15, unique=True)
     invite_code = models.CharField(max_length=6, unique=True, blank=False, null=False)
     activated_code = models.CharField(max_length=6, blank=True, null=True)
+    referred_by = models.ForeignKey('self', on_delete=models.SET_NULL, blank=True, null=True,
+                                    related_name='referrals')
+    activated_at = models.DateTimeField(blank=True, null=True)
+    referral_count = models.PositiveIntegerField(default=0, db_index=True)
 
     USERNAME_FIELD = 'phone_number'
 
@@ -46,14 +173,54 @@ class User(AbstractBaseUser, PermissionsMixin):
         return self.phone_number
 
 
+class InviteCodeCounter(models.Model):
+    """Single-row counter of invite code sequence numbers handed out in blocks by InviteCodeAllocator."""
+    value = models.BigIntegerField(default=0)
+
+
+invite_code_allocator = InviteCodeAllocator(InviteCodeCounter, block_size=settings.INVITE_CODE_BLOCK_SIZE)
+
+
+class ReferralClosure(models.Model):
+    """
+    Every (ancestor, descendant) pair of the referral tree and the number of levels between them, so the
+    whole downline or the whole upline of a user is one indexed lookup. Only maintained with REFERRAL_CLOSURE_TABLE on,
+    rebuild_referral_closure fills it for existing data.
+    """
+    ancestor = models.ForeignKey(User, on_delete=models.CASCADE, related_name='+', db_index=False)
+    descendant = models.ForeignKey(User, on_delete=models.CASCADE, related_name='+', db_index=False)
+    depth = models.PositiveIntegerField()
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=('ancestor', 'descendant'), name='unique_referral_closure_pair'),
+        ]
+        indexes = [
+            models.Index(fields=('ancestor', 'depth'), name='referral_closure_downline'),
+            models.Index(fields=('descendant', 'depth'), name='referral_closure_upline'),
+        ]
+
+
 class UserPhoneCode(models.Model):
-    phone_number = models.CharField(max_length=15)
+    phone_number = models.CharField(max_length=15, unique=True)
     code = models.CharField(max_length=4)
-    created_at = models.DateTimeField(auto_now_add=True)
+    created_at = models.DateTimeField(auto_now_add=True, db_index=True)
 
     def is_expired(self):
-        return timezone.now() > self.created_at + timedelta(hours=1)
+        return timezone.now() > self.created_at + timedelta(seconds=settings.PHONE_CODE_TTL)
 
     @staticmethod
     def generate_4xcode():
         return str(random.randint(1000, 9999))
+
+
+class ReferralStats(models.Model):
+    """Referral activations per referrer and day, rebuilt by the refresh_referral_stats command."""
+    date = models.DateField(db_index=True)
+    referrer = models.ForeignKey(User, on_delete=models.CASCADE, related_name='referral_stats')
+    referrals = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=('referrer', 'date'), name='unique_referral_stats_per_day'),
+        ]
@@ -0,0 +1,10 @@
+from django.conf import settings
+from rest_framework.pagination import CursorPagination
+
+
+class UserCursorPagination(CursorPagination):
+    """Keyset pagination over the user primary key, so every page is an index range scan."""
+    ordering = 'id'
+    page_size = settings.REFERRAL_USERS_PAGE_SIZE
+    page_size_query_param = 'page_size'
+    max_page_size = settings.REFERRAL_USERS_MAX_PAGE_SIZE
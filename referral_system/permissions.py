@@ -0,0 +1,8 @@
+from rest_framework import permissions
+
+
+class IsSuperuser(permissions.BasePermission):
+    """Service endpoints for partner integrations. The user model has no is_staff flag, so superusers only."""
+
+    def has_permission(self, request, view):
+        return bool(request.user and request.user.is_authenticated and request.user.is_superuser)
@@ -0,0 +1,56 @@
+"""
+Canonical form of phone numbers: "+" followed by 5 to 14 digits, so "+7 (999) 123-45-67", "79991234567"
+and "+79991234567" are one user, one authorization code and one rate limit counter, and every lookup
+is an exact match on the unique index.
+
+Numbers stored before normalization are not always in canonical form: a few could not be rewritten because their
+canonical form belonged to another user. Sign-in looks such a number up exactly as typed first, see
+stored_phone_number().
+"""
+import re
+from functools import lru_cache
+
+from django.contrib.auth import get_user_model
+
+PHONE_NUMBER_RE = re.compile(r'^\+?(\d{5,14})$')
+# Formatting people type between the digits
+PHONE_NUMBER_SEPARATORS_RE = re.compile(r'[\s().-]+')
+
+
+@lru_cache(maxsize=10000)
+def normalize_phone_number(value):
+    """Return the canonical "+<digits>" form of a phone number as typed, or None if it is not a valid number."""
+    if not isinstance(value, str):
+        return None
+    match = PHONE_NUMBER_RE.match(PHONE_NUMBER_SEPARATORS_RE.sub('', value))
+    return f'+{match.group(1)}' if match else None
+
+
+def phone_number_key(value):
+    """
+    The key to look a phone number up by: its canonical form, or the value as given if it has none (numbers stored
+    before validation existed are kept as they were), None if empty.
+    """
+    return normalize_phone_number(value) or value or None
+
+
+def _stored_candidate(value):
+    # a canonical value can only be stored as itself, so only other values are worth a query
+    return isinstance(value, str) and value and normalize_phone_number(value) != value
+
+
+def stored_phone_number(value):
+    """
+    Return value if it is not in canonical form but is stored as is for a user (a number stored before
+    normalization), else None. Sign-in accepts such a number exactly as stored instead of normalizing it.
+    """
+    if _stored_candidate(value) and get_user_model().objects.filter(phone_number=value).exists():
+        return value
+    return None
+
+
+async def astored_phone_number(value):
+    """Async version of stored_phone_number()."""
+    if _stored_candidate(value) and await get_user_model().objects.filter(phone_number=value).aexists():
+        return value
+    return None
@@ -0,0 +1,165 @@
+import time
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import transaction
+from django.utils.http import parse_etags
+
+from referral_system.metrics import Counter
+
+PROFILE_CACHE_REQUESTS = Counter(
+    "referral_profile_cache_requests_total", "User profile cache lookups by result", labelnames=("result",))
+
+
+def _cache():
+    return caches[settings.PROFILE_CACHE]
+
+
+def _version_key(user_id):
+    return f'profile:version:{user_id}'
+
+
+# The pages of the profile list are cached by the versions of the buckets of PROFILE_LIST_BUCKET_SIZE primary keys
+# their users fall in, bumped together with the profiles in them. The last page also depends on the tail version,
+# bumped when users are added, so a change only throws away the one or two pages that show it
+PROFILE_LIST_BUCKET_SIZE = 100
+PROFILE_LIST_TAIL_KEY = 'profile:version:list:tail'
+
+
+def _list_bucket_key(user_id):
+    return f'profile:version:list:{user_id // PROFILE_LIST_BUCKET_SIZE}'
+
+
+def _list_page_key(after, size):
+    return f'profile:list:page:{after}:{size}'
+
+
+def get_profile_version(user_id):
+    """
+    Return the current profile version of a user. Versions are timestamps rather than counters,
+    so a version key lost to eviction can never come back with a value that was already used.
+    """
+    cache = _cache()
+    version = cache.get(_version_key(user_id))
+    if version is None:
+        version = time.time_ns()
+        if not cache.add(_version_key(user_id), version, timeout=None):
+            version = cache.get(_version_key(user_id), version)
+    return version
+
+
+def get_profile_list_page(after, size):
+    """Return the version keys a cached profile list page depends on, or None if the page was never rendered."""
+    return _cache().get(_list_page_key(after, size))
+
+
+def set_profile_list_page(after, size, user_ids, last_page):
+    """Remember which users a freshly rendered profile list page shows, see get_profile_list_page()."""
+    keys = sorted({_list_bucket_key(user_id) for user_id in user_ids})
+    if last_page:
+        keys.append(PROFILE_LIST_TAIL_KEY)
+    _cache().set(_list_page_key(after, size), keys, timeout=settings.PROFILE_CACHE_TIMEOUT)
+    return keys
+
+
+def get_profile_list_version(keys):
+    """Return the version of a profile list page from the version keys it depends on, in one cache round trip."""
+    cache = _cache()
+    versions = cache.get_many(keys)
+    for key in keys:
+        if key not in versions:
+            # timestamps for the same reason as in get_profile_version()
+            version = time.time_ns()
+            if not cache.add(key, version, timeout=None):
+                version = cache.get(key, version)
+            versions[key] = version
+    return '.'.join(str(versions[key]) for key in keys)
+
+
+def profile_etag(user_id, version):
+    return f'"profile-{user_id}-{version}"'
+
+
+def get_profile(user, serialize, if_none_match=None):
+    """
+    Return (profile, etag) for user, serializing it with serialize(user) only on a cache miss.
+    If the client already has the current version (If-None-Match), profile is None and the response can be a 304.
+    """
+    version = get_profile_version(user.pk)
+    etag = profile_etag(user.pk, version)
+    if if_none_match and etag in parse_etags(if_none_match):
+        PROFILE_CACHE_REQUESTS.inc(result='not_modified')
+        return None, etag
+
+    cache = _cache()
+    data_key = f'profile:data:{user.pk}:{version}'
+    profile = cache.get(data_key)
+    if profile is None:
+        PROFILE_CACHE_REQUESTS.inc(result='miss')
+        profile = serialize(user)
+        cache.set(data_key, profile, timeout=settings.PROFILE_CACHE_TIMEOUT)
+    else:
+        PROFILE_CACHE_REQUESTS.inc(result='hit')
+    return profile, etag
+
+
+async def aget_profile_version(user_id):
+    cache = _cache()
+    version = await cache.aget(_version_key(user_id))
+    if version is None:
+        version = time.time_ns()
+        if not await cache.aadd(_version_key(user_id), version, timeout=None):
+            version = await cache.aget(_version_key(user_id), version)
+    return version
+
+
+async def aget_profile(user, aserialize, if_none_match=None):
+    """Async version of get_profile(), aserialize(user) is a coroutine function."""
+    version = await aget_profile_version(user.pk)
+    etag = profile_etag(user.pk, version)
+    if if_none_match and etag in parse_etags(if_none_match):
+        PROFILE_CACHE_REQUESTS.inc(result='not_modified')
+        return None, etag
+
+    cache = _cache()
+    data_key = f'profile:data:{user.pk}:{version}'
+    profile = await cache.aget(data_key)
+    if profile is None:
+        PROFILE_CACHE_REQUESTS.inc(result='miss')
+        profile = await aserialize(user)
+        await cache.aset(data_key, profile, timeout=settings.PROFILE_CACHE_TIMEOUT)
+    else:
+        PROFILE_CACHE_REQUESTS.inc(result='hit')
+    return profile, etag
+
+
+async def ainvalidate_profiles(user_ids):
+    """Async version of invalidate_profiles() for code running outside of a transaction."""
+    version = time.time_ns()
+    user_ids = [user_id for user_id in user_ids if user_id is not None]
+    if user_ids:
+        keys = {_version_key(user_id) for user_id in user_ids} | {_list_bucket_key(user_id) for user_id in user_ids}
+        await _cache().aset_many({key: version for key in keys}, timeout=None)
+
+
+def invalidate_profiles(user_ids):
+    """Move the given users to a new profile version once the current transaction commits."""
+    user_ids = [user_id for user_id in user_ids if user_id is not None]
+    keys = {_version_key(user_id) for user_id in user_ids} | {_list_bucket_key(user_id) for user_id in user_ids}
+
+    def bump_versions():
+        version = time.time_ns()
+        _cache().set_many({key: version for key in keys}, timeout=None)
+
+    if keys:
+        transaction.on_commit(bump_versions)
+
+
+def invalidate_profile_list():
+    """Move the last page of the profile list to a new version once users are added and the transaction commits."""
+    transaction.on_commit(lambda: _cache().set(PROFILE_LIST_TAIL_KEY, time.time_ns(), timeout=None))
+
+
+async def ainvalidate_profile_list():
+    """Async version of invalidate_profile_list() for code running outside of a transaction."""
+    await _cache().aset(PROFILE_LIST_TAIL_KEY, time.time_ns(), timeout=None)
@@ -0,0 +1,141 @@
+import time
+from functools import wraps
+
+from django.conf import settings
+from django.core.cache import caches
+from django.http import JsonResponse
+from rest_framework.settings import api_settings
+from rest_framework.throttling import BaseThrottle
+
+from referral_system.phone_numbers import phone_number_key
+
+PERIODS = {'s': 1, 'm': 60, 'h': 60 * 60, 'd': 24 * 60 * 60}
+
+
+def parse_rate(rate):
+    """Parse a DRF style rate such as '5/min' into (limit, period in seconds)."""
+    limit, period = rate.split('/')
+    return int(limit), PERIODS[period[0]]
+
+
+class SlidingWindowRateLimiter:
+    """
+    Sliding window counter over the shared cache.
+    Every key costs two integers (the current and the previous fixed window), the previous window is weighted
+    by how much of it still overlaps the sliding window.
+    """
+
+    def __init__(self, rate, prefix='ratelimit', cache_alias=None):
+        self.limit, self.period = parse_rate(rate)
+        self.prefix = prefix
+        self.cache = caches[cache_alias or settings.RATE_LIMIT_CACHE]
+
+    def _keys(self, key, now):
+        window, offset = divmod(now, self.period)
+        return f'{self.prefix}:{key}:{int(window)}', f'{self.prefix}:{key}:{int(window) - 1}', offset
+
+    def _decide(self, current, previous, offset):
+        estimated = previous * (1 - offset / self.period) + current
+        if estimated <= self.limit:
+            return True, 0
+        return False, self.period - offset
+
+    def hit(self, key, now=None):
+        """Count one request for key. Returns (allowed, seconds until the next request could be allowed)."""
+        current_key, previous_key, offset = self._keys(key, time.time() if now is None else now)
+
+        # add() + incr() keeps the increment atomic on backends with native counters (Redis, memcached)
+        self.cache.add(current_key, 0, timeout=self.period * 2)
+        try:
+            current = self.cache.incr(current_key)
+        except ValueError:
+            # the key expired between add() and incr()
+            self.cache.add(current_key, 1, timeout=self.period * 2)
+            current = 1
+        previous = self.cache.get(previous_key, 0)
+        return self._decide(current, previous, offset)
+
+    async def ahit(self, key, now=None):
+        """Async version of hit() for async views."""
+        current_key, previous_key, offset = self._keys(key, time.time() if now is None else now)
+
+        await self.cache.aadd(current_key, 0, timeout=self.period * 2)
+        try:
+            current = await self.cache.aincr(current_key)
+        except ValueError:
+            await self.cache.aadd(current_key, 1, timeout=self.period * 2)
+            current = 1
+        previous = await self.cache.aget(previous_key, 0)
+        return self._decide(current, previous, offset)
+
+
+class SlidingWindowThrottle(BaseThrottle):
+    """
+    DRF throttle backed by SlidingWindowRateLimiter. The rate is taken from DEFAULT_THROTTLE_RATES[scope],
+    subclasses define what identifies a client.
+    """
+    scope = None
+
+    def __init__(self):
+        self.limiter = SlidingWindowRateLimiter(api_settings.DEFAULT_THROTTLE_RATES[self.scope], prefix=self.scope)
+        self.retry_after = None
+
+    def get_cache_key(self, request, view):
+        raise NotImplementedError
+
+    def allow_request(self, request, view):
+        key = self.get_cache_key(request, view)
+        if key is None:
+            return True
+        allowed, self.retry_after = self.limiter.hit(key)
+        return allowed
+
+    def wait(self):
+        return self.retry_after
+
+
+class IPRateThrottle(SlidingWindowThrottle):
+    scope = 'auth_ip'
+
+    def get_cache_key(self, request, view):
+        return self.get_ident(request)
+
+
+class PhoneNumberRateThrottle(SlidingWindowThrottle):
+    """Limits attempts per phone number, so a 4-digit code cannot be brute-forced from many addresses."""
+    scope = 'auth_phone'
+
+    def get_cache_key(self, request, view):
+        return phone_number_key(request.data.get('phone_number'))
+
+
+class GlobalRateThrottle(SlidingWindowThrottle):
+    """One counter shared by all clients, caps the total load the auth endpoints put on the database."""
+    scope = 'auth_global'
+
+    def get_cache_key(self, request, view):
+        return 'all'
+
+
+def rate_limit(rate, key, prefix=None):
+    """
+    Rate limit a plain Django view. key(request) returns the client identity, or None to skip limiting.
+    Limited requests get a 429 JSON response with a Retry-After header.
+    """
+    def decorator(view_func):
+        limiter = SlidingWindowRateLimiter(rate, prefix=prefix or f'ratelimit:{view_func.__qualname__}')
+
+        @wraps(view_func)
+        def wrapper(request, *args, **kwargs):
+            identity = key(request)
+            if identity is not None:
+                allowed, retry_after = limiter.hit(identity)
+                if not allowed:
+                    response = JsonResponse({'message': 'Too many requests'}, status=429)
+                    response['Retry-After'] = str(int(retry_after) + 1)
+                    return response
+            return view_func(request, *args, **kwargs)
+
+        return wrapper
+
+    return decorator
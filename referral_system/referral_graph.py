@@ -0,0 +1,93 @@
+from array import array
+from collections import Counter
+
+from django.db.models import Max
+
+from referral_system.models import User
+
+
+class UnionFind:
+    """Disjoint sets over the integers [0, size) with union by size and path halving, two machine words per element."""
+
+    def __init__(self, size):
+        self.parent = array('q', range(size))
+        self.size = array('q', [1]) * size
+
+    def find(self, x):
+        parent = self.parent
+        while parent[x] != x:
+            parent[x] = parent[parent[x]]
+            x = parent[x]
+        return x
+
+    def union(self, a, b):
+        """Merge the sets of a and b. Returns False if they already were one set."""
+        a, b = self.find(a), self.find(b)
+        if a == b:
+            return False
+        if self.size[a] < self.size[b]:
+            a, b = b, a
+        self.parent[b] = a
+        self.size[a] += self.size[b]
+        return True
+
+
+def analyze_referral_graph(min_size=50, min_per_hour=100.0, chunk_size=10000):
+    """
+    Label the connected components of the referral graph and yield the suspicious ones as dicts:
+    components with a cycle, and components of at least min_size users whose activations came in faster than
+    min_per_hour on average. Two passes over the referred users, memory is linear in the largest user id.
+    """
+    max_id = User.objects.aggregate(max_id=Max('id'))['max_id']
+    if max_id is None:
+        return
+    edges = User.objects.filter(referred_by__isnull=False).order_by()
+
+    components = UnionFind(max_id + 1)
+    cycles = []
+    for user_id, referrer_id in edges.values_list('id', 'referred_by_id').iterator(chunk_size=chunk_size):
+        if not components.union(user_id, referrer_id):
+            # every user has one referrer, so an edge inside a component closes a cycle
+            cycles.append(user_id)
+    cyclic = {components.find(user_id) for user_id in cycles}
+
+    stats = {}
+    referrals = Counter()
+    rows = edges.values_list('id', 'referred_by_id', 'activated_at').iterator(chunk_size=chunk_size)
+    for user_id, referrer_id, activated_at in rows:
+        root = components.find(user_id)
+        if components.size[root] < min_size and root not in cyclic:
+            continue
+        referrals[referrer_id] += 1
+        component = stats.setdefault(root, {'activations': 0, 'first': None, 'last': None, 'top_referrer': None})
+        component['activations'] += 1
+        if activated_at is not None:
+            component['first'] = min(component['first'] or activated_at, activated_at)
+            component['last'] = max(component['last'] or activated_at, activated_at)
+        top = component['top_referrer']
+        if top is None or referrals[referrer_id] > referrals[top]:
+            component['top_referrer'] = referrer_id
+
+    flagged = []
+    for root, component in stats.items():
+        per_hour = None
+        if component['first'] is not None:
+            # a burst within one minute counts as one minute
+            hours = max((component['last'] - component['first']).total_seconds() / 3600, 1 / 60)
+            per_hour = component['activations'] / hours
+        if root in cyclic or (per_hour is not None and per_hour >= min_per_hour):
+            flagged.append((root, component, per_hour))
+
+    phone_numbers = dict(User.objects.filter(pk__in=[component['top_referrer'] for _, component, _ in flagged])
+                         .values_list('pk', 'phone_number'))
+    for root, component, per_hour in sorted(flagged, key=lambda item: -components.size[item[0]]):
+        yield {
+            'size': components.size[root],
+            'cycle': root in cyclic,
+            'top_referrer': phone_numbers.get(component['top_referrer']),
+            'top_referrer_referrals': referrals[component['top_referrer']],
+            'activations': component['activations'],
+            'first_activation': component['first'].isoformat() if component['first'] else None,
+            'last_activation': component['last'].isoformat() if component['last'] else None,
+            'activations_per_hour': round(per_hour, 1) if per_hour is not None else None,
+        }
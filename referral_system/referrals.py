@@ -0,0 +1,316 @@
+import logging
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import connection, connections, transaction
+from django.db.models import Count, F
+from django.db.models.functions import TruncDate
+from django.utils import timezone
+
+from referral_system.code_store import get_code_store
+from referral_system.invite_codes import parse_invite_code
+from referral_system.models import ReferralClosure, ReferralStats, User
+from referral_system.phone_numbers import phone_number_key
+from referral_system.profile_cache import invalidate_profiles
+
+logger = logging.getLogger(__name__)
+
+# Keeps the IN (...) list well below the bind-parameter limits of the supported backends
+REFERRALS_LOOKUP_BATCH_SIZE = 1000
+
+
+def get_referrals_map(users):
+    """
+    Resolve the referrals of many users with one grouped query per batch of users.
+    Returns {referrer_id: [phone_number, ...]} with the referrals in primary key order.
+    """
+    return get_referrals_map_for_ids([user.pk for user in users])
+
+
+def get_referrals_map_for_ids(user_ids):
+    """get_referrals_map() for primary keys, e.g. of .values() rows."""
+    referrals_map = defaultdict(list)
+    for start in range(0, len(user_ids), REFERRALS_LOOKUP_BATCH_SIZE):
+        batch = user_ids[start:start + REFERRALS_LOOKUP_BATCH_SIZE]
+        rows = (
+            User.objects
+            .filter(referred_by_id__in=batch)
+            .order_by('pk')
+            .values_list('referred_by_id', 'phone_number')
+        )
+        for referred_by_id, phone_number in rows:
+            referrals_map[referred_by_id].append(phone_number)
+    return referrals_map
+
+
+def _closure_table():
+    return connection.ops.quote_name(ReferralClosure._meta.db_table)
+
+
+def link_referral_closure(user_id, referrer_id):
+    """
+    Add the closure rows for user_id (with its own subtree) becoming a referral of referrer_id:
+    every ancestor of the referrer, and the referrer itself, becomes an ancestor of the whole subtree.
+    """
+    table = _closure_table()
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f'INSERT INTO {table} (ancestor_id, descendant_id, depth) '
+            f'SELECT a.ancestor_id, d.descendant_id, a.depth + d.depth + 1 '
+            f'FROM (SELECT %s AS ancestor_id, 0 AS depth '
+            f'UNION ALL SELECT ancestor_id, depth FROM {table} WHERE descendant_id = %s) a '
+            f'CROSS JOIN (SELECT %s AS descendant_id, 0 AS depth '
+            f'UNION ALL SELECT descendant_id, depth FROM {table} WHERE ancestor_id = %s) d',
+            [referrer_id, referrer_id, user_id, user_id],
+        )
+
+
+def unlink_referral_closure(user_ids, referrer_id):
+    """Remove the closure rows that connect the subtrees of user_ids to referrer_id and its ancestors."""
+    if referrer_id is None or not user_ids:
+        return
+    table = _closure_table()
+    placeholders = ', '.join(['%s'] * len(user_ids))
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f'DELETE FROM {table} '
+            f'WHERE (ancestor_id = %s OR ancestor_id IN (SELECT ancestor_id FROM {table} WHERE descendant_id = %s)) '
+            f'AND (descendant_id IN ({placeholders}) '
+            f'OR descendant_id IN (SELECT descendant_id FROM {table} WHERE ancestor_id IN ({placeholders})))',
+            [referrer_id, referrer_id, *user_ids, *user_ids],
+        )
+
+
+def rebuild_referral_closure(max_depth=100):
+    """Refill the closure table from referred_by with one recursive INSERT. Returns the number of rows."""
+    table = _closure_table()
+    user_table = connection.ops.quote_name(User._meta.db_table)
+    with transaction.atomic():
+        ReferralClosure.objects.all().delete()
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f'WITH RECURSIVE pairs (ancestor_id, descendant_id, depth) AS ('
+                f'SELECT referred_by_id, id, 1 FROM {user_table} WHERE referred_by_id IS NOT NULL '
+                f'UNION ALL '
+                f'SELECT pairs.ancestor_id, u.id, pairs.depth + 1 '
+                f'FROM {user_table} u JOIN pairs ON u.referred_by_id = pairs.descendant_id WHERE pairs.depth < %s'
+                f') INSERT INTO {table} (ancestor_id, descendant_id, depth) '
+                # a referral cycle would repeat pairs, keep the shortest distance and no self pairs
+                f'SELECT ancestor_id, descendant_id, MIN(depth) FROM pairs WHERE ancestor_id <> descendant_id '
+                f'GROUP BY ancestor_id, descendant_id',
+                [max_depth],
+            )
+    # cursor.rowcount is not reported for INSERT ... SELECT with a CTE by every backend
+    return ReferralClosure.objects.count()
+
+
+class ReferralCycleError(Exception):
+    """The activation would make a user a referral of one of their own referrals."""
+
+
+class ReferralAlreadyActivatedError(Exception):
+    """The user has already activated a referral code, possibly in a concurrent request."""
+
+
+def activate_referral(user, referrer):
+    """
+    Attach the referrer's invite code to user and bump the referrer's counter in one transaction.
+    Raises ReferralCycleError if user is the referrer's referrer at any level and ReferralAlreadyActivatedError
+    if the user has activated a code in the meantime: user may be a stale instance, the database row decides.
+    """
+    with transaction.atomic():
+        # Locking both rows serializes two users activating each other's codes at the same time
+        locked = dict(User.objects.select_for_update().filter(pk__in=(user.pk, referrer.pk)).order_by('pk')
+                      .values_list('pk', 'activated_code'))
+        # re-read under the lock, user may be a stale instance of a row activated by a concurrent request
+        if locked.get(user.pk):
+            raise ReferralAlreadyActivatedError(f'{user} has already activated a referral code')
+        if User.objects.has_referral_ancestor(referrer.pk, user.pk, settings.REFERRAL_CYCLE_CHECK_DEPTH):
+            raise ReferralCycleError(f'{user} is already a referrer of {referrer}')
+        activated_at = timezone.now()
+        updated = User.objects.filter(pk=user.pk, activated_code__isnull=True).update(
+            activated_code=referrer.invite_code, referred_by=referrer, activated_at=activated_at)
+        if updated != 1:
+            raise ReferralAlreadyActivatedError(f'{user} has already activated a referral code')
+        user.activated_code, user.referred_by, user.activated_at = referrer.invite_code, referrer, activated_at
+        User.objects.filter(pk=referrer.pk).update(referral_count=F('referral_count') + 1)
+        if settings.REFERRAL_CLOSURE_TABLE:
+            link_referral_closure(user.pk, referrer.pk)
+        invalidate_profiles([user.pk, referrer.pk])
+
+
+def _creates_cycle(user_id, referrer_id, uplines, new_referrers, max_depth):
+    """
+    Whether user_id is referrer_id or one of its first max_depth referrers, following both the stored referrals
+    (uplines, as returned by User.objects.referral_uplines) and the activations made earlier in the same batch.
+    """
+    node, depth = referrer_id, 0
+    while node is not None and depth <= max_depth:
+        chain = [node, *uplines.get(node, ())]
+        if user_id in chain:
+            return True
+        depth += len(chain)
+        # the top of a stored chain may have got a referrer of its own earlier in the batch
+        node = new_referrers.get(chain[-1])
+    return False
+
+
+def activate_referrals_in_bulk(pairs, chunk_size=None):
+    """
+    Activate a batch of (phone_number, activated_code) pairs under the rules of activate_referral, in one transaction.
+    Each chunk of chunk_size pairs costs one IN query for the users, one for the codes and one for the uplines
+    of the referrers. The activations are written at the end with one UPDATE per referrer (and per chunk_size
+    of its new referrals) and one per distinct counter increment, so a partner batch sharing a few codes
+    is a handful of statements.
+    Returns a status per pair, in order: 'activated', 'user_not_found', 'already_activated', 'code_not_found',
+    'self_referral' or 'cycle'.
+    """
+    chunk_size = chunk_size or settings.REFERRAL_BULK_CHUNK_SIZE
+    max_depth = settings.REFERRAL_CYCLE_CHECK_DEPTH
+    # a number stored before normalization matches exactly as given, any other one by its canonical form
+    pairs = [(phone_number, phone_number_key(phone_number), code) for phone_number, code in pairs]
+    now = timezone.now()
+    # one instance per row for the whole batch, so a user activated in one chunk is seen as such in the next ones
+    rows = {}
+    uplines = {}
+    new_referrers = {}
+    statuses = []
+    with transaction.atomic():
+        for start in range(0, len(pairs), chunk_size):
+            chunk = pairs[start:start + chunk_size]
+            users = User.objects.select_for_update().filter(
+                phone_number__in={number for phone_number, key, _ in chunk for number in (phone_number, key)}
+            ).order_by('pk')
+            by_phone_number = {user.phone_number: rows.setdefault(user.pk, user) for user in users}
+            referrers = User.objects.select_for_update().filter(
+                invite_code__in={code for _, _, code in chunk if parse_invite_code(code) is not None}).order_by('pk')
+            by_code = {referrer.invite_code: rows.setdefault(referrer.pk, referrer) for referrer in referrers}
+            uplines.update(User.objects.referral_uplines([referrer.pk for referrer in by_code.values()], max_depth))
+
+            for phone_number, key, code in chunk:
+                user = by_phone_number.get(phone_number) or by_phone_number.get(key)
+                referrer = by_code.get(code)
+                if user is None:
+                    statuses.append('user_not_found')
+                elif user.activated_code:
+                    statuses.append('already_activated')
+                elif referrer is None:
+                    statuses.append('code_not_found')
+                elif referrer.pk == user.pk:
+                    statuses.append('self_referral')
+                elif _creates_cycle(user.pk, referrer.pk, uplines, new_referrers, max_depth):
+                    statuses.append('cycle')
+                else:
+                    # only in memory, for the pairs after this one, the rows are written below
+                    user.activated_code = referrer.invite_code
+                    new_referrers[user.pk] = referrer.pk
+                    statuses.append('activated')
+
+        referrals = defaultdict(list)
+        for user_id, referrer_id in new_referrers.items():
+            referrals[referrer_id].append(user_id)
+        referrers_by_count = defaultdict(list)
+        for referrer_id, user_ids in referrals.items():
+            referrers_by_count[len(user_ids)].append(referrer_id)
+            for start in range(0, len(user_ids), chunk_size):
+                User.objects.filter(pk__in=user_ids[start:start + chunk_size]).update(
+                    activated_code=rows[referrer_id].invite_code, referred_by_id=referrer_id, activated_at=now)
+        for count, referrer_ids in referrers_by_count.items():
+            for start in range(0, len(referrer_ids), chunk_size):
+                User.objects.filter(pk__in=referrer_ids[start:start + chunk_size]).update(
+                    referral_count=F('referral_count') + count)
+        if settings.REFERRAL_CLOSURE_TABLE:
+            # in activation order, each link sees the closure rows of the previous ones
+            for user_id, referrer_id in new_referrers.items():
+                link_referral_closure(user_id, referrer_id)
+        invalidate_profiles([*new_referrers, *referrals])
+    return statuses
+
+
+def delete_user(user):
+    """
+    Delete user, unlink all of its referrals with one UPDATE and decrement its referrer's counter,
+    all in one transaction. The number of queries does not depend on the number of referrals.
+    """
+    with transaction.atomic():
+        if user.referred_by_id:
+            User.objects.filter(pk=user.referred_by_id).update(referral_count=F('referral_count') - 1)
+        if settings.REFERRAL_CLOSURE_TABLE:
+            # the rows of user itself go with the CASCADE below, the pairs passing through user are removed here
+            unlink_referral_closure([user.pk], user.referred_by_id)
+        referrals = User.objects.filter(referred_by=user)
+        invalidate_profiles([user.pk, user.referred_by_id, *referrals.values_list('id', flat=True)])
+        # referred_by is cleared here as well, so the SET_NULL pass of user.delete() has no rows left to touch
+        referrals.update(activated_code=None, activated_at=None, referred_by=None)
+        get_code_store().discard(user.phone_number)
+        user.delete()
+
+
+def unlink_referrals_in_chunks(user_id, chunk_size):
+    """Unlink the referrals of user_id chunk_size rows at a time, each chunk in its own short transaction."""
+    referrals = User.objects.filter(referred_by_id=user_id)
+    while ids := list(referrals.values_list('id', flat=True)[:chunk_size]):
+        with transaction.atomic():
+            User.objects.filter(id__in=ids).update(activated_code=None, activated_at=None, referred_by=None)
+            if settings.REFERRAL_CLOSURE_TABLE:
+                unlink_referral_closure(ids, user_id)
+            invalidate_profiles(ids)
+
+
+def _delete_user_in_chunks(user, chunk_size):
+    try:
+        unlink_referrals_in_chunks(user.pk, chunk_size)
+        delete_user(user)
+    finally:
+        connections.close_all()
+
+
+_background_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='referrals')
+
+
+def delete_user_in_background(user, chunk_size=None):
+    """
+    Delete a user with a very large number of referrals without holding row locks on all of them at once:
+    the referrals are unlinked in chunks by a background worker, then the user is deleted.
+    Returns a Future that resolves when the user is gone. A failure is logged, the client got its 202 long ago.
+    """
+    future = _background_executor.submit(_delete_user_in_chunks, user,
+                                         chunk_size or settings.REFERRAL_UNLINK_CHUNK_SIZE)
+    future.add_done_callback(lambda done: _log_background_failure(done, user))
+    return future
+
+
+def _log_background_failure(future, user):
+    exc = future.exception()
+    if exc is not None:
+        logger.error('Failed to delete user %s in the background', user.pk, exc_info=exc)
+
+
+def refresh_referral_stats(days=None):
+    """
+    Rebuild ReferralStats from the activation timestamps.
+    With days set only the last `days` days are recomputed, otherwise the whole table is rebuilt.
+    """
+    activations = User.objects.filter(referred_by__isnull=False, activated_at__isnull=False)
+    stats = ReferralStats.objects.all()
+    if days is not None:
+        since = timezone.localdate() - timedelta(days=days - 1)
+        activations = activations.filter(activated_at__date__gte=since)
+        stats = stats.filter(date__gte=since)
+
+    rows = (
+        activations
+        .annotate(date=TruncDate('activated_at'))
+        .order_by()
+        .values('date', 'referred_by')
+        .annotate(referrals=Count('pk'))
+    )
+    with transaction.atomic():
+        stats.delete()
+        ReferralStats.objects.bulk_create(
+            (ReferralStats(date=row['date'], referrer_id=row['referred_by'], referrals=row['referrals'])
+             for row in rows.iterator()),
+            batch_size=REFERRALS_LOOKUP_BATCH_SIZE,
+        )
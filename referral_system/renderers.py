@@ -0,0 +1,50 @@
+"""
+Fast renderers picked by content negotiation (the Accept header or ?format=): orjson for JSON and MessagePack.
+Both packages are optional: without orjson ORJSONRenderer is the stock JSONRenderer, and MessagePackRenderer
+is only listed in DEFAULT_RENDERER_CLASSES when msgpack is installed.
+"""
+from rest_framework.renderers import BaseRenderer, JSONRenderer
+from rest_framework.utils.encoders import JSONEncoder
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+# Types orjson and msgpack do not handle natively (dates included, to keep DRF's format) are converted by DRF
+_encode_default = JSONEncoder().default
+
+
+class ORJSONRenderer(JSONRenderer):
+    """
+    JSONRenderer encoding with orjson. The output is byte for byte the same as JSONRenderer's for this API's data
+    (strings, integers, lists and dicts, dates through DRF's encoder); indented output, non-compact or ASCII-only
+    JSON settings and setups without orjson fall back to JSONRenderer.
+    """
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if (orjson is None or data is None or not self.compact or self.ensure_ascii
+                or self.get_indent(accepted_media_type, renderer_context or {}) is not None):
+            return super().render(data, accepted_media_type, renderer_context)
+        ret = orjson.dumps(data, default=_encode_default,
+                           option=orjson.OPT_PASSTHROUGH_DATETIME | orjson.OPT_NON_STR_KEYS)
+        # JSONRenderer escapes the line separators that are not valid inside JavaScript strings
+        return ret.replace(b'\xe2\x80\xa8', b'\\u2028').replace(b'\xe2\x80\xa9', b'\\u2029')
+
+
+class MessagePackRenderer(BaseRenderer):
+    """The same data as the JSON responses, MessagePack encoded (application/msgpack)."""
+    media_type = 'application/msgpack'
+    format = 'msgpack'
+    charset = None
+    render_style = 'binary'
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if data is None:
+            return b''
+        return msgpack.packb(data, default=_encode_default, use_bin_type=True)
@@ -1,9 +1,10 @@
 from .utils.serializers import PhoneNumberSerializerMixin
 
-from django.db.models import Q
+from django.conf import settings
 from rest_framework import serializers
 
 from referral_system.models import User, UserPhoneCode
+from referral_system.referrals import get_referrals_map, get_referrals_map_for_ids
 
 
 class UserSerializer(serializers.ModelSerializer, PhoneNumberSerializerMixin):
@@ -26,10 +27,21 @@ class UserPhoneCodeSerializer(serializers.ModelSerializer, PhoneNumberSerializer
         help_text="The four-digit authorization code that was sent to the phone number\n"
                   "example='4985'"
     )
+    token = serializers.BooleanField(
+        default=False,
+        help_text="Return signed access and refresh tokens instead of starting a session"
+    )
 
     class Meta:
         model = UserPhoneCode
-        fields = ("phone_number", "code",)
+        fields = ("phone_number", "code", "token",)
+
+
+class UserProfileListSerializer(serializers.ListSerializer):
+    def to_representation(self, data):
+        users = list(data.all() if hasattr(data, 'all') else data)
+        self.context['referrals'] = get_referrals_map(users)
+        return super().to_representation(users)
 
 
 class UserProfileSerializer(serializers.ModelSerializer, PhoneNumberSerializerMixin):
@@ -53,10 +65,46 @@ class UserProfileSerializer(serializers.ModelSerializer, PhoneNumberSerializerMi
     class Meta:
         model = User
         fields = ("phone_number", "invite_code", "activated_code", "referrals")
+        list_serializer_class = UserProfileListSerializer
 
     def get_referrals(self, obj):
-        users = User.objects.filter(Q(activated_code=obj.invite_code) & ~Q(phone_number=obj.phone_number))
-        return [user.phone_number for user in users]
+        referrals_map = self.context.get('referrals')
+        if referrals_map is not None:
+            return referrals_map.get(obj.pk, [])
+        return list(obj.referrals.order_by('pk').values_list('phone_number', flat=True))
+
+
+# Read-only fast path of UserProfileSerializer for the hot endpoints: the same output, built with plain functions
+# from .values(*PROFILE_FIELDS) rows instead of model instances and serializer fields
+PROFILE_FIELDS = ('id', 'phone_number', 'invite_code', 'activated_code')
+
+
+def profile_to_dict(row, referrals):
+    return {
+        'phone_number': row['phone_number'],
+        'invite_code': row['invite_code'],
+        'activated_code': row['activated_code'],
+        'referrals': referrals,
+    }
+
+
+def serialize_profile_rows(rows):
+    """UserProfileSerializer(users, many=True).data for .values(*PROFILE_FIELDS) rows, one referrals query per batch."""
+    rows = list(rows)
+    referrals_map = get_referrals_map_for_ids([row['id'] for row in rows])
+    return [profile_to_dict(row, referrals_map.get(row['id'], [])) for row in rows]
+
+
+def serialize_user_profile(user, referrals=None):
+    """UserProfileSerializer(user).data for a single user; referrals are queried unless given."""
+    if referrals is None:
+        referrals = list(user.referrals.order_by('pk').values_list('phone_number', flat=True))
+    return {
+        'phone_number': user.phone_number,
+        'invite_code': user.invite_code,
+        'activated_code': user.activated_code,
+        'referrals': referrals,
+    }
 
 
 class AddReferralSerializer(serializers.ModelSerializer):
@@ -68,3 +116,46 @@ class AddReferralSerializer(serializers.ModelSerializer):
     class Meta:
         model = User
         fields = ("activated_code",)
+
+
+class BulkReferralItemSerializer(serializers.Serializer):
+    phone_number = serializers.CharField(max_length=15)
+    activated_code = serializers.CharField(max_length=6)
+
+
+class BulkReferralSerializer(serializers.Serializer):
+    items = BulkReferralItemSerializer(many=True, allow_empty=False, max_length=settings.REFERRAL_BULK_MAX_ITEMS)
+    chunk_size = serializers.IntegerField(min_value=1, max_value=settings.REFERRAL_BULK_MAX_ITEMS, required=False)
+
+
+class TopReferrerSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = User
+        fields = ("phone_number", "invite_code", "referral_count")
+
+
+class ReferralStatsSerializer(serializers.Serializer):
+    date = serializers.DateField()
+    referrals = serializers.IntegerField()
+
+
+class ReferralStatsQuerySerializer(serializers.Serializer):
+    top = serializers.IntegerField(min_value=1, max_value=settings.REFERRAL_STATS_MAX_ROWS, default=10)
+    days = serializers.IntegerField(min_value=1, max_value=settings.REFERRAL_STATS_MAX_ROWS, default=30)
+    invite_code = serializers.CharField(max_length=6, required=False)
+
+
+class RefreshTokenSerializer(serializers.Serializer):
+    refresh = serializers.CharField(help_text="A refresh token returned by /confirm/ or /token/refresh/")
+
+
+class RevokeTokenSerializer(serializers.Serializer):
+    refresh = serializers.CharField(required=False, help_text="A refresh token to revoke along with the access token")
+
+
+class ReferralTreeQuerySerializer(serializers.Serializer):
+    depth = serializers.IntegerField(min_value=1, max_value=settings.REFERRAL_TREE_MAX_DEPTH,
+                                     default=settings.REFERRAL_TREE_MAX_DEPTH)
+    max_nodes = serializers.IntegerField(min_value=1, max_value=settings.REFERRAL_TREE_MAX_NODES,
+                                         default=settings.REFERRAL_TREE_MAX_NODES)
+    stream = serializers.BooleanField(default=False)
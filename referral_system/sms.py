@@ -0,0 +1,147 @@
+import logging
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+from django.utils.module_loading import import_string
+
+from referral_system.metrics import Counter, Gauge, Histogram
+
+logger = logging.getLogger(__name__)
+
+CODE_DELIVERY_QUEUE_DEPTH = Gauge(
+    "referral_code_delivery_queue_depth", "Authorization codes waiting for a delivery worker")
+CODE_DELIVERY_LATENCY = Histogram(
+    "referral_code_delivery_latency_seconds", "Time from enqueueing an authorization code to its delivery")
+CODE_DELIVERY_TOTAL = Counter(
+    "referral_code_delivery_total", "Authorization code deliveries by outcome", labelnames=("outcome",))
+
+
+class FakeSMSGateway:
+    """
+    Local stand-in for an SMS provider, for development and tests. The latest delivered messages are kept
+    in FakeSMSGateway.outbox.
+    """
+    outbox = deque(maxlen=1000)
+
+    def __init__(self, latency=0):
+        self.latency = latency
+
+    def send_sms(self, phone_number, message):
+        if self.latency:
+            time.sleep(self.latency)
+        self.outbox.append((phone_number, message))
+
+
+class LoggingSMSGateway:
+    """Writes messages to the log instead of sending them, the default until a real SMS provider is configured."""
+
+    def send_sms(self, phone_number, message):
+        logger.info("SMS to %s: %s", phone_number, message)
+
+
+class CodeDeliveryQueueFull(Exception):
+    pass
+
+
+class BaseCodeDelivery:
+    """Delivers authorization codes through an SMS gateway. Subclasses decide where the sending happens."""
+
+    def __init__(self, gateway):
+        self.gateway = gateway
+
+    def send(self, phone_number, code):
+        raise NotImplementedError
+
+    async def asend(self, phone_number, code):
+        """Send from async code without blocking the event loop."""
+        return await sync_to_async(self.send, thread_sensitive=False)(phone_number, code)
+
+    def close(self, wait=True):
+        pass
+
+    def deliver(self, phone_number, code, enqueued_at):
+        try:
+            self.gateway.send_sms(phone_number, f"Your authorization code: {code}")
+        except Exception:
+            CODE_DELIVERY_TOTAL.inc(outcome="failed")
+            logger.exception("Failed to deliver the authorization code to %s", phone_number)
+            raise
+        CODE_DELIVERY_TOTAL.inc(outcome="sent")
+        CODE_DELIVERY_LATENCY.observe(time.monotonic() - enqueued_at)
+
+
+class SyncCodeDelivery(BaseCodeDelivery):
+    """Sends the code in the calling thread."""
+
+    def send(self, phone_number, code):
+        future = Future()
+        try:
+            future.set_result(self.deliver(phone_number, code, time.monotonic()))
+        except Exception as exc:
+            future.set_exception(exc)
+        return future
+
+
+class ThreadPoolCodeDelivery(BaseCodeDelivery):
+    """
+    Queues the code for a pool of worker threads and returns immediately. At most max_queue codes wait
+    for a worker, the ones above are dropped (counted as outcome="dropped") instead of piling up in memory.
+    """
+
+    def __init__(self, gateway, max_workers=8, max_queue=1000):
+        super().__init__(gateway)
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="code-delivery")
+        self.queue_slots = threading.BoundedSemaphore(max_queue)
+
+    def send(self, phone_number, code):
+        if not self.queue_slots.acquire(blocking=False):
+            CODE_DELIVERY_TOTAL.inc(outcome="dropped")
+            logger.warning("Code delivery queue is full, the authorization code to %s is dropped", phone_number)
+            future = Future()
+            future.set_exception(CodeDeliveryQueueFull())
+            return future
+        CODE_DELIVERY_QUEUE_DEPTH.inc()
+        return self.executor.submit(self._run, phone_number, code, time.monotonic())
+
+    async def asend(self, phone_number, code):
+        # submitting to the pool never blocks, the delivery itself runs in a worker thread
+        return self.send(phone_number, code)
+
+    def _run(self, phone_number, code, enqueued_at):
+        CODE_DELIVERY_QUEUE_DEPTH.dec()
+        self.queue_slots.release()
+        return self.deliver(phone_number, code, enqueued_at)
+
+    def close(self, wait=True):
+        self.executor.shutdown(wait=wait)
+
+
+_code_delivery = None
+_code_delivery_lock = threading.Lock()
+
+
+def get_code_delivery():
+    """Return the process-wide code delivery backend configured by CODE_DELIVERY_BACKEND and SMS_GATEWAY."""
+    global _code_delivery
+    with _code_delivery_lock:
+        if _code_delivery is None:
+            gateway = import_string(settings.SMS_GATEWAY)(**settings.SMS_GATEWAY_OPTIONS)
+            backend = import_string(settings.CODE_DELIVERY_BACKEND)
+            _code_delivery = backend(gateway, **settings.CODE_DELIVERY_OPTIONS)
+        return _code_delivery
+
+
+@receiver(setting_changed)
+def reset_code_delivery(setting, **kwargs):
+    global _code_delivery
+    if setting in ("CODE_DELIVERY_BACKEND", "CODE_DELIVERY_OPTIONS", "SMS_GATEWAY", "SMS_GATEWAY_OPTIONS"):
+        with _code_delivery_lock:
+            if _code_delivery is not None:
+                _code_delivery.close()
+            _code_delivery = None
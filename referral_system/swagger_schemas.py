@@ -31,6 +31,32 @@ REFERRALS_SCHEMA = openapi.Schema(
     example=["+7222142", "89223432"]
 )
 
+# Query parameters
+ALL_USERS_QUERY_PARAMETERS = [
+    openapi.Parameter("cursor", openapi.IN_QUERY, type=openapi.TYPE_STRING,
+                      description="Opaque cursor taken from the next/previous link of the previous page"),
+    openapi.Parameter("page_size", openapi.IN_QUERY, type=openapi.TYPE_INTEGER,
+                      description="Number of profiles per page"),
+    openapi.Parameter("stream", openapi.IN_QUERY, type=openapi.TYPE_BOOLEAN,
+                      description="Export all profiles as NDJSON (one profile per line) instead of a page"),
+]
+REFERRAL_STATS_QUERY_PARAMETERS = [
+    openapi.Parameter("top", openapi.IN_QUERY, type=openapi.TYPE_INTEGER,
+                      description="Number of top referrers to return (10 by default)"),
+    openapi.Parameter("days", openapi.IN_QUERY, type=openapi.TYPE_INTEGER,
+                      description="Number of days of activation history to return (30 by default)"),
+    openapi.Parameter("invite_code", openapi.IN_QUERY, type=openapi.TYPE_STRING,
+                      description="Only count the activations of this referrer's invite code"),
+]
+REFERRAL_TREE_QUERY_PARAMETERS = [
+    openapi.Parameter("depth", openapi.IN_QUERY, type=openapi.TYPE_INTEGER,
+                      description="Number of referral levels to return (REFERRAL_TREE_MAX_DEPTH at most)"),
+    openapi.Parameter("max_nodes", openapi.IN_QUERY, type=openapi.TYPE_INTEGER,
+                      description="Maximum number of referrals to return (REFERRAL_TREE_MAX_NODES at most)"),
+    openapi.Parameter("stream", openapi.IN_QUERY, type=openapi.TYPE_BOOLEAN,
+                      description="Stream the referrals as NDJSON, one per line, followed by a summary line"),
+]
+
 # Request bodies
 AUTH_CODE_REQUEST_BODY = openapi.Schema(
     type=openapi.TYPE_OBJECT,
@@ -40,11 +66,37 @@ AUTH_CODE_REQUEST_BODY = openapi.Schema(
     },
 )
 
+TOKEN_SCHEMA = openapi.Schema(
+    type=openapi.TYPE_STRING,
+    description="A signed token",
+    example="eyJ1aWQiOjEsInR5cCI6ImFjY2VzcyJ9:1uf2Kq:kV4...",
+)
+
 CONFIRM_CODE_REQUEST_BODY = openapi.Schema(
     type=openapi.TYPE_OBJECT,
     properties={
         "phone_number": PHONE_NUMBER_SCHEMA,
         "code": CODE_SCHEMA,
+        "token": openapi.Schema(
+            type=openapi.TYPE_BOOLEAN,
+            description="Return signed access and refresh tokens instead of starting a session",
+            default=False,
+        ),
+    }
+)
+
+REFRESH_TOKEN_REQUEST_BODY = openapi.Schema(
+    type=openapi.TYPE_OBJECT,
+    required=["refresh"],
+    properties={
+        "refresh": TOKEN_SCHEMA,
+    }
+)
+
+REVOKE_TOKEN_REQUEST_BODY = openapi.Schema(
+    type=openapi.TYPE_OBJECT,
+    properties={
+        "refresh": TOKEN_SCHEMA,
     }
 )
 
@@ -56,6 +108,25 @@ ADD_REFERRAL_REQUEST_BODY = openapi.Schema(
     }
 )
 
+BULK_REFERRAL_ITEM_SCHEMA = openapi.Schema(
+    type=openapi.TYPE_OBJECT,
+    properties={
+        "phone_number": PHONE_NUMBER_SCHEMA,
+        "activated_code": ACTIVATED_CODE_SCHEMA,
+    }
+)
+
+BULK_REFERRAL_REQUEST_BODY = openapi.Schema(
+    type=openapi.TYPE_OBJECT,
+    required=["items"],
+    properties={
+        "items": openapi.Schema(type=openapi.TYPE_ARRAY, items=BULK_REFERRAL_ITEM_SCHEMA,
+                                description="Users and the referral codes to activate for them"),
+        "chunk_size": openapi.Schema(type=openapi.TYPE_INTEGER, example=1000,
+                                     description="Pairs looked up per query, REFERRAL_BULK_CHUNK_SIZE by default"),
+    }
+)
+
 # Response schemas
 CODE_CREATED_RESPONSE = openapi.Response(
     description="Code created and sent to phone number",
@@ -69,12 +140,27 @@ CODE_CREATED_RESPONSE = openapi.Response(
 )
 
 USER_AUTHENTICATED_RESPONSE = openapi.Response(
-    description="Successful authorization",
+    description="Successful authorization. access, refresh and expires_in are only returned with token=true",
     schema=openapi.Schema(
         type=openapi.TYPE_OBJECT,
         properties={
             "message": openapi.Schema(type=openapi.TYPE_STRING, example="User authenticated"),
             "new_user": openapi.Schema(type=openapi.TYPE_BOOLEAN),
+            "access": TOKEN_SCHEMA,
+            "refresh": TOKEN_SCHEMA,
+            "expires_in": openapi.Schema(type=openapi.TYPE_INTEGER, example=900),
+        }
+    )
+)
+
+TOKENS_RESPONSE = openapi.Response(
+    description="A new token pair",
+    schema=openapi.Schema(
+        type=openapi.TYPE_OBJECT,
+        properties={
+            "access": TOKEN_SCHEMA,
+            "refresh": TOKEN_SCHEMA,
+            "expires_in": openapi.Schema(type=openapi.TYPE_INTEGER, example=900),
         }
     )
 )
@@ -93,18 +179,50 @@ USER_PROFILE_RESPONSE_SCHEMA = openapi.Response(
 )
 
 ALL_USERS_RESPONSE_SCHEMA = openapi.Response(
-    description="All user profiles",
+    description="A page of user profiles",
     schema=openapi.Schema(
-        type=openapi.TYPE_ARRAY,
-        items=openapi.Schema(
-            type=openapi.TYPE_OBJECT,
-            properties={
-                "phone_number": PHONE_NUMBER_SCHEMA,
-                "invite_code": INVITE_CODE_SCHEMA,
-                "activated_code": ACTIVATED_CODE_SCHEMA,
-                "referrals": REFERRALS_SCHEMA,
-            }
-        )
+        type=openapi.TYPE_OBJECT,
+        properties={
+            "next": openapi.Schema(type=openapi.TYPE_STRING, format=openapi.FORMAT_URI, x_nullable=True),
+            "previous": openapi.Schema(type=openapi.TYPE_STRING, format=openapi.FORMAT_URI, x_nullable=True),
+            "results": openapi.Schema(
+                type=openapi.TYPE_ARRAY,
+                items=openapi.Schema(
+                    type=openapi.TYPE_OBJECT,
+                    properties={
+                        "phone_number": PHONE_NUMBER_SCHEMA,
+                        "invite_code": INVITE_CODE_SCHEMA,
+                        "activated_code": ACTIVATED_CODE_SCHEMA,
+                        "referrals": REFERRALS_SCHEMA,
+                    }
+                )
+            ),
+        }
+    )
+)
+
+REFERRAL_TREE_RESPONSE = openapi.Response(
+    description="The referrals of the user down to the requested depth, level by level",
+    schema=openapi.Schema(
+        type=openapi.TYPE_OBJECT,
+        properties={
+            "nodes": openapi.Schema(
+                type=openapi.TYPE_ARRAY,
+                items=openapi.Schema(
+                    type=openapi.TYPE_OBJECT,
+                    properties={
+                        "phone_number": PHONE_NUMBER_SCHEMA,
+                        "invite_code": INVITE_CODE_SCHEMA,
+                        "parent": PHONE_NUMBER_SCHEMA,
+                        "depth": openapi.Schema(type=openapi.TYPE_INTEGER, example=1),
+                    }
+                )
+            ),
+            "levels": openapi.Schema(type=openapi.TYPE_OBJECT, description="Number of referrals per level",
+                                     example={"1": 3, "2": 7}),
+            "truncated": openapi.Schema(type=openapi.TYPE_BOOLEAN,
+                                        description="max_nodes was reached, deeper or later referrals are missing"),
+        }
     )
 )
 
@@ -127,3 +245,70 @@ USER_DELETED_RESPONSE = openapi.Response(
         }
     )
 )
+
+USER_DELETION_SCHEDULED_RESPONSE = openapi.Response(
+    description="The user has too many referrals to be deleted in one request, "
+                "referrals are unlinked in the background and the user is deleted afterwards",
+    schema=openapi.Schema(
+        type=openapi.TYPE_OBJECT,
+        properties={
+            "message": openapi.Schema(type=openapi.TYPE_STRING, example="User deletion scheduled"),
+        }
+    )
+)
+
+REFERRAL_STATS_RESPONSE = openapi.Response(
+    description="Referral statistics",
+    schema=openapi.Schema(
+        type=openapi.TYPE_OBJECT,
+        properties={
+            "top_referrers": openapi.Schema(
+                type=openapi.TYPE_ARRAY,
+                items=openapi.Schema(
+                    type=openapi.TYPE_OBJECT,
+                    properties={
+                        "phone_number": PHONE_NUMBER_SCHEMA,
+                        "invite_code": INVITE_CODE_SCHEMA,
+                        "referral_count": openapi.Schema(type=openapi.TYPE_INTEGER, example=42),
+                    }
+                )
+            ),
+            "daily": openapi.Schema(
+                type=openapi.TYPE_ARRAY,
+                items=openapi.Schema(
+                    type=openapi.TYPE_OBJECT,
+                    properties={
+                        "date": openapi.Schema(type=openapi.TYPE_STRING, format=openapi.FORMAT_DATE,
+                                               example="2025-07-25"),
+                        "referrals": openapi.Schema(type=openapi.TYPE_INTEGER, example=7),
+                    }
+                )
+            ),
+        }
+    )
+)
+
+BULK_REFERRAL_RESPONSE = openapi.Response(
+    description="Result of every activation of the batch, in request order",
+    schema=openapi.Schema(
+        type=openapi.TYPE_OBJECT,
+        properties={
+            "activated": openapi.Schema(type=openapi.TYPE_INTEGER, example=1),
+            "results": openapi.Schema(
+                type=openapi.TYPE_ARRAY,
+                items=openapi.Schema(
+                    type=openapi.TYPE_OBJECT,
+                    properties={
+                        "phone_number": PHONE_NUMBER_SCHEMA,
+                        "activated_code": ACTIVATED_CODE_SCHEMA,
+                        "status": openapi.Schema(
+                            type=openapi.TYPE_STRING, example="activated",
+                            enum=["activated", "user_not_found", "already_activated", "code_not_found",
+                                  "self_referral", "cycle"],
+                        ),
+                    }
+                )
+            ),
+        }
+    )
+)
@@ -1,3 +1,1231 @@
-from django.test import TestCase
+import json
+import os
+import tempfile
+from importlib import import_module
+import threading
+from collections import Counter
+from datetime import timedelta
+import time
+from io import StringIO
+from concurrent.futures import ThreadPoolExecutor
+from unittest import mock, skipUnless
 
-# Create your tests here.
+from asgiref.sync import iscoroutinefunction, sync_to_async
+from django.conf import settings
+from django.apps import apps
+from django.core import signing
+from django.core.cache import cache
+from django.core.management import CommandError, call_command
+from django.db import connection
+from django.http import JsonResponse
+from django.test import Client, RequestFactory, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import resolve, reverse
+from rest_framework.renderers import JSONRenderer
+from django.utils import timezone
+
+from referral_system import models
+from referral_system.code_store import CacheCodeStore, get_code_store
+from referral_system.invite_code_index import BloomFilter, InviteCodeIndex, SortedCodeSet, get_invite_code_index, \
+    invite_code_may_exist, warm_up_invite_code_index
+from referral_system.invite_codes import INVITE_CODE_ALPHABET, InviteCodeAllocator, invite_code_to_int, \
+    parse_invite_code, sequence_to_invite_code
+from referral_system.db_router import PrimaryReplicaRouter, _read_alias, is_pinned_to_primary, use_replica
+from referral_system.middleware import REQUEST_QUERIES, RESPONSE_SIZE, RequestMetricsMiddleware
+from referral_system.models import ReferralClosure, User, UserPhoneCode
+from referral_system.phone_numbers import normalize_phone_number
+from referral_system.profile_cache import PROFILE_CACHE_REQUESTS
+from referral_system.ratelimit import SlidingWindowRateLimiter
+from referral_system.referral_graph import UnionFind
+from referral_system.renderers import ORJSONRenderer, msgpack
+from referral_system.referrals import ReferralAlreadyActivatedError, ReferralCycleError, activate_referral, \
+    activate_referrals_in_bulk, delete_user, delete_user_in_background, rebuild_referral_closure, _background_executor
+from referral_system.serializers import PROFILE_FIELDS, UserProfileSerializer, serialize_profile_rows, \
+    serialize_user_profile
+from referral_system.sms import CodeDeliveryQueueFull, FakeSMSGateway, get_code_delivery
+from referral_system.tokens import TOKEN_SALT
+
+
+class AllUsersTests(TestCase):
+    def setUp(self):
+        self.referrer = User.objects.create_user(phone_number='+70000000001')
+        self.other = User.objects.create_user(phone_number='+70000000002')
+        for i in range(5):
+            User.objects.create_user(phone_number=f'+7100000000{i}', activated_code=self.referrer.invite_code,
+                                     referred_by=self.referrer)
+        User.objects.create_user(phone_number='+72000000000', activated_code=self.other.invite_code,
+                                 referred_by=self.other)
+
+    def test_referrals_are_grouped_per_user(self):
+        response = self.client.get(reverse('all_users'))
+        self.assertEqual(response.status_code, 200)
+        profiles = {profile['phone_number']: profile for profile in response.json()['results']}
+        self.assertEqual(profiles['+70000000001']['referrals'], [f'+7100000000{i}' for i in range(5)])
+        self.assertEqual(profiles['+70000000002']['referrals'], ['+72000000000'])
+        self.assertEqual(profiles['+72000000000']['referrals'], [])
+
+    def test_query_count_does_not_grow_with_users(self):
+        with self.assertNumQueries(2):
+            self.client.get(reverse('all_users'))
+        for i in range(20):
+            User.objects.create_user(phone_number=f'+7300000000{i:02}', activated_code=self.other.invite_code,
+                                     referred_by=self.other)
+        with self.assertNumQueries(2):
+            self.client.get(reverse('all_users'))
+
+    def test_cursor_pagination_walks_all_users(self):
+        phone_numbers = []
+        url = reverse('all_users') + '?page_size=3'
+        while url:
+            page = self.client.get(url).json()
+            self.assertLessEqual(len(page['results']), 3)
+            phone_numbers += [profile['phone_number'] for profile in page['results']]
+            url = page['next']
+        self.assertEqual(phone_numbers, list(User.objects.order_by('id').values_list('phone_number', flat=True)))
+
+    def test_stream_exports_ndjson(self):
+        response = self.client.get(reverse('all_users'), {'stream': 'true'})
+        self.assertEqual(response['Content-Type'], 'application/x-ndjson')
+        lines = b''.join(response.streaming_content).decode().splitlines()
+        profiles = [json.loads(line) for line in lines]
+        self.assertEqual(len(profiles), User.objects.count())
+        self.assertEqual(profiles[0]['referrals'], [f'+7100000000{i}' for i in range(5)])
+
+
+class ReferralRelationTests(TestCase):
+    def setUp(self):
+        self.referrer = User.objects.create_user(phone_number='+70000000001')
+        self.user = User.objects.create_user(phone_number='+70000000002')
+
+    def test_add_referral_links_referrer(self):
+        self.client.force_login(self.user)
+        response = self.client.patch(reverse('referral'), {'activated_code': self.referrer.invite_code},
+                                     content_type='application/json')
+        self.assertEqual(response.status_code, 200)
+        self.user.refresh_from_db()
+        self.referrer.refresh_from_db()
+        self.assertEqual(self.user.referred_by, self.referrer)
+        self.assertEqual(self.user.activated_code, self.referrer.invite_code)
+        self.assertEqual(self.referrer.referral_count, 1)
+
+    def test_own_code_is_rejected(self):
+        self.client.force_login(self.user)
+        response = self.client.patch(reverse('referral'), {'activated_code': self.user.invite_code},
+                                     content_type='application/json')
+        self.assertEqual(response.status_code, 404)
+
+    def test_delete_unlinks_referrals(self):
+        activate_referral(self.user, self.referrer)
+        UserPhoneCode.objects.create(phone_number=self.referrer.phone_number, code='1234')
+        self.client.force_login(self.referrer)
+        response = self.client.delete(reverse('delete_user'))
+        self.assertEqual(response.status_code, 200)
+        self.user.refresh_from_db()
+        self.assertIsNone(self.user.referred_by)
+        self.assertIsNone(self.user.activated_code)
+
+    def test_delete_decrements_referrer_counter(self):
+        activate_referral(self.user, self.referrer)
+        self.client.force_login(self.user)
+        self.client.delete(reverse('delete_user'))
+        self.referrer.refresh_from_db()
+        self.assertEqual(self.referrer.referral_count, 0)
+
+    def test_code_is_activated_once_from_stale_instances(self):
+        other_referrer = User.objects.create_user(phone_number='+70000000003')
+        first, second = User.objects.get(pk=self.user.pk), User.objects.get(pk=self.user.pk)
+        activate_referral(first, self.referrer)
+        with self.assertRaises(ReferralAlreadyActivatedError):
+            activate_referral(second, other_referrer)
+
+        self.user.refresh_from_db()
+        self.assertEqual(self.user.referred_by, self.referrer)
+        self.assertEqual(User.objects.get(pk=self.referrer.pk).referral_count, 1)
+        self.assertEqual(User.objects.get(pk=other_referrer.pk).referral_count, 0)
+
+        self.client.force_login(second)
+        response = self.client.patch(reverse('referral'), {'activated_code': other_referrer.invite_code},
+                                     content_type='application/json')
+        self.assertEqual(response.json(), {'message': 'Referral code already activated'})
+
+
+class ReferralStatsTests(TestCase):
+    def setUp(self):
+        self.referrer = User.objects.create_user(phone_number='+70000000001')
+        self.other = User.objects.create_user(phone_number='+70000000002')
+        for i in range(3):
+            activate_referral(User.objects.create_user(phone_number=f'+7100000000{i}'), self.referrer)
+        activate_referral(User.objects.create_user(phone_number='+72000000000'), self.other)
+        call_command('refresh_referral_stats', stdout=StringIO())
+
+    def test_top_referrers_and_daily_counts(self):
+        response = self.client.get(reverse('referral_stats'), {'top': 1})
+        self.assertEqual(response.status_code, 200)
+        data = response.json()
+        self.assertEqual(data['top_referrers'], [
+            {'phone_number': '+70000000001', 'invite_code': self.referrer.invite_code, 'referral_count': 3},
+        ])
+        self.assertEqual(data['daily'], [{'date': str(timezone.localdate()), 'referrals': 4}])
+
+    def test_daily_counts_per_referrer(self):
+        response = self.client.get(reverse('referral_stats'), {'invite_code': self.other.invite_code})
+        self.assertEqual(response.json()['daily'][0]['referrals'], 1)
+
+    def test_invalid_parameters(self):
+        response = self.client.get(reverse('referral_stats'), {'top': 'many'})
+        self.assertEqual(response.status_code, 400)
+
+
+class InviteCodeTests(TestCase):
+    def test_sequence_maps_to_distinct_codes(self):
+        codes = [sequence_to_invite_code(number) for number in range(20000)]
+        self.assertEqual(len(set(codes)), len(codes))
+        for code in codes[:100]:
+            self.assertEqual(len(code), 6)
+            self.assertTrue(set(code) <= set(INVITE_CODE_ALPHABET))
+
+    def test_code_packs_into_36_bits(self):
+        self.assertEqual(invite_code_to_int('aaaaaa'), 0)
+        self.assertLess(invite_code_to_int('999999'), 2 ** 36)
+
+    def test_signup_skips_codes_taken_by_legacy_users(self):
+        User.objects.create(phone_number='+70000000001', invite_code='AAAAAA')
+        with mock.patch.object(models.invite_code_allocator, 'next_code', side_effect=['AAAAAA', 'BBBBBB']):
+            user = User.objects.create_user(phone_number='+70000000002')
+        self.assertEqual(user.invite_code, 'BBBBBB')
+
+
+class InviteCodeSignupQueriesTests(TransactionTestCase):
+    def test_signup_costs_a_single_query(self):
+        allocator = InviteCodeAllocator(models.InviteCodeCounter, block_size=10)
+        with mock.patch.object(models, 'invite_code_allocator', allocator):
+            User.objects.create_user(phone_number='+70000000001')
+            with self.assertNumQueries(1):
+                User.objects.create_user(phone_number='+70000000002')
+
+
+@override_settings(
+    CODE_DELIVERY_BACKEND='referral_system.sms.ThreadPoolCodeDelivery',
+    SMS_GATEWAY='referral_system.sms.FakeSMSGateway',
+    SMS_GATEWAY_OPTIONS={'latency': 0.5},
+)
+class CodeDeliveryTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        FakeSMSGateway.outbox.clear()
+
+    def test_request_code_does_not_wait_for_delivery(self):
+        started = time.monotonic()
+        response = self.client.post(reverse('first_auth'), {'phone_number': '+70000000001'})
+        self.assertEqual(response.status_code, 201)
+        self.assertLess(time.monotonic() - started, 0.5)
+
+        get_code_delivery().close(wait=True)
+        self.assertEqual(list(FakeSMSGateway.outbox), [
+            ('+70000000001', f"Your authorization code: {response.json()['code']}"),
+        ])
+
+    def test_delivery_metrics_are_exposed(self):
+        get_code_delivery().send('+70000000001', '1234').result()
+        response = self.client.get(reverse('metrics'))
+        self.assertContains(response, 'referral_code_delivery_queue_depth 0')
+        self.assertContains(response, 'referral_code_delivery_total{outcome="sent"}')
+        self.assertContains(response, 'referral_code_delivery_latency_seconds_count')
+
+    @override_settings(CODE_DELIVERY_OPTIONS={'max_workers': 1, 'max_queue': 1})
+    def test_overflowing_codes_are_dropped(self):
+        delivery = get_code_delivery()
+        sending = threading.Event()
+        with mock.patch.object(FakeSMSGateway, 'send_sms', side_effect=lambda *args: sending.wait(5)):
+            first = delivery.send('+70000000001', '1234')
+            # the worker may not have taken the first code yet, then the second one waits in its place
+            delivery.send('+70000000002', '1234')
+            dropped = delivery.send('+70000000003', '1234')
+            with self.assertRaises(CodeDeliveryQueueFull):
+                dropped.result()
+            sending.set()
+            first.result()
+        self.assertContains(self.client.get(reverse('metrics')), 'referral_code_delivery_total{outcome="dropped"}')
+
+
+@override_settings(
+    PHONE_CODE_STORE='referral_system.code_store.DatabaseCodeStore',
+    CODE_DELIVERY_BACKEND='referral_system.sms.SyncCodeDelivery',
+    CODE_DELIVERY_OPTIONS={},
+    SMS_GATEWAY='referral_system.sms.FakeSMSGateway',
+    SMS_GATEWAY_OPTIONS={'latency': 0},
+)
+class AuthFlowTests(TestCase):
+    phone_number = '+70000000001'
+
+    def setUp(self):
+        cache.clear()
+
+    def request_code(self):
+        return self.client.post(reverse('first_auth'), {'phone_number': self.phone_number})
+
+    def confirm(self, code):
+        return self.client.post(reverse('confirm_code'), {'phone_number': self.phone_number, 'code': code})
+
+    def test_request_and_confirm_code(self):
+        response = self.request_code()
+        self.assertEqual(response.status_code, 201)
+        response = self.confirm(response.json()['code'])
+        self.assertEqual(response.json(), {'message': 'User authenticated', 'new_user': True})
+        self.assertIsNone(get_code_store().get(self.phone_number))
+
+    def test_resend_window(self):
+        self.assertEqual(self.request_code().status_code, 201)
+        self.assertEqual(self.request_code().status_code, 400)
+
+    def test_wrong_and_missing_code(self):
+        self.assertEqual(self.confirm('0000').status_code, 404)
+        code = self.request_code().json()['code']
+        wrong_code = '1000' if code != '1000' else '1001'
+        self.assertEqual(self.confirm(wrong_code).json(), {'message': 'Code invalid'})
+
+
+@override_settings(PHONE_CODE_STORE='referral_system.code_store.CacheCodeStore')
+class CacheAuthFlowTests(AuthFlowTests):
+    def test_codes_do_not_touch_the_database(self):
+        # valid numbers are normalized without asking whether a user with the number as typed exists
+        with self.assertNumQueries(0):
+            self.request_code()
+
+    def test_code_expires_with_the_cache_key(self):
+        store = CacheCodeStore()
+        store.issue(self.phone_number)
+        store.cache.delete(store.code_key(self.phone_number))
+        self.assertEqual(self.confirm('1234').status_code, 404)
+
+
+@override_settings(PHONE_CODE_STORE='referral_system.code_store.DatabaseCodeStore')
+class PurgePhoneCodesTests(TestCase):
+    def setUp(self):
+        expired_at = timezone.now() - timedelta(hours=2)
+        for i in range(5):
+            UserPhoneCode.objects.create(phone_number=f'+7100000000{i}', code='1234')
+        UserPhoneCode.objects.filter(phone_number__startswith='+71').update(created_at=expired_at)
+        UserPhoneCode.objects.create(phone_number='+72000000000', code='1234')
+
+    def test_purge_deletes_only_expired_codes(self):
+        call_command('purge_phone_codes', batch_size=2, stdout=StringIO())
+        self.assertEqual(list(UserPhoneCode.objects.values_list('phone_number', flat=True)), ['+72000000000'])
+
+    def test_purge_stops_after_max_batches(self):
+        call_command('purge_phone_codes', batch_size=2, max_batches=1, stdout=StringIO())
+        self.assertEqual(UserPhoneCode.objects.count(), 4)
+
+
+@override_settings(
+    PHONE_CODE_STORE='referral_system.code_store.DatabaseCodeStore',
+    CODE_DELIVERY_BACKEND='referral_system.sms.SyncCodeDelivery',
+    CODE_DELIVERY_OPTIONS={},
+    SMS_GATEWAY='referral_system.sms.FakeSMSGateway',
+    SMS_GATEWAY_OPTIONS={'latency': 0},
+)
+class RequestCodeConcurrencyTests(TransactionTestCase):
+    requests = 16
+
+    def setUp(self):
+        cache.clear()
+
+    def test_parallel_requests_issue_a_single_code(self):
+        barrier = threading.Barrier(self.requests)
+
+        def request_code(_):
+            try:
+                barrier.wait()
+                return Client().post(reverse('first_auth'), {'phone_number': '+70000000001'}).status_code
+            finally:
+                connection.close()
+
+        with ThreadPoolExecutor(max_workers=self.requests) as executor:
+            statuses = list(executor.map(request_code, range(self.requests)))
+
+        self.assertEqual(statuses.count(201), 1)
+        self.assertEqual(statuses.count(400), self.requests - 1)
+        self.assertEqual(UserPhoneCode.objects.filter(phone_number='+70000000001').count(), 1)
+
+    def test_code_is_replaced_after_resend_interval(self):
+        store = get_code_store()
+        first_code = store.issue('+70000000001')
+        UserPhoneCode.objects.update(created_at=timezone.now() - timedelta(seconds=31))
+        second_code = store.issue('+70000000001')
+        self.assertIsNotNone(second_code)
+        phone_code = UserPhoneCode.objects.get(phone_number='+70000000001')
+        self.assertEqual(phone_code.code, second_code)
+        self.assertGreater(phone_code.created_at, timezone.now() - timedelta(seconds=5))
+        self.assertIsNotNone(first_code)
+
+
+class RateLimitTests(TestCase):
+    def setUp(self):
+        cache.clear()
+
+    def test_sliding_window_weights_previous_window(self):
+        limiter = SlidingWindowRateLimiter('4/min', prefix='test')
+        for second in range(4):
+            self.assertEqual(limiter.hit('key', now=60 + second), (True, 0))
+        allowed, retry_after = limiter.hit('key', now=64)
+        self.assertFalse(allowed)
+        self.assertEqual(retry_after, 56)
+        # half of the previous window still counts: 5 * 0.5 + 1 <= 4
+        self.assertTrue(limiter.hit('key', now=150)[0])
+        self.assertTrue(limiter.hit('other', now=64)[0])
+
+    @override_settings(PHONE_CODE_STORE='referral_system.code_store.DatabaseCodeStore')
+    def test_confirm_code_brute_force_is_throttled(self):
+        UserPhoneCode.objects.create(phone_number='+70000000001', code='1234')
+        statuses = [
+            self.client.post(reverse('confirm_code'), {'phone_number': '+70000000001', 'code': f'{code}'}).status_code
+            for code in range(1000, 1010)
+        ]
+        self.assertEqual(statuses[:5], [400] * 5)
+        self.assertEqual(set(statuses[5:]), {429})
+
+    def test_request_code_is_throttled_per_ip(self):
+        statuses = {
+            self.client.post(reverse('first_auth'), {'phone_number': f'+7100000{i:04}'},
+                             REMOTE_ADDR='10.0.0.1').status_code
+            for i in range(25)
+        }
+        self.assertIn(429, statuses)
+        response = self.client.post(reverse('first_auth'), {'phone_number': '+72000000000'}, REMOTE_ADDR='10.0.0.2')
+        self.assertEqual(response.status_code, 201)
+
+    def test_spoofed_forwarded_for_does_not_reset_the_ip_limit(self):
+        def statuses(url, **headers):
+            return [self.client.post(url, {'phone_number': f'+7100000{i:04}'}, content_type='application/json',
+                                     REMOTE_ADDR='10.0.0.1', headers={'X-Forwarded-For': f'1.2.3.{i}', **headers}
+                                     ).status_code for i in range(25)]
+
+        self.assertIn(429, statuses(reverse('first_auth')))
+        cache.clear()
+        self.assertIn(429, statuses(reverse('async_first_auth')))
+
+        # behind one proxy the client is the last address the proxy appended
+        cache.clear()
+        with override_settings(REST_FRAMEWORK={**settings.REST_FRAMEWORK, 'NUM_PROXIES': 1}):
+            self.assertNotIn(429, statuses(reverse('first_auth')))
+
+    @override_settings(PHONE_CODE_STORE='referral_system.code_store.DatabaseCodeStore')
+    def test_test_page_shares_the_phone_limit(self):
+        for code in range(1000, 1005):
+            self.client.post(reverse('confirm_code'), {'phone_number': '+70000000001', 'code': f'{code}'})
+        response = self.client.post(reverse('test_confirm'), {'phone_number': '+70000000001', 'code': '1234'})
+        self.assertEqual(response.status_code, 429)
+        self.assertIn('Retry-After', response)
+
+
+class DeleteUserQueriesTests(TestCase):
+    def delete_queries(self, referrals):
+        referrer = User.objects.create_user(phone_number=f'+7000000{referrals:04}')
+        activate_referral(referrer, User.objects.create_user(phone_number=f'+7200000{referrals:04}'))
+        for i in range(referrals):
+            activate_referral(User.objects.create_user(phone_number=f'+71{referrals:04}{i:04}'), referrer)
+        self.client.force_login(referrer)
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.delete(reverse('delete_user'))
+        self.assertEqual(response.status_code, 200)
+        self.assertFalse(User.objects.filter(referred_by_id=referrer.pk).exists())
+        self.assertFalse(User.objects.filter(phone_number__startswith='+71', activated_code__isnull=False).exists())
+        return len(queries)
+
+    def test_query_count_does_not_depend_on_referrals(self):
+        self.assertEqual(self.delete_queries(referrals=1), self.delete_queries(referrals=50))
+
+
+@override_settings(REFERRAL_UNLINK_BACKGROUND_THRESHOLD=3)
+class DeleteUserInBackgroundTests(TransactionTestCase):
+    def setUp(self):
+        self.referrer = User.objects.create_user(phone_number='+70000000001')
+        for i in range(5):
+            activate_referral(User.objects.create_user(phone_number=f'+7100000000{i}'), self.referrer)
+        self.referrer.refresh_from_db()
+
+    def test_large_referrer_is_deleted_in_chunks(self):
+        future = delete_user_in_background(self.referrer, chunk_size=2)
+        future.result(timeout=10)
+        self.assertFalse(User.objects.filter(pk=self.referrer.pk).exists())
+        self.assertEqual(User.objects.filter(activated_code__isnull=False).count(), 0)
+
+    def test_view_schedules_deletion(self):
+        self.client.force_login(self.referrer)
+        with mock.patch('referral_system.views.delete_user_in_background') as delete_in_background:
+            response = self.client.delete(reverse('delete_user'))
+        self.assertEqual(response.status_code, 202)
+        delete_in_background.assert_called_once_with(self.referrer)
+
+    def test_failure_is_logged(self):
+        with mock.patch('referral_system.referrals.delete_user', side_effect=RuntimeError('deadlock')), \
+                self.assertLogs('referral_system.referrals', level='ERROR') as logs:
+            future = delete_user_in_background(self.referrer, chunk_size=2)
+            with self.assertRaises(RuntimeError):
+                future.result(timeout=10)
+            # done callbacks run in the worker right after the result is set, before its next task
+            _background_executor.submit(lambda: None).result(timeout=10)
+        self.assertIn(f'Failed to delete user {self.referrer.pk} in the background', logs.output[0])
+        self.assertIn('RuntimeError: deadlock', logs.output[0])
+        self.assertTrue(User.objects.filter(pk=self.referrer.pk).exists())
+
+
+class ProfileCacheTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.referrer = User.objects.create_user(phone_number='+70000000001')
+        self.user = User.objects.create_user(phone_number='+70000000002')
+        self.client.force_login(self.referrer)
+
+    def test_profile_is_served_from_cache(self):
+        self.client.get(reverse('profile'))
+        hits = PROFILE_CACHE_REQUESTS.value(result='hit')
+        with self.assertNumQueries(2):
+            # session and user lookups of the authentication only
+            response = self.client.get(reverse('profile'))
+        self.assertEqual(response.json()['phone_number'], '+70000000001')
+        self.assertEqual(PROFILE_CACHE_REQUESTS.value(result='hit'), hits + 1)
+
+    def test_if_none_match_returns_304(self):
+        etag = self.client.get(reverse('profile'))['ETag']
+        response = self.client.get(reverse('profile'), HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response['ETag'], etag)
+
+    def test_new_referral_invalidates_referrer_profile(self):
+        etag = self.client.get(reverse('profile'))['ETag']
+        with self.captureOnCommitCallbacks(execute=True):
+            activate_referral(self.user, self.referrer)
+        response = self.client.get(reverse('profile'), HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+        self.assertEqual(response.json()['referrals'], ['+70000000002'])
+
+    def test_deleted_referrer_invalidates_referral_profile(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            activate_referral(self.user, self.referrer)
+        self.client.force_login(self.user)
+        self.assertEqual(self.client.get(reverse('profile')).json()['activated_code'], self.referrer.invite_code)
+        self.client.force_login(self.referrer)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.delete(reverse('delete_user'))
+        self.client.force_login(self.user)
+        self.assertIsNone(self.client.get(reverse('profile')).json()['activated_code'])
+
+
+@override_settings(PHONE_CODE_STORE='referral_system.code_store.DatabaseCodeStore')
+class TokenAuthenticationTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.referrer = User.objects.create_user(phone_number='+70000000001')
+        UserPhoneCode.objects.create(phone_number='+70000000002', code='1234')
+        response = self.client.post(reverse('confirm_code'),
+                                    {'phone_number': '+70000000002', 'code': '1234', 'token': True})
+        self.tokens = response.json()
+        self.user = User.objects.get(phone_number='+70000000002')
+
+    def auth(self, token=None):
+        return {'HTTP_AUTHORIZATION': f"Bearer {token or self.tokens['access']}"}
+
+    def test_confirm_returns_tokens_without_session(self):
+        self.assertTrue(self.tokens['new_user'])
+        self.assertEqual(self.tokens['expires_in'], 15 * 60)
+        self.assertNotIn('sessionid', self.client.cookies)
+
+    def test_cached_profile_needs_no_queries(self):
+        self.client.get(reverse('profile'), **self.auth())
+        with self.assertNumQueries(0):
+            response = self.client.get(reverse('profile'), **self.auth())
+        self.assertEqual(response.json()['phone_number'], '+70000000002')
+
+    def test_write_endpoints_use_the_real_user(self):
+        response = self.client.patch(reverse('referral'), {'activated_code': self.referrer.invite_code},
+                                     content_type='application/json', **self.auth())
+        self.assertEqual(response.status_code, 200)
+        self.user.refresh_from_db()
+        self.assertEqual(self.user.referred_by, self.referrer)
+
+    def test_invalid_token_is_rejected(self):
+        response = self.client.get(reverse('profile'), **self.auth(self.tokens['refresh']))
+        self.assertEqual(response.status_code, 401)
+        response = self.client.get(reverse('profile'), **self.auth(self.tokens['access'][:-2]))
+        self.assertEqual(response.status_code, 401)
+
+    def test_refresh_rotates_tokens(self):
+        response = self.client.post(reverse('token_refresh'), {'refresh': self.tokens['refresh']})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.client.get(reverse('profile'), **self.auth(response.json()['access'])).status_code, 200)
+        response = self.client.post(reverse('token_refresh'), {'refresh': self.tokens['refresh']})
+        self.assertEqual(response.json(), {'message': 'Token revoked'})
+
+    def test_concurrent_refresh_issues_one_pair(self):
+        # both requests pass verification before either has revoked the token
+        payload = signing.loads(self.tokens['refresh'], salt=TOKEN_SALT)
+        with mock.patch('referral_system.tokens.verify_token', return_value=payload):
+            first = self.client.post(reverse('token_refresh'), {'refresh': self.tokens['refresh']})
+            second = self.client.post(reverse('token_refresh'), {'refresh': self.tokens['refresh']})
+        self.assertEqual((first.status_code, second.status_code), (200, 401))
+
+    def test_revoke(self):
+        response = self.client.post(reverse('token_revoke'), {'refresh': self.tokens['refresh']}, **self.auth())
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.client.get(reverse('profile'), **self.auth()).status_code, 401)
+        response = self.client.post(reverse('token_refresh'), {'refresh': self.tokens['refresh']})
+        self.assertEqual(response.status_code, 401)
+
+    def test_token_of_deleted_user(self):
+        self.client.delete(reverse('delete_user'), **self.auth())
+        self.assertEqual(self.client.get(reverse('profile'), **self.auth()).status_code, 401)
+        response = self.client.post(reverse('token_refresh'), {'refresh': self.tokens['refresh']})
+        self.assertEqual(response.json(), {'message': 'Unknown user'})
+
+
+@override_settings(
+    PHONE_CODE_STORE='referral_system.code_store.CacheCodeStore',
+    CODE_DELIVERY_BACKEND='referral_system.sms.SyncCodeDelivery',
+    CODE_DELIVERY_OPTIONS={},
+    SMS_GATEWAY='referral_system.sms.FakeSMSGateway',
+    SMS_GATEWAY_OPTIONS={'latency': 0},
+)
+class AsyncViewsTests(TestCase):
+    phone_number = '+70000000002'
+
+    def setUp(self):
+        cache.clear()
+        self.referrer = User.objects.create_user(phone_number='+70000000001')
+
+    async def sign_in(self, **extra):
+        response = await self.async_client.post(reverse('async_first_auth'), {'phone_number': self.phone_number},
+                                                content_type='application/json')
+        self.assertEqual(response.status_code, 201)
+        return await self.async_client.post(reverse('async_confirm_code'),
+                                            {'phone_number': self.phone_number, 'code': response.json()['code'],
+                                             **extra}, content_type='application/json')
+
+    async def test_session_flow(self):
+        response = await self.sign_in()
+        self.assertEqual(response.json(), {'message': 'User authenticated', 'new_user': True})
+
+        response = await self.async_client.patch(reverse('async_referral'),
+                                                 {'activated_code': self.referrer.invite_code},
+                                                 content_type='application/json')
+        self.assertEqual(response.status_code, 200)
+        response = await self.async_client.get(reverse('async_profile'))
+        self.assertEqual(response.json()['activated_code'], self.referrer.invite_code)
+        response = await self.async_client.get(reverse('async_profile'), headers={'If-None-Match': response['ETag']})
+        self.assertEqual(response.status_code, 304)
+
+    async def test_token_flow_matches_sync_profile(self):
+        tokens = (await self.sign_in(token=True)).json()
+        user = await User.objects.aget(phone_number=self.phone_number)
+        self.assertTrue(await sync_to_async(is_pinned_to_primary)(user.pk))
+        auth = {'Authorization': f"Bearer {tokens['access']}"}
+        response = await self.async_client.get(reverse('async_profile'), headers=auth)
+        self.assertEqual(response.status_code, 200)
+        sync_response = await self.async_client.get(reverse('profile'), headers=auth)
+        self.assertEqual(response.json(), sync_response.json())
+
+    async def test_errors(self):
+        response = await self.async_client.get(reverse('async_profile'))
+        self.assertEqual(response.status_code, 401)
+        response = await self.async_client.post(reverse('async_first_auth'), {'phone_number': 'abc'},
+                                                content_type='application/json')
+        self.assertEqual(response.status_code, 400)
+        response = await self.async_client.post(reverse('async_confirm_code'),
+                                                {'phone_number': self.phone_number, 'code': '1234'},
+                                                content_type='application/json')
+        self.assertEqual(response.json(), {'message': 'Code not found'})
+
+    async def test_metrics_middleware_stays_on_the_event_loop(self):
+        # a sync-only middleware is run through sync_to_async, on a worker thread
+        threads = []
+        observe = RequestMetricsMiddleware.observe
+
+        def recording_observe(middleware, *args):
+            threads.append(threading.get_ident())
+            return observe(middleware, *args)
+
+        REQUEST_QUERIES.clear()
+        tokens = (await self.sign_in(token=True)).json()
+        with self.settings(REQUEST_METRICS_VIEWS=['async_profile']), \
+                mock.patch.object(RequestMetricsMiddleware, 'observe', recording_observe):
+            response = await self.async_client.get(reverse('async_profile'),
+                                                   headers={'Authorization': f"Bearer {tokens['access']}"})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(threads, [threading.get_ident()])
+        _, total, count = REQUEST_QUERIES.snapshot(view='async_profile')
+        self.assertEqual(count, 1)
+        # the queries of the async ORM's worker threads are counted too
+        self.assertGreater(total, 0)
+
+
+class BenchmarkApiTests(TestCase):
+    def test_reports_every_endpoint(self):
+        out = StringIO()
+        call_command('benchmark_api', users=50, requests=5, stdout=out)
+        lines = [json.loads(line) for line in out.getvalue().splitlines()]
+        self.assertEqual(lines[0]['seeded_users'], 50)
+        self.assertEqual([line['endpoint'] for line in lines[1:]],
+                         ['auth', 'confirm', 'profile', 'code', 'users', 'delete'])
+        for line in lines[1:]:
+            self.assertEqual(line['errors'], 0, line)
+            self.assertIsNotNone(line['p99_ms'])
+        self.assertFalse(User.objects.filter(phone_number__startswith='+999').exists())
+
+
+class RequestMetricsTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        REQUEST_QUERIES.clear()
+        RESPONSE_SIZE.clear()
+        self.user = User.objects.create_user(phone_number='+70000000001')
+        self.client.force_login(self.user)
+
+    def test_observes_the_configured_views(self):
+        self.client.get(reverse('profile'))
+        self.client.get(reverse('referral_stats'))
+        _, total, count = REQUEST_QUERIES.snapshot(view='profile')
+        self.assertEqual(count, 1)
+        self.assertGreater(total, 0)
+        self.assertEqual(RESPONSE_SIZE.snapshot(view='referral_stats')[2], 0)
+        metrics = self.client.get('/metrics').content.decode()
+        self.assertIn('referral_request_duration_seconds_bucket{view="profile"', metrics)
+
+    @override_settings(SLOW_REQUEST_THRESHOLD=0)
+    def test_slow_request_log_contains_the_sql(self):
+        with self.assertLogs('referral_system.slow_requests', 'WARNING') as logs:
+            self.client.get(reverse('all_users'))
+        self.assertIn('SELECT', logs.output[0])
+
+    async def test_async_requests_are_observed_without_leaving_the_event_loop(self):
+        async def get_response(request):
+            return JsonResponse({'users': await User.objects.acount()})
+
+        middleware = RequestMetricsMiddleware(get_response)
+        self.assertTrue(iscoroutinefunction(middleware))
+        request = RequestFactory().get(reverse('profile'))
+        request.resolver_match = resolve(request.path)
+        response = await middleware(request)
+        self.assertEqual(json.loads(response.content), {'users': 1})
+        self.assertEqual(REQUEST_QUERIES.snapshot(view='profile')[1:], (1, 1))
+
+
+class ReplicaRoutingTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.referrer = User.objects.create_user(phone_number='+70000000001')
+        self.user = User.objects.create_user(phone_number='+70000000002')
+        self.client.force_login(self.user)
+
+    def read_aliases(self, *args, **kwargs):
+        aliases = []
+        original = PrimaryReplicaRouter.db_for_read
+
+        def db_for_read(router, model, **hints):
+            alias = original(router, model, **hints)
+            if model is User:
+                aliases.append(alias)
+            return alias
+
+        # 'default' stands in for a replica, so the reads still find the test database
+        with override_settings(DATABASE_REPLICAS=['default']), \
+                mock.patch.object(PrimaryReplicaRouter, 'db_for_read', db_for_read):
+            self.client.get(*args, **kwargs)
+        return aliases
+
+    def test_router(self):
+        router = PrimaryReplicaRouter()
+        self.assertIsNone(router.db_for_read(User))
+        with override_settings(DATABASE_REPLICAS=['replica1']), use_replica():
+            self.assertEqual(router.db_for_read(User), 'replica1')
+            self.assertEqual(router.db_for_write(User), 'default')
+        self.assertFalse(router.allow_migrate('replica1', 'referral_system'))
+
+    def test_read_only_views_use_the_replica(self):
+        self.assertEqual(set(self.read_aliases(reverse('all_users'))), {'default'})
+        self.assertEqual(set(self.read_aliases(reverse('referral_stats'))), {None})
+
+    def test_cache_filling_views_read_from_the_primary(self):
+        # the referrer is not pinned by the activation of their referral, yet must not cache a stale profile
+        self.client.force_login(self.referrer)
+        self.assertEqual(set(self.read_aliases(reverse('profile'))), {None})
+        self.assertEqual(set(self.read_aliases(reverse('test_user_profiles'))), {None})
+
+    def test_writes_pin_the_user_to_the_primary(self):
+        response = self.client.patch(reverse('referral'), {'activated_code': self.referrer.invite_code},
+                                     content_type='application/json')
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(is_pinned_to_primary(self.user.pk))
+        self.assertEqual(set(self.read_aliases(reverse('all_users'))), {None})
+
+    async def test_async_requests(self):
+        await self.async_client.aforce_login(self.user)
+        with override_settings(DATABASE_REPLICAS=['default']):
+            response = await self.async_client.get(reverse('all_users'))
+        self.assertEqual(response.status_code, 200)
+        # the alias chosen for the request does not leak into the context that served it
+        self.assertIsNone(_read_alias.get())
+
+        response = await self.async_client.patch(reverse('async_referral'),
+                                                 {'activated_code': self.referrer.invite_code},
+                                                 content_type='application/json')
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(await sync_to_async(is_pinned_to_primary)(self.user.pk))
+
+
+class ReferralTreeTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.root, b, c, d, e = (User.objects.create_user(phone_number=f'+7000000000{i}') for i in range(5))
+        for user, referrer in ((b, self.root), (c, self.root), (d, b), (e, d)):
+            activate_referral(user, referrer)
+        self.client.force_login(self.root)
+
+    def tree(self, **params):
+        return self.client.get(reverse('referral_tree'), params).json()
+
+    def test_tree_in_one_query(self):
+        with self.assertNumQueries(1):
+            nodes = list(User.objects.referral_subtree(self.root, max_depth=10, max_nodes=100))
+        self.assertEqual([(node.phone_number, node.parent, node.depth) for node in nodes], [
+            ('+70000000001', '+70000000000', 1),
+            ('+70000000002', '+70000000000', 1),
+            ('+70000000003', '+70000000001', 2),
+            ('+70000000004', '+70000000003', 3),
+        ])
+
+    def test_depth_and_node_caps(self):
+        self.assertEqual(self.tree(depth=2)['levels'], {'1': 2, '2': 1})
+        response = self.tree(max_nodes=2)
+        self.assertEqual((len(response['nodes']), response['truncated']), (2, True))
+        self.assertFalse(self.tree()['truncated'])
+
+    def test_stream(self):
+        response = self.client.get(reverse('referral_tree'), {'stream': 'true', 'max_nodes': 3})
+        lines = [json.loads(line) for line in b''.join(response.streaming_content).splitlines()]
+        self.assertEqual(len(lines), 4)
+        self.assertEqual(lines[-1], {'levels': {'1': 2, '2': 1}, 'truncated': True})
+
+    def test_closure_table(self):
+        expected, capped = self.tree(), self.tree(max_nodes=2)
+        with self.settings(REFERRAL_CLOSURE_TABLE=True):
+            call_command('rebuild_referral_closure', stdout=StringIO())
+            self.assertEqual(ReferralClosure.objects.count(), 7)
+            self.assertEqual(self.tree(), expected)
+            # both backends cap the subtree at the same nodes
+            self.assertEqual(self.tree(max_nodes=2), capped)
+
+            # kept up to date by activations and deletions
+            f = User.objects.create_user(phone_number='+70000000005')
+            activate_referral(f, User.objects.get(phone_number='+70000000004'))
+            self.assertEqual(self.tree()['levels'], {'1': 2, '2': 1, '3': 1, '4': 1})
+            delete_user(User.objects.get(phone_number='+70000000001'))
+            self.assertEqual(self.tree()['levels'], {'1': 1})
+            self.assertEqual(ReferralClosure.objects.count(), rebuild_referral_closure())
+
+
+class ReferralAbuseTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.a, self.b, self.c = (User.objects.create_user(phone_number=f'+7000000000{i}') for i in range(3))
+        activate_referral(self.b, self.a)
+        activate_referral(self.c, self.b)
+
+    def test_activation_rejects_cycles(self):
+        for closure in (False, True):
+            with self.settings(REFERRAL_CLOSURE_TABLE=closure):
+                if closure:
+                    rebuild_referral_closure()
+                with self.assertRaises(ReferralCycleError):
+                    activate_referral(self.a, self.c)
+        self.client.force_login(self.a)
+        response = self.client.patch(reverse('referral'), {'activated_code': self.c.invite_code},
+                                     content_type='application/json')
+        self.assertEqual(response.status_code, 400)
+        self.a.refresh_from_db()
+        self.assertIsNone(self.a.referred_by)
+
+    def test_locked_row_is_rechecked_before_the_cycle_check(self):
+        stale = User.objects.get(pk=self.b.pk)
+        stale.activated_code = None
+        with self.assertRaises(ReferralAlreadyActivatedError):
+            activate_referral(stale, self.c)
+        self.assertEqual(User.objects.get(pk=self.c.pk).referral_count, 0)
+
+    def test_union_find(self):
+        components = UnionFind(5)
+        self.assertTrue(components.union(0, 1))
+        self.assertTrue(components.union(3, 1))
+        self.assertFalse(components.union(0, 3))
+        self.assertEqual(components.find(3), components.find(0))
+        self.assertNotEqual(components.find(2), components.find(0))
+
+    def test_analyzer_flags_bursts_and_cycles(self):
+        farm = User.objects.create_user(phone_number='+71000000000')
+        for i in range(5):
+            activate_referral(User.objects.create_user(phone_number=f'+7200000000{i}'), farm)
+        # a cycle left over from before activations were checked
+        User.objects.filter(pk=self.a.pk).update(referred_by=self.c)
+
+        out = StringIO()
+        call_command('analyze_referral_graph', min_size=5, min_per_hour=100, stdout=out)
+        clusters = [json.loads(line) for line in out.getvalue().splitlines()]
+        self.assertEqual([(cluster['size'], cluster['cycle']) for cluster in clusters], [(6, False), (3, True)])
+        self.assertEqual(clusters[0]['top_referrer'], '+71000000000')
+        self.assertEqual(clusters[0]['top_referrer_referrals'], 5)
+
+
+class BulkReferralTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.a, self.b, self.c, self.d, self.e = (
+            User.objects.create_user(phone_number=f'+7000000000{i}') for i in range(5))
+        activate_referral(self.b, self.a)
+
+    def pairs(self):
+        return [
+            (self.c.phone_number, self.a.invite_code),
+            (self.c.phone_number, self.b.invite_code),
+            (self.b.phone_number, self.c.invite_code),
+            ('+79999999999', self.a.invite_code),
+            (self.d.phone_number, 'ZZZZZZ'),
+            (self.d.phone_number, self.d.invite_code),
+            (self.a.phone_number, self.c.invite_code),
+            (self.e.phone_number, self.d.invite_code),
+            # e became d's referral earlier in the same batch
+            (self.d.phone_number, self.e.invite_code),
+        ]
+
+    def test_bulk_activation(self):
+        statuses = activate_referrals_in_bulk(self.pairs(), chunk_size=2)
+        self.assertEqual(statuses, ['activated', 'already_activated', 'already_activated', 'user_not_found',
+                                    'code_not_found', 'self_referral', 'cycle', 'activated', 'cycle'])
+        self.assertEqual(list(User.objects.order_by('pk').values_list('referred_by', 'referral_count')),
+                         [(None, 2), (self.a.pk, 0), (self.a.pk, 0), (None, 1), (self.d.pk, 0)])
+        self.c.refresh_from_db()
+        self.assertEqual(self.c.activated_code, self.a.invite_code)
+        self.assertIsNotNone(self.c.activated_at)
+
+    def test_closure_table(self):
+        with self.settings(REFERRAL_CLOSURE_TABLE=True):
+            rebuild_referral_closure()
+            statuses = activate_referrals_in_bulk(self.pairs())
+            self.assertEqual(statuses.count('activated'), 2)
+            self.assertEqual(statuses[6], 'cycle')
+            maintained = set(ReferralClosure.objects.values_list('ancestor', 'descendant', 'depth'))
+            rebuild_referral_closure()
+            self.assertEqual(maintained, set(ReferralClosure.objects.values_list('ancestor', 'descendant', 'depth')))
+
+    def test_endpoint_and_command(self):
+        items = [{'phone_number': self.c.phone_number, 'activated_code': self.a.invite_code},
+                 {'phone_number': self.d.phone_number, 'activated_code': 'ZZZZZZ'}]
+        self.client.force_login(self.a)
+        response = self.client.post(reverse('referral_bulk'), {'items': items}, content_type='application/json')
+        self.assertEqual(response.status_code, 403)
+
+        User.objects.filter(pk=self.a.pk).update(is_superuser=True)
+        response = self.client.post(reverse('referral_bulk'), {'items': items}, content_type='application/json')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json(), {'activated': 1, 'results': [
+            {**items[0], 'status': 'activated'}, {**items[1], 'status': 'code_not_found'}]})
+
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'pairs.csv')
+            with open(path, 'w') as f:
+                f.write(f'phone_number,activated_code\n{self.e.phone_number},{self.d.invite_code}\n')
+            out = StringIO()
+            call_command('activate_referrals', path, stdout=out)
+        self.assertEqual(json.loads(out.getvalue())['activated'], 1)
+        self.assertEqual(User.objects.get(pk=self.e.pk).referred_by_id, self.d.pk)
+
+
+class ImportExportUsersTests(TestCase):
+    def setUp(self):
+        self.existing = User.objects.create_user(phone_number='+70000000001')
+
+    def import_file(self, name, content, stderr=None, **options):
+        path = os.path.join(self.enterContext(tempfile.TemporaryDirectory()), name)
+        with open(path, 'w', encoding='utf-8') as file:
+            file.write(content)
+        out = StringIO()
+        call_command('import_users', path, stdout=out, stderr=stderr or StringIO(), **options)
+        return json.loads(out.getvalue())
+
+    def test_import_csv(self):
+        summary = self.import_file('users.csv', '\n'.join([
+            'phone_number,invite_code',
+            '+70000000001,',
+            '+70000000002,AAAAAA',
+            '+70000000003,',
+            'not-a-phone,',
+            '+70000000003,',
+            f'+70000000004,{self.existing.invite_code}',
+            '+70000000005,BAD',
+        ]), batch_size=3)
+        del summary['seconds'], summary['rows_per_second']
+        # the second +70000000003 is in the next batch, after the first one was imported
+        self.assertEqual(summary, {'rows': 7, 'imported': 2, 'existing': 2, 'invalid_phone_number': 1,
+                                   'invite_code_taken': 1, 'invalid_invite_code': 1})
+        self.assertEqual(User.objects.get(phone_number='+70000000002').invite_code, 'AAAAAA')
+
+    def test_malformed_ndjson_lines_are_rejected(self):
+        err = StringIO()
+        summary = self.import_file('users.ndjson', '\n'.join([
+            '{"phone_number": "+70000000002"}',
+            '{"phone_number": "+7000',
+            '',
+            '["+70000000003"]',
+            '{"phone_number": 70000000004}',
+            '{"phone_number": "+70000000005"}',
+        ]), stderr=err, batch_size=2)
+        self.assertEqual((summary['rows'], summary['imported'], summary['malformed_row']), (5, 2, 3))
+        self.assertEqual(err.getvalue().splitlines(),
+                         ['line 2: malformed_row', 'line 4: malformed_row', 'line 5: malformed_row'])
+
+        path = os.path.join(self.enterContext(tempfile.TemporaryDirectory()), 'pairs.ndjson')
+        with open(path, 'w', encoding='utf-8') as file:
+            file.write(f'{{"phone_number": "+70000000002", "activated_code": "{self.existing.invite_code}"}}\n'
+                       f'not json\n')
+        with self.assertRaisesMessage(CommandError, 'line 2: malformed row'):
+            call_command('activate_referrals', path, stdout=StringIO())
+        self.assertIsNone(User.objects.get(phone_number='+70000000002').referred_by)
+
+    def test_round_trip(self):
+        self.import_file('users.ndjson', '{"phone_number": "+70000000002", "invite_code": "AAAAAA"}\n'
+                                         '{"phone_number": "+70000000003"}\n')
+        activate_referral(User.objects.get(phone_number='+70000000002'), self.existing)
+        out = StringIO()
+        call_command('export_users', format='ndjson', stdout=out, stderr=StringIO())
+        rows = [json.loads(line) for line in out.getvalue().splitlines()]
+        self.assertEqual([row['phone_number'] for row in rows], ['+70000000001', '+70000000002', '+70000000003'])
+        self.assertEqual((rows[1]['invite_code'], rows[1]['referred_by']), ('AAAAAA', '+70000000001'))
+        self.assertEqual(len(set(row['invite_code'] for row in rows)), 3)
+
+
+class InviteCodeIndexTests(TestCase):
+    def test_code_sets(self):
+        values = list(range(0, 6000, 3))
+        codes = SortedCodeSet(values[:1000])
+        for value in values[1000:]:
+            codes.add(value)
+        codes.discard(3)
+        self.assertEqual(len(codes), 1999)
+        self.assertEqual([value for value in range(6000) if value in codes], values[:1] + values[2:])
+
+        bloom = BloomFilter(len(values), error_rate=0.01)
+        for value in values:
+            bloom.add(value)
+        self.assertTrue(all(value in bloom for value in values))
+        false_positives = sum(value in bloom for value in range(1, 6000, 3))
+        self.assertLess(false_positives, 100)
+
+    def test_parse_invite_code(self):
+        self.assertEqual(parse_invite_code('aaaaab'), invite_code_to_int('aaaaab'))
+        for code in ('aaaaa', 'aaaaaaa', 'aaaa-a', None, 123456):
+            self.assertIsNone(parse_invite_code(code))
+
+    def test_index_tracks_users(self):
+        user = User.objects.create_user(phone_number='+70000000001')
+        for kind in ('sorted', 'bloom'):
+            with self.settings(INVITE_CODE_INDEX=kind):
+                index = get_invite_code_index()
+                index.load()
+                self.assertTrue(invite_code_may_exist(user.invite_code))
+                with self.assertNumQueries(0):
+                    self.assertFalse(invite_code_may_exist('bad!!!'))
+
+                created = User.objects.create_user(phone_number=f'+7000000000{2 + (kind == "bloom")}')
+                with self.assertNumQueries(0):
+                    self.assertTrue(index.may_exist(created.invite_code))
+
+                # rows written by another process are picked up by a refresh, once the index is stale
+                other = User.objects.bulk_create([User(phone_number=f'+7100000000{kind == "bloom"}',
+                                                       invite_code=f'Imp{kind[:3]}', password='!')])[0]
+                with self.assertNumQueries(0):
+                    self.assertFalse(index.may_exist(other.invite_code))
+                index.refresh_interval = 0
+                with self.assertNumQueries(1):
+                    self.assertTrue(index.may_exist(other.invite_code))
+                with self.assertNumQueries(0):
+                    self.assertTrue(index.may_exist(other.invite_code))
+                with self.assertNumQueries(1):
+                    self.assertFalse(index.may_exist('zzzzzz'))
+                index.refresh_interval = 60
+                with self.assertNumQueries(0):
+                    self.assertFalse(index.may_exist('zzzzzz'))
+
+        with self.settings(INVITE_CODE_INDEX='sorted'):
+            get_invite_code_index().load()
+            with self.captureOnCommitCallbacks(execute=True):
+                delete_user(user)
+            self.assertFalse(invite_code_may_exist(user.invite_code))
+
+    def test_code_of_another_process_is_accepted_after_refresh(self):
+        user = User.objects.create_user(phone_number='+70000000001')
+        self.client.force_login(user)
+        with self.settings(INVITE_CODE_INDEX='sorted', INVITE_CODE_INDEX_REFRESH=0):
+            get_invite_code_index().load()
+            referrer = User.objects.bulk_create([User(phone_number='+71000000000', invite_code='Imp001',
+                                                      password='!')])[0]
+            response = self.client.patch(reverse('referral'), {'activated_code': referrer.invite_code},
+                                         content_type='application/json')
+        self.assertEqual(response.status_code, 200)
+
+    def test_index_is_built_in_the_background(self):
+        building = threading.Event()
+        with self.settings(INVITE_CODE_INDEX='sorted'):
+            index = get_invite_code_index()
+            with mock.patch.object(InviteCodeIndex, 'load', side_effect=lambda force: building.wait(5)) as load, \
+                    mock.patch('referral_system.invite_code_index.connections'):
+                warm_up_invite_code_index()
+                loader = index._loader
+                # lookups do not wait for the build, they go to the database meanwhile
+                self.assertTrue(index.may_exist('zzzzzz'))
+                building.set()
+                loader.join()
+            load.assert_called_once_with(False)
+
+
+class FastSerializationTests(TestCase):
+    def setUp(self):
+        self.referrer = User.objects.create_user(phone_number='+70000000001')
+        for i in range(3):
+            activate_referral(User.objects.create_user(phone_number=f'+7100000000{i}'), self.referrer)
+
+    def test_values_rows_match_model_serializer(self):
+        users = User.objects.order_by('pk')
+        self.assertEqual(serialize_profile_rows(users.values(*PROFILE_FIELDS)),
+                         UserProfileSerializer(users, many=True).data)
+        self.assertEqual(serialize_user_profile(self.referrer), UserProfileSerializer(self.referrer).data)
+
+    def test_orjson_output_is_identical(self):
+        data = {
+            'users': UserProfileSerializer(User.objects.order_by('pk'), many=True).data,
+            'text': 'Привет \u2028 "quoted" \\ \u2029',
+            'when': timezone.now(),
+            'levels': Counter({1: 3, 2: 1}),
+            'nothing': None,
+        }
+        self.assertEqual(ORJSONRenderer().render(data), JSONRenderer().render(data))
+        self.assertEqual(ORJSONRenderer().render(data, 'application/json; indent=2'),
+                         JSONRenderer().render(data, 'application/json; indent=2'))
+
+    def test_users_endpoint(self):
+        response = self.client.get(reverse('all_users'), HTTP_ACCEPT='application/json')
+        self.assertIsInstance(response.accepted_renderer, ORJSONRenderer)
+        self.assertEqual(response.content, JSONRenderer().render(response.data))
+        self.assertEqual(response.json()['results'][0]['referrals'], ['+71000000000', '+71000000001', '+71000000002'])
+
+    @skipUnless(msgpack, 'msgpack is not installed')
+    def test_msgpack(self):
+        rest_framework = {**settings.REST_FRAMEWORK, 'DEFAULT_RENDERER_CLASSES': [
+            'referral_system.renderers.ORJSONRenderer', 'referral_system.renderers.MessagePackRenderer']}
+        with self.settings(REST_FRAMEWORK=rest_framework):
+            response = self.client.get(reverse('all_users'), HTTP_ACCEPT='application/msgpack')
+        self.assertEqual(response['Content-Type'], 'application/msgpack')
+        self.assertEqual(msgpack.unpackb(response.content), json.loads(JSONRenderer().render(response.data)))
+
+
+class PhoneNumberNormalizationTests(TestCase):
+    def test_normalize(self):
+        for value in ('+79991234567', '79991234567', '+7 (999) 123-45-67', ' 7.999.123.45.67 '):
+            self.assertEqual(normalize_phone_number(value), '+79991234567')
+        for value in ('', '1234', '+7999123456789012', '+7999abc4567', '++79991234567', None, 79991234567):
+            self.assertIsNone(normalize_phone_number(value))
+
+    def test_one_user_per_number(self):
+        first = self.client.post(reverse('first_auth'), {'phone_number': '7 999 123-45-67'})
+        self.assertEqual(first.json()['message'], 'Code is created and sent to +79991234567')
+        response = self.client.post(reverse('confirm_code'), {'phone_number': '+79991234567',
+                                                              'code': first.json()['code']})
+        self.assertEqual(response.json(), {'message': 'User authenticated', 'new_user': True})
+        self.assertEqual(list(User.objects.values_list('phone_number', flat=True)), ['+79991234567'])
+
+    def sign_in(self, phone_number, prefix=''):
+        code = self.client.post(reverse(f'{prefix}first_auth'), {'phone_number': phone_number},
+                                content_type='application/json').json()['code']
+        response = self.client.post(reverse(f'{prefix}confirm_code'), {'phone_number': phone_number, 'code': code},
+                                    content_type='application/json')
+        self.assertEqual(response.json(), {'message': 'User authenticated', 'new_user': False})
+        return int(self.client.session['_auth_user_id'])
+
+    def test_legacy_numbers_sign_in_as_stored(self):
+        legacy = User.objects.create_user(phone_number='7999-bad')
+        self.assertEqual(self.sign_in('7999-bad'), legacy.pk)
+        self.assertEqual(self.sign_in('7999-bad', prefix='async_'), legacy.pk)
+        self.assertEqual(self.client.post(reverse('first_auth'), {'phone_number': '7998-bad'}).status_code, 400)
+        self.assertEqual(self.client.post(reverse('confirm_code'), {'phone_number': '7998-bad', 'code': '1234'})
+                         .json(), {'phone_number': ['Invalid phone number']})
+
+    def test_legacy_duplicate_signs_in_as_stored(self):
+        canonical = User.objects.create_user(phone_number='+79990000002')
+        legacy = User.objects.create_user(phone_number='79990000002')
+        self.assertEqual(self.sign_in('79990000002'), legacy.pk)
+        self.assertEqual(self.sign_in('79990000002', prefix='async_'), legacy.pk)
+        self.assertEqual(self.sign_in('+79990000002'), canonical.pk)
+        self.assertEqual(self.sign_in('7 999 000-00-02'), canonical.pk)
+        self.assertEqual(activate_referrals_in_bulk([('79990000002', canonical.invite_code)]), ['activated'])
+        self.assertEqual(User.objects.get(pk=legacy.pk).referred_by_id, canonical.pk)
+
+    def test_migration(self):
+        migration = import_module('referral_system.migrations.0013_normalize_phone_numbers')
+        User.objects.bulk_create([User(phone_number=phone_number, invite_code=f'Mig{i:03d}', password='!')
+                                  for i, phone_number in enumerate(('79990000001', '+79990000002', '79990000002',
+                                                                    '7 999 000 00 03', 'legacy'))])
+        UserPhoneCode.objects.bulk_create([UserPhoneCode(phone_number=phone_number, code='1234')
+                                           for phone_number in ('79990000001', '+79990000001', '79990000004')])
+
+        migration.normalize_phone_numbers(apps, mock.Mock(connection=connection))
+        self.assertEqual(sorted(User.objects.values_list('phone_number', flat=True)),
+                         ['+79990000001', '+79990000002', '+79990000003', '79990000002', 'legacy'])
+        self.assertEqual(sorted(UserPhoneCode.objects.values_list('phone_number', flat=True)),
+                         ['+79990000001', '+79990000004'])
+
+
+@override_settings(USER_PROFILES_PAGE_SIZE=2)
+class UserProfilesPageTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        with self.captureOnCommitCallbacks(execute=True):
+            self.users = [User.objects.create_user(phone_number=f'+7000000000{i}') for i in range(1, 4)]
+            activate_referral(self.users[1], self.users[0])
+            activate_referral(self.users[2], self.users[0])
+
+    def test_pages(self):
+        with self.assertNumQueries(2):
+            # one page of users and one query for the referrals of all of them
+            response = self.client.get(reverse('test_user_profiles'))
+        self.assertContains(response, '<li>+70000000002</li>')
+        self.assertContains(response, f'?after={self.users[1].pk}')
+        self.assertNotContains(response, '<td>+70000000003</td>')
+
+        response = self.client.get(reverse('test_user_profiles'), {'after': self.users[1].pk})
+        self.assertContains(response, '<td>+70000000003</td>')
+        self.assertNotContains(response, '?after=')
+
+    def test_page_is_cached_until_a_profile_changes(self):
+        self.client.get(reverse('test_user_profiles'))
+        with self.assertNumQueries(0):
+            self.client.get(reverse('test_user_profiles'))
+
+        with self.captureOnCommitCallbacks(execute=True):
+            delete_user(self.users[1])
+        response = self.client.get(reverse('test_user_profiles'))
+        self.assertNotContains(response, '+70000000002')
+        self.assertContains(response, '<td>+70000000003</td>')
+
+    @mock.patch('referral_system.profile_cache.PROFILE_LIST_BUCKET_SIZE', 1)
+    def test_changes_only_invalidate_their_pages(self):
+        second_page = {'after': self.users[1].pk}
+        self.client.get(reverse('test_user_profiles'))
+        self.client.get(reverse('test_user_profiles'), second_page)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            new_user = User.objects.create_user(phone_number='+70000000004')
+        with self.captureOnCommitCallbacks(execute=True):
+            activate_referral(new_user, self.users[2])
+        with self.assertNumQueries(0):
+            self.client.get(reverse('test_user_profiles'))
+        response = self.client.get(reverse('test_user_profiles'), second_page)
+        self.assertContains(response, '<li>+70000000004</li>')
+        self.assertContains(response, '<td>+70000000004</td>')
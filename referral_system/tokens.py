@@ -0,0 +1,100 @@
+import time
+import uuid
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core import signing
+from django.core.cache import caches
+
+TOKEN_SALT = 'referral_system.tokens'
+ACCESS = 'access'
+REFRESH = 'refresh'
+
+
+class TokenError(Exception):
+    pass
+
+
+def _lifetime(token_type):
+    return settings.ACCESS_TOKEN_LIFETIME if token_type == ACCESS else settings.REFRESH_TOKEN_LIFETIME
+
+
+def _revocation_key(jti):
+    return f'token:revoked:{jti}'
+
+
+def _make_token(user_id, token_type):
+    payload = {
+        'uid': user_id,
+        'typ': token_type,
+        'jti': uuid.uuid4().hex,
+        'exp': int(time.time()) + _lifetime(token_type),
+    }
+    return signing.dumps(payload, salt=TOKEN_SALT, compress=True)
+
+
+def issue_tokens(user):
+    """Return a new signed access/refresh token pair for user."""
+    return {
+        'access': _make_token(user.pk, ACCESS),
+        'refresh': _make_token(user.pk, REFRESH),
+        'expires_in': settings.ACCESS_TOKEN_LIFETIME,
+    }
+
+
+def _load_token(token, token_type):
+    try:
+        payload = signing.loads(token, salt=TOKEN_SALT, max_age=_lifetime(token_type))
+    except signing.SignatureExpired:
+        raise TokenError('Token expired')
+    except signing.BadSignature:
+        raise TokenError('Invalid token')
+    if payload.get('typ') != token_type:
+        raise TokenError('Invalid token type')
+    return payload
+
+
+def verify_token(token, token_type):
+    """
+    Check the signature, age, type and revocation of a token and return its payload.
+    Only the revocation list is consulted, which lives in the cache, so no database query is made.
+    """
+    payload = _load_token(token, token_type)
+    if caches[settings.TOKEN_REVOCATION_CACHE].get(_revocation_key(payload['jti'])):
+        raise TokenError('Token revoked')
+    return payload
+
+
+async def averify_token(token, token_type):
+    payload = _load_token(token, token_type)
+    if await caches[settings.TOKEN_REVOCATION_CACHE].aget(_revocation_key(payload['jti'])):
+        raise TokenError('Token revoked')
+    return payload
+
+
+def revoke_token(payload):
+    """
+    Put a verified token on the revocation list until it would have expired anyway.
+    Returns False if it was already revoked (or has just expired), so only one of two concurrent callers wins.
+    """
+    remaining = payload['exp'] - int(time.time())
+    if remaining <= 0:
+        return False
+    return caches[settings.TOKEN_REVOCATION_CACHE].add(_revocation_key(payload['jti']), True, timeout=remaining)
+
+
+def refresh_tokens(refresh_token):
+    """
+    Exchange a refresh token for a new token pair. The old refresh token is revoked (rotation), so replaying it,
+    even concurrently, fails, and so does a token of a user deleted since it was issued.
+    """
+    payload = verify_token(refresh_token, REFRESH)
+    if not revoke_token(payload):
+        raise TokenError('Token revoked')
+    if not get_user_model().objects.filter(pk=payload['uid']).exists():
+        raise TokenError('Unknown user')
+    return {
+        'access': _make_token(payload['uid'], ACCESS),
+        'refresh': _make_token(payload['uid'], REFRESH),
+        'expires_in': settings.ACCESS_TOKEN_LIFETIME,
+    }
@@ -1,15 +1,28 @@
 from django.urls import path
 
+from referral_system.async_views import AsyncAddReferral, AsyncConfirmCode, AsyncRequestCode, AsyncUserProfile
 from referral_system.views import RequestCode, ConfirmCode, UserProfile, AddReferral, AllUsers, DeleteUser, \
-    GetAuthCodeView, ConfirmCodeView, GetProfileView, GetUserProfilesView, AddReferralView, DeleteUserView
+    ReferralStatsView, ReferralTree, RefreshToken, RevokeToken, BulkAddReferral, GetAuthCodeView, ConfirmCodeView, \
+    GetProfileView, GetUserProfilesView, AddReferralView, DeleteUserView
 
 urlpatterns = [
     path("auth/", RequestCode.as_view(), name="first_auth"),
     path("confirm/", ConfirmCode.as_view(), name="confirm_code"),
+    path("token/refresh/", RefreshToken.as_view(), name="token_refresh"),
+    path("token/revoke/", RevokeToken.as_view(), name="token_revoke"),
     path("users/", AllUsers.as_view(), name="all_users"),
     path("delete/", DeleteUser.as_view(), name="delete_user"),
     path("profile/", UserProfile.as_view(), name="profile"),
     path("code/", AddReferral.as_view(), name="referral"),
+    path("code/bulk/", BulkAddReferral.as_view(), name="referral_bulk"),
+    path("stats/", ReferralStatsView.as_view(), name="referral_stats"),
+    path("tree/", ReferralTree.as_view(), name="referral_tree"),
+
+    # Async versions, for deployments served through ReferralSystem.asgi
+    path("async/auth/", AsyncRequestCode.as_view(), name="async_first_auth"),
+    path("async/confirm/", AsyncConfirmCode.as_view(), name="async_confirm_code"),
+    path("async/profile/", AsyncUserProfile.as_view(), name="async_profile"),
+    path("async/code/", AsyncAddReferral.as_view(), name="async_referral"),
 
     # --------------- Test ----------------
     path("test/auth/", GetAuthCodeView.as_view(), name="test_auth"),
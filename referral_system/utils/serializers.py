@@ -1,8 +1,14 @@
 from rest_framework import serializers
-import re
+
+from referral_system.phone_numbers import normalize_phone_number
+
 
 class PhoneNumberSerializerMixin:
     def validate_phone_number(self, value):
-        if not re.match(r'^\+?\d{5,14}$', value):
+        # a number stored before normalization, looked up by the view, is taken exactly as stored
+        if value and value == self.context.get('stored_phone_number'):
+            return value
+        phone_number = normalize_phone_number(value)
+        if phone_number is None:
             raise serializers.ValidationError("Invalid phone number")
-        return value
\ No newline at end of file
+        return phone_number
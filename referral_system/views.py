@@ -1,10 +1,16 @@
-import time
+import json
+from collections import Counter
 from datetime import timedelta
+from itertools import islice
 
-from django.contrib.auth import login
+from django.conf import settings
+from django.contrib.auth import login, logout
 from django.contrib.auth.mixins import LoginRequiredMixin
-from django.db.models import Q
+from django.db.models import Prefetch, Sum
+from django.http import HttpResponse, StreamingHttpResponse
 from django.utils import timezone
+from django.utils.decorators import method_decorator
+from django.utils.functional import cached_property
 import requests
 from django.shortcuts import render, redirect
 from django.views import View
@@ -13,23 +19,44 @@ from drf_yasg import openapi
 from rest_framework import status, permissions
 from rest_framework.views import APIView
 from rest_framework.response import Response
+from rest_framework.utils.encoders import JSONEncoder
 from drf_yasg.utils import swagger_auto_schema
 
 from ReferralSystem.settings import BASE_URL
-from referral_system.models import User, UserPhoneCode
-from referral_system.serializers import UserSerializer, UserPhoneCodeSerializer, UserProfileSerializer, \
-    AddReferralSerializer
+from referral_system.authentication import SignedTokenAuthentication
+from referral_system.code_store import get_code_store
+from referral_system.db_router import pin_to_primary
+from referral_system.invite_code_index import invite_code_may_exist
+from referral_system.metrics import REGISTRY
+from referral_system.models import ReferralStats, User
+from referral_system.pagination import UserCursorPagination
+from referral_system.phone_numbers import phone_number_key, stored_phone_number
+from referral_system.permissions import IsSuperuser
+from referral_system.profile_cache import get_profile, get_profile_list_page, get_profile_list_version, \
+    set_profile_list_page
+from referral_system.ratelimit import GlobalRateThrottle, IPRateThrottle, PhoneNumberRateThrottle, rate_limit
+from referral_system.referrals import ReferralAlreadyActivatedError, ReferralCycleError, activate_referral, \
+    activate_referrals_in_bulk, delete_user, delete_user_in_background
+from referral_system.serializers import UserSerializer, UserPhoneCodeSerializer, \
+    AddReferralSerializer, ReferralStatsSerializer, ReferralStatsQuerySerializer, TopReferrerSerializer, \
+    RefreshTokenSerializer, RevokeTokenSerializer, ReferralTreeQuerySerializer, BulkReferralSerializer, \
+    PROFILE_FIELDS, serialize_profile_rows, serialize_user_profile
+from referral_system.sms import get_code_delivery
+from referral_system.tokens import REFRESH, TokenError, issue_tokens, refresh_tokens, revoke_token, verify_token
 from .swagger_schemas import (
     AUTH_CODE_REQUEST_BODY, CODE_CREATED_RESPONSE,
     CONFIRM_CODE_REQUEST_BODY, USER_AUTHENTICATED_RESPONSE,
-    USER_PROFILE_RESPONSE_SCHEMA, ALL_USERS_RESPONSE_SCHEMA,
+    USER_PROFILE_RESPONSE_SCHEMA, ALL_USERS_RESPONSE_SCHEMA, ALL_USERS_QUERY_PARAMETERS,
     ADD_REFERRAL_REQUEST_BODY, REFERRAL_ADDED_RESPONSE,
-    USER_DELETED_RESPONSE,
+    USER_DELETED_RESPONSE, USER_DELETION_SCHEDULED_RESPONSE, REFERRAL_STATS_QUERY_PARAMETERS,
+    REFERRAL_STATS_RESPONSE, REFRESH_TOKEN_REQUEST_BODY, REVOKE_TOKEN_REQUEST_BODY, TOKENS_RESPONSE,
+    REFERRAL_TREE_QUERY_PARAMETERS, REFERRAL_TREE_RESPONSE, BULK_REFERRAL_REQUEST_BODY, BULK_REFERRAL_RESPONSE,
 )
 
 
 class RequestCode(APIView):
     authentication_classes = ()
+    throttle_classes = (IPRateThrottle, GlobalRateThrottle)
 
     @swagger_auto_schema(
         operation_description="Get an authorization code by phone number",
@@ -45,30 +72,23 @@ class RequestCode(APIView):
         if not phone_number:
             return Response({'message': 'phone_number is required'}, status=status.HTTP_400_BAD_REQUEST)
 
-        if not User.objects.filter(phone_number=phone_number).exists():
-            serializer = UserSerializer(data=request.data)
-            serializer.is_valid(raise_exception=True)
-            phone_number = serializer.validated_data['phone_number']
-
-        user_phone_code = UserPhoneCode.objects.filter(phone_number=phone_number).first()
-        if user_phone_code:
-            if timezone.now() < user_phone_code.created_at + timedelta(seconds=30):
-                return Response({'message': 'The authentication code was requested less than 30 seconds ago'},
-                                status=status.HTTP_400_BAD_REQUEST)
-            else:
-                user_phone_code.code = user_phone_code.generate_4xcode()
-                auth_code = user_phone_code.code
-                user_phone_code.save()
-        else:
-            auth_code = UserPhoneCode.generate_4xcode()
-            UserPhoneCode.objects.create(phone_number=phone_number, code=auth_code)
-        time.sleep(1)
+        serializer = UserSerializer(data=request.data,
+                                    context={'stored_phone_number': stored_phone_number(phone_number)})
+        serializer.is_valid(raise_exception=True)
+        phone_number = serializer.validated_data['phone_number']
+
+        auth_code = get_code_store().issue(phone_number)
+        if auth_code is None:
+            return Response({'message': 'The authentication code was requested less than 30 seconds ago'},
+                            status=status.HTTP_400_BAD_REQUEST)
+        get_code_delivery().send(phone_number, auth_code)
         return Response({"message": f"Code is created and sent to {phone_number}",
                          "code": auth_code}, status=status.HTTP_201_CREATED)
 
 
 class ConfirmCode(APIView):
     authentication_classes = ()
+    throttle_classes = (IPRateThrottle, PhoneNumberRateThrottle, GlobalRateThrottle)
 
     @swagger_auto_schema(
         operation_description="Confirmation of the authorization code",
@@ -82,20 +102,21 @@ class ConfirmCode(APIView):
     )
     def post(self, request):
         created = False
-        serializer = UserPhoneCodeSerializer(data=request.data)
+        serializer = UserPhoneCodeSerializer(
+            data=request.data, context={'stored_phone_number': stored_phone_number(request.data.get('phone_number'))})
         serializer.is_valid(raise_exception=True)
         phone_number = serializer.validated_data['phone_number']
         auth_code = serializer.validated_data['code']
 
-        try:
-            code_obj = UserPhoneCode.objects.get(phone_number=phone_number)
-        except UserPhoneCode.DoesNotExist:
+        code_store = get_code_store()
+        phone_code = code_store.get(phone_number)
+        if phone_code is None:
             return Response({"message": f"Code not found"}, status=status.HTTP_404_NOT_FOUND)
 
-        if code_obj.is_expired():
+        if phone_code.expired:
             return Response({"message": f"Code expired"}, status=status.HTTP_400_BAD_REQUEST)
 
-        if code_obj.code != auth_code:
+        if phone_code.code != auth_code:
             return Response({"message": f"Code invalid"}, status=status.HTTP_400_BAD_REQUEST)
 
         try:
@@ -103,11 +124,67 @@ class ConfirmCode(APIView):
         except User.DoesNotExist:
             user = User.objects.create_user(phone_number=phone_number)
             created = True
+        code_store.discard(phone_number)
+        if serializer.validated_data['token']:
+            # token clients are anonymous to ReplicaRoutingMiddleware here, pin the new session explicitly
+            pin_to_primary(user.pk)
+            return Response({"message": "User authenticated", "new_user": created, **issue_tokens(user)},
+                            status=status.HTTP_200_OK)
         login(request, user)
-        code_obj.delete()
         return Response({"message": "User authenticated", "new_user": created}, status=status.HTTP_200_OK)
 
 
+class RefreshToken(APIView):
+    authentication_classes = ()
+    throttle_classes = (IPRateThrottle, GlobalRateThrottle)
+
+    @swagger_auto_schema(
+        operation_description="Exchange a refresh token for a new access and refresh token pair",
+        tags=["Token"],
+        request_body=REFRESH_TOKEN_REQUEST_BODY,
+        responses={
+            200: TOKENS_RESPONSE,
+            401: openapi.Response(description="Invalid, expired or revoked refresh token"),
+        }
+    )
+    def post(self, request):
+        serializer = RefreshTokenSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        try:
+            tokens = refresh_tokens(serializer.validated_data['refresh'])
+        except TokenError as exc:
+            return Response({"message": str(exc)}, status=status.HTTP_401_UNAUTHORIZED)
+        return Response(tokens, status=status.HTTP_200_OK)
+
+
+class RevokeToken(APIView):
+    authentication_classes = (SignedTokenAuthentication,)
+    permission_classes = (permissions.IsAuthenticated,)
+
+    @swagger_auto_schema(
+        operation_description="Revoke the access token of the request and, optionally, a refresh token",
+        tags=["Token"],
+        request_body=REVOKE_TOKEN_REQUEST_BODY,
+        responses={
+            200: openapi.Response(description="Tokens revoked"),
+            401: openapi.Response(description="Invalid, expired or revoked token"),
+        }
+    )
+    def post(self, request):
+        serializer = RevokeTokenSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        if 'refresh' in serializer.validated_data:
+            try:
+                refresh_payload = verify_token(serializer.validated_data['refresh'], REFRESH)
+            except TokenError as exc:
+                return Response({"message": str(exc)}, status=status.HTTP_401_UNAUTHORIZED)
+            if refresh_payload['uid'] != request.auth['uid']:
+                return Response({"message": "Token belongs to another user"}, status=status.HTTP_400_BAD_REQUEST)
+            revoke_token(refresh_payload)
+        revoke_token(request.auth)
+        return Response({"message": "Tokens revoked"}, status=status.HTTP_200_OK)
+
+
 class UserProfile(APIView):
     permission_classes = (permissions.IsAuthenticated,)
 
@@ -115,28 +192,48 @@ class UserProfile(APIView):
         operation_description="Get user profile",
         tags=["UserProfile"],
         responses={
-            200: USER_PROFILE_RESPONSE_SCHEMA
+            200: USER_PROFILE_RESPONSE_SCHEMA,
+            304: openapi.Response(description="Not modified since the version in If-None-Match"),
         }
     )
     def get(self, request):
-        user = request.user
-        serializer = UserProfileSerializer(user)
-        return Response(serializer.data)
+        profile, etag = get_profile(request.user, serialize_user_profile, request.headers.get('If-None-Match'))
+        if profile is None:
+            return Response(status=status.HTTP_304_NOT_MODIFIED, headers={'ETag': etag})
+        return Response(profile, headers={'ETag': etag})
+
+
+def iter_user_profiles_ndjson(chunk_size):
+    """Yield every user profile as one JSON line, holding at most chunk_size users in memory."""
+    rows = User.objects.order_by('id').values(*PROFILE_FIELDS).iterator(chunk_size=chunk_size)
+    while chunk := list(islice(rows, chunk_size)):
+        for profile in serialize_profile_rows(chunk):
+            yield json.dumps(profile, cls=JSONEncoder, ensure_ascii=False) + '\n'
 
 
 class AllUsers(APIView):
+    pagination_class = UserCursorPagination
 
     @swagger_auto_schema(
-        operation_description="Get all user profiles",
+        operation_description="Get user profiles page by page. "
+                              "With stream=true all profiles are exported as NDJSON in a single response",
         tags=["UserProfiles"],
+        manual_parameters=ALL_USERS_QUERY_PARAMETERS,
         responses={
             200: ALL_USERS_RESPONSE_SCHEMA
         }
     )
     def get(self, request):
-        users = User.objects.all()
-        serializer = UserProfileSerializer(users, many=True)
-        return Response(serializer.data)
+        if request.query_params.get('stream') in ('1', 'true'):
+            return StreamingHttpResponse(
+                iter_user_profiles_ndjson(settings.REFERRAL_USERS_STREAM_CHUNK_SIZE),
+                content_type='application/x-ndjson',
+            )
+
+        paginator = self.pagination_class()
+        # the cursor pagination reads the position from dict rows as well
+        rows = paginator.paginate_queryset(User.objects.values(*PROFILE_FIELDS), request, view=self)
+        return paginator.get_paginated_response(serialize_profile_rows(rows))
 
 
 class AddReferral(APIView):
@@ -161,15 +258,50 @@ class AddReferral(APIView):
             return Response({"message": "Referral code already activated"}, status=status.HTTP_400_BAD_REQUEST)
         activated_code = serializer.validated_data['activated_code']
 
-        if User.objects.filter(Q(invite_code=activated_code) & ~Q(phone_number=user.phone_number)).exists():
-            user.activated_code = activated_code
-            user.save()
-        else:
+        referrer = None
+        if invite_code_may_exist(activated_code):
+            referrer = User.objects.filter(invite_code=activated_code).exclude(pk=user.pk).first()
+        if not referrer:
             return Response({"message": f"Referral code not found"}, status=status.HTTP_404_NOT_FOUND)
+        try:
+            activate_referral(user, referrer)
+        except ReferralCycleError:
+            return Response({"message": "Referral code of your own referral"}, status=status.HTTP_400_BAD_REQUEST)
+        except ReferralAlreadyActivatedError:
+            return Response({"message": "Referral code already activated"}, status=status.HTTP_400_BAD_REQUEST)
 
         return Response({"message": "Referral code successfully added"}, status=status.HTTP_200_OK)
 
 
+class BulkAddReferral(APIView):
+    """Activate referral codes for many users at once, for partner integrations. Superusers only."""
+    permission_classes = (IsSuperuser,)
+
+    @swagger_auto_schema(
+        operation_description="Activate referral codes for a batch of users in one transaction",
+        tags=["Referral"],
+        request_body=BULK_REFERRAL_REQUEST_BODY,
+        responses={
+            200: BULK_REFERRAL_RESPONSE,
+            400: openapi.Response(description="Bad request"),
+            403: openapi.Response(description="Not a superuser"),
+        }
+    )
+    def post(self, request):
+        serializer = BulkReferralSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        items = serializer.validated_data['items']
+
+        statuses = activate_referrals_in_bulk(
+            [(item['phone_number'], item['activated_code']) for item in items],
+            chunk_size=serializer.validated_data.get('chunk_size'),
+        )
+        return Response({
+            "activated": statuses.count('activated'),
+            "results": [{**item, "status": item_status} for item, item_status in zip(items, statuses)],
+        }, status=status.HTTP_200_OK)
+
+
 class DeleteUser(APIView):
     permission_classes = (permissions.IsAuthenticated,)
 
@@ -177,21 +309,95 @@ class DeleteUser(APIView):
         operation_description="Delete user",
         tags=["Delete"],
         responses={
-            200: USER_DELETED_RESPONSE
+            200: USER_DELETED_RESPONSE,
+            202: USER_DELETION_SCHEDULED_RESPONSE,
         }
     )
     def delete(self, request):
         user = request.user
-        serializer = UserProfileSerializer(user)
-        for referral in serializer.data['referrals']:
-            referral_user = User.objects.get(phone_number=referral)
-            referral_user.activated_code = None
-            referral_user.save()
-        UserPhoneCode.objects.get(phone_number=user.phone_number).delete()
-        user.delete()
+        if user.referral_count >= settings.REFERRAL_UNLINK_BACKGROUND_THRESHOLD:
+            logout(request)
+            delete_user_in_background(user)
+            return Response({"message": "User deletion scheduled"}, status=status.HTTP_202_ACCEPTED)
+        delete_user(user)
         return Response({"message": "User deleted"}, status=status.HTTP_200_OK)
 
 
+class ReferralStatsView(APIView):
+
+    @swagger_auto_schema(
+        operation_description="Get the top referrers and referral activations per day",
+        tags=["ReferralStats"],
+        manual_parameters=REFERRAL_STATS_QUERY_PARAMETERS,
+        responses={
+            200: REFERRAL_STATS_RESPONSE
+        }
+    )
+    def get(self, request):
+        query = ReferralStatsQuerySerializer(data=request.query_params)
+        query.is_valid(raise_exception=True)
+        top = query.validated_data['top']
+        since = timezone.localdate() - timedelta(days=query.validated_data['days'] - 1)
+
+        top_referrers = User.objects.filter(referral_count__gt=0).order_by('-referral_count', 'id')[:top]
+        daily = ReferralStats.objects.filter(date__gte=since)
+        if 'invite_code' in query.validated_data:
+            daily = daily.filter(referrer__invite_code=query.validated_data['invite_code'])
+        daily = daily.values('date').annotate(referrals=Sum('referrals')).order_by('date')
+
+        return Response({
+            "top_referrers": TopReferrerSerializer(top_referrers, many=True).data,
+            "daily": ReferralStatsSerializer(daily, many=True).data,
+        })
+
+
+def iter_referral_tree_ndjson(nodes, max_nodes):
+    """Yield each node as a JSON line and finish with a {"levels": ..., "truncated": ...} summary line."""
+    levels, count = Counter(), 0
+    for node in nodes:
+        count += 1
+        if count > max_nodes:
+            break
+        levels[node.depth] += 1
+        yield json.dumps(node._asdict(), ensure_ascii=False) + '\n'
+    yield json.dumps({'levels': levels, 'truncated': count > max_nodes}) + '\n'
+
+
+class ReferralTree(APIView):
+    permission_classes = (permissions.IsAuthenticated,)
+
+    @swagger_auto_schema(
+        operation_description="Get the referrals of the user, their referrals and so on, with the count per level",
+        tags=["Referral"],
+        manual_parameters=REFERRAL_TREE_QUERY_PARAMETERS,
+        responses={
+            200: REFERRAL_TREE_RESPONSE
+        }
+    )
+    def get(self, request):
+        query = ReferralTreeQuerySerializer(data=request.query_params)
+        query.is_valid(raise_exception=True)
+        max_nodes = query.validated_data['max_nodes']
+        # one node more than requested tells whether the tree was cut off
+        nodes = User.objects.referral_subtree(request.user, query.validated_data['depth'], max_nodes + 1)
+
+        if query.validated_data['stream']:
+            return StreamingHttpResponse(iter_referral_tree_ndjson(nodes, max_nodes),
+                                         content_type='application/x-ndjson')
+        nodes = list(nodes)
+        truncated = len(nodes) > max_nodes
+        nodes = nodes[:max_nodes]
+        return Response({
+            "nodes": [node._asdict() for node in nodes],
+            "levels": Counter(node.depth for node in nodes),
+            "truncated": truncated,
+        })
+
+
+def metrics(request):
+    return HttpResponse(REGISTRY.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+
 # ---------------- Test --------------------
 class GetAuthCodeView(View):
     template_name = "request_code.html"
@@ -214,15 +420,16 @@ class GetAuthCodeView(View):
 
 
 def confirm_code_logic(request, phone_number, code):
-    try:
-        code_obj = UserPhoneCode.objects.get(phone_number=phone_number)
-    except UserPhoneCode.DoesNotExist:
+    phone_number = stored_phone_number(phone_number) or phone_number_key(phone_number)
+    code_store = get_code_store()
+    phone_code = code_store.get(phone_number)
+    if phone_code is None:
         return {"status": 404, "message": "Code not found"}
 
-    if code_obj.is_expired():
+    if phone_code.expired:
         return {"status": 400, "message": "Code expired"}
 
-    if code_obj.code != code:
+    if phone_code.code != code:
         return {"status": 400, "message": "Code invalid"}
 
     try:
@@ -233,7 +440,7 @@ def confirm_code_logic(request, phone_number, code):
         created = True
 
     login(request, user)
-    code_obj.delete()
+    code_store.discard(phone_number)
 
     return {"status": 200, "message": "User authenticated", "new_user": created}
 
@@ -244,6 +451,9 @@ class ConfirmCodeView(View):
     def get(self, request):
         return render(request, self.template_name)
 
+    @method_decorator(rate_limit(settings.REST_FRAMEWORK['DEFAULT_THROTTLE_RATES']['auth_phone'],
+                                 key=lambda request: phone_number_key(request.POST.get('phone_number')),
+                                 prefix=PhoneNumberRateThrottle.scope))
     def post(self, request):
         phone = request.POST.get('phone_number')
         code = request.POST.get('code')
@@ -258,18 +468,62 @@ class GetProfileView(LoginRequiredMixin, TemplateView):
 
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
-        serializer = UserProfileSerializer(self.request.user)
-        context['user_profile'] = serializer.data
+        context['user_profile'], _ = get_profile(self.request.user, serialize_user_profile)
         return context
 
 
+class UserProfilesPage:
+    """
+    One page of users with their referrals, after the user with primary key after. Queried lazily, so a page
+    rendered from the template fragment cache costs no queries.
+    """
+
+    def __init__(self, after, size):
+        self.after = after
+        self.size = size
+
+    @cached_property
+    def _rows(self):
+        """The users of the page plus the first one of the next page, and the version keys of the users shown."""
+        referrals = User.objects.order_by('pk').only('phone_number', 'referred_by_id')
+        # keyset pagination: the cost of a page does not depend on its position in the table
+        users = list(
+            User.objects.filter(pk__gt=self.after).order_by('pk')
+            .only('phone_number', 'invite_code', 'activated_code')
+            .prefetch_related(Prefetch('referrals', queryset=referrals))[:self.size + 1]
+        )
+        version_keys = set_profile_list_page(self.after, self.size, [user.pk for user in users[:self.size]],
+                                             last_page=len(users) <= self.size)
+        return users, version_keys
+
+    @property
+    def users(self):
+        return self._rows[0][:self.size]
+
+    @property
+    def next_after(self):
+        users = self._rows[0]
+        return users[self.size - 1].pk if len(users) > self.size else None
+
+    @property
+    def version_keys(self):
+        """The profile list version keys of the page, recorded when it was last queried or queried now."""
+        version_keys = get_profile_list_page(self.after, self.size)
+        return version_keys if version_keys is not None else self._rows[1]
+
+
 class GetUserProfilesView(View):
     template_name = 'user_profiles.html'
 
     def get(self, request):
-        users = User.objects.all()
-        serializer = UserProfileSerializer(users, many=True)
-        return render(request, self.template_name, {'users': serializer.data})
+        after = request.GET.get('after', '')
+        page = UserProfilesPage(int(after) if after.isdigit() else 0, settings.USER_PROFILES_PAGE_SIZE)
+        return render(request, self.template_name, {
+            'page': page,
+            # only changes of the users on this page (or new users, on the last one) move it to a new version
+            'version': get_profile_list_version(page.version_keys),
+            'cache_timeout': settings.PROFILE_CACHE_TIMEOUT,
+        })
 
 
 class AddReferralView(LoginRequiredMixin, View):
@@ -296,12 +550,19 @@ class AddReferralView(LoginRequiredMixin, View):
             context['error'] = "Referral code already activated"
             return render(request, self.template_name, context)
 
-        if User.objects.filter(Q(invite_code=activated_code) & ~Q(phone_number=user.phone_number)).exists():
-            user.activated_code = activated_code
-            user.save()
-            context['message'] = "Referral code successfully added"
-        else:
+        referrer = None
+        if invite_code_may_exist(activated_code):
+            referrer = User.objects.filter(invite_code=activated_code).exclude(pk=user.pk).first()
+        if not referrer:
             context['error'] = "Referral code not found"
+            return render(request, self.template_name, context)
+        try:
+            activate_referral(user, referrer)
+            context['message'] = "Referral code successfully added"
+        except ReferralCycleError:
+            context['error'] = "Referral code of your own referral"
+        except ReferralAlreadyActivatedError:
+            context['error'] = "Referral code already activated"
 
         return render(request, self.template_name, context)
 
@@ -314,15 +575,9 @@ class DeleteUserView(LoginRequiredMixin, View):
 
     def post(self, request):
         user = request.user
-        serializer = UserProfileSerializer(user)
-        for referral_phone in serializer.data.get('referrals', []):
-            try:
-                referral_user = User.objects.get(phone_number=referral_phone)
-                referral_user.activated_code = None
-                referral_user.save()
-            except User.DoesNotExist:
-                pass
-
-        UserPhoneCode.objects.filter(phone_number=user.phone_number).delete()
-        user.delete()
+        if user.referral_count >= settings.REFERRAL_UNLINK_BACKGROUND_THRESHOLD:
+            logout(request)
+            delete_user_in_background(user)
+        else:
+            delete_user(user)
         return redirect('test_auth')